@@ -0,0 +1,306 @@
+# Mark Evers
+# Created: 10/19/2026
+# batch_predict.py
+# Classifies many MIDI files at once
+
+import csv
+import json
+import os
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+
+from src.globals import *
+from src.midi_handlers.smf_reader import read_midi
+from src.midi_handlers.midi_file import MidiFileNHot, MidiFileNHotTimeSeries, MidiFileNHotIndex, \
+    MidiFileNHotTimeSeriesIndex
+from src.file_handlers.midi_archive import MidiArchive
+from src.progress import ProgressReporter
+
+# the encoders a saved model can have been trained on, by name
+FILE_CONVERTERS = {converter.__name__: converter for converter in (MidiFileNHot, MidiFileNHotTimeSeries,
+                                                                   MidiFileNHotIndex, MidiFileNHotTimeSeriesIndex)}
+
+
+
+def save_encoding(filename, _dataset):
+    """
+    Records how a model's inputs are encoded next to it, so whatever serves it encodes files the same way.
+
+    :param filename: The model's filename without an extension, like save_to_disk().
+    :param _dataset: The VectorGetter it was trained on.
+    :return: None
+    """
+
+    with open(filename + "_encoding.json", "w") as f:
+        json.dump({"file_converter": _dataset.file_converter.__name__, "X_dtype": np.dtype(_dataset.X_dtype).str}, f)
+
+
+
+def load_encoding(filename):
+    """
+    Reads back what save_encoding() recorded.  Models saved without it are n-hot models.
+
+    :param filename: The model's filename without an extension, like load_from_disk().
+    :return: The MidiFileBase subclass and the dtype to encode the model's inputs with
+    """
+
+    if not os.path.exists(filename + "_encoding.json"):
+        return MidiFileNHot, np.dtype(np.byte)
+
+    with open(filename + "_encoding.json", "r") as f:
+        encoding = json.load(f)
+
+    return FILE_CONVERTERS[encoding["file_converter"]], np.dtype(encoding["X_dtype"])
+
+
+
+def encode_file(file, file_converter=MidiFileNHot, X_dtype=np.byte):
+    """
+    Reads and encodes one file.  This is what runs in the worker processes.
+
+    :param file: Path to a MIDI file, or the contents of one as bytes.
+    :param file_converter: The MidiFileBase subclass the model's inputs are encoded with, see load_encoding().
+    :param X_dtype: The dtype of the model's inputs.
+    :return: (X, None) with the file's windows, or (None, <error message>) if it couldn't be encoded.
+    """
+
+    try:
+        mid = read_midi(file, FAST_MIDI_READER)
+        note_dist = MidiArchive.smf_meta(mid)[14:]
+        X = np.array(file_converter(file, note_dist, mid).to_X(), dtype=X_dtype)
+
+    except KeyboardInterrupt:
+        raise KeyboardInterrupt
+
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+    if not X.shape[0]:
+        return None, "No notes"
+
+    return X, None
+
+
+
+def encode_upload(filename, file_converter=MidiFileNHot, X_dtype=np.byte):
+    """
+    Reads and encodes one file uploaded to webapp.py.  Runs in a ParseWorker, so it lives here instead of in webapp.py
+    for the worker to import it.  Unlike encode_file() whatever went wrong is raised.
+
+    :param filename: Path to the MIDI file.
+    :param file_converter: The MidiFileBase subclass the model's inputs are encoded with, see load_encoding().
+    :param X_dtype: The dtype of the model's inputs.
+    :return: The file's windows as a numpy array
+    """
+
+    note_dist = MidiArchive.parse_midi_meta(filename)[14:]
+
+    mid = file_converter(filename, note_dist)
+    return np.array(mid.to_X(), dtype=X_dtype)
+
+
+
+def predict_windows(_model, pending):
+    """
+    Predicts the windows of several files with one model.predict() call and splits the results back up per file.
+
+    :param _model: The model.
+    :param pending: A list of (X, error) from encode_file().
+    :return: A list of (normed probabilities, error), one per file.  Probabilities are None if there was an error.
+    """
+
+    encoded = [X for X, error in pending if X is not None]
+    if not encoded:
+        return [(None, error) for X, error in pending]
+
+    # segment index: the windows of the i-th encoded file are y_pred[offsets[i]:offsets[i + 1]]
+    offsets = np.cumsum([0] + [X.shape[0] for X in encoded])
+    y_pred = _model.predict(np.concatenate(encoded), batch_size=PREDICT_BATCH_SIZE)
+
+    sum_probs = np.add.reduceat(y_pred, offsets[:-1], axis=0)
+    normed_probs = sum_probs / sum_probs.sum(axis=1, keepdims=True)
+
+    results = []
+    i = 0
+    for X, error in pending:
+        if X is None:
+            results.append((None, error))
+        else:
+            results.append((normed_probs[i], None))
+            i += 1
+
+    return results
+
+
+
+def predict_files(_model, files, n_processes=None, encoding=(MidiFileNHot, np.byte)):
+    """
+    Classifies many files.  They are encoded in a process pool and their windows are predicted together in batches
+    of about PREDICT_BATCH_SIZE windows.
+
+    :param _model: The model.
+    :param files: Paths to MIDI files, or their contents as bytes.
+    :param n_processes: How many worker processes to encode with (default: one per core).
+    :param encoding: The model's file_converter and X_dtype, from load_encoding().
+    :return: A generator of (index in files, normed probabilities, error) in the same order as files.  Probabilities are
+             None if the file couldn't be encoded.
+    """
+
+    with Pool(n_processes) as pool:
+
+        pending = []
+        n_pending_windows = 0
+        first_i = 0
+
+        for X, error in pool.imap(partial(encode_file, file_converter=encoding[0], X_dtype=encoding[1]), files,
+                                  chunksize=4):
+
+            pending.append((X, error))
+            if X is not None:
+                n_pending_windows += X.shape[0]
+
+            if n_pending_windows >= PREDICT_BATCH_SIZE:
+                for i, (probs, error) in enumerate(predict_windows(_model, pending)):
+                    yield first_i + i, probs, error
+                first_i += len(pending)
+                pending = []
+                n_pending_windows = 0
+
+        for i, (probs, error) in enumerate(predict_windows(_model, pending)):
+            yield first_i + i, probs, error
+
+
+
+def find_midi_files(dir):
+    """
+    Finds all the MIDI files in a directory tree.
+
+    :param dir: The directory.
+    :return: A sorted list of paths
+    """
+
+    result = []
+
+    for root, dirs, files in os.walk(dir):
+        for file in files:
+            if file.lower().endswith(".mid") or file.lower().endswith(".midi"):
+                result.append(os.path.join(root, file))
+
+    return sorted(result)
+
+
+
+def already_scored(output_file, as_json):
+    """
+    Gets the files that are already in an output file so an interrupted run can pick up where it left off.
+
+    :param output_file: The csv or json lines file.
+    :param as_json: Whether it is json lines.
+    :return: A set of filenames
+    """
+
+    if not os.path.exists(output_file):
+        return set()
+
+    with open(output_file, "r", newline="") as f:
+        if as_json:
+            return {json.loads(line)["filename"] for line in f if line.strip()}
+        else:
+            return {row["filename"] for row in csv.DictReader(f)}
+
+
+
+def score_directory(_model, composers, dir, output_file, as_json=False, n_processes=None,
+                    encoding=(MidiFileNHot, np.byte)):
+    """
+    Classifies every MIDI file in a directory tree, see score_files().
+
+    :param _model: The model.
+    :param composers: The composer of each of the model's outputs.
+    :param dir: The directory to score.
+    :param output_file: Where to write the results.
+    :param as_json: Write json lines instead of csv.
+    :param n_processes: How many worker processes to encode with (default: one per core).
+    :param encoding: The model's file_converter and X_dtype, from load_encoding().
+    :return: None
+    """
+
+    score_files(_model, composers, find_midi_files(dir), output_file, as_json, n_processes, encoding)
+
+
+
+def score_files(_model, composers, files, output_file, as_json=False, n_processes=None,
+                encoding=(MidiFileNHot, np.byte)):
+    """
+    Classifies MIDI files and writes the results to a csv (or json lines) file.  Files that are already in the output
+    file are skipped, so running it again resumes an interrupted run.
+
+    :param _model: The model.
+    :param composers: The composer of each of the model's outputs.
+    :param files: The files to score.
+    :param output_file: Where to write the results.
+    :param as_json: Write json lines instead of csv.
+    :param n_processes: How many worker processes to encode with (default: one per core).
+    :param encoding: The model's file_converter and X_dtype, from load_encoding().
+    :return: None
+    """
+
+    done = already_scored(output_file, as_json)
+    n_files = len(files)
+    files = [file for file in files if file not in done]
+    print("Found", n_files, "MIDI files,", n_files - len(files), "already scored.")
+    if not files:
+        return
+
+    new_file = not os.path.exists(output_file)
+
+    with open(output_file, "a", newline="") as f:
+
+        if not as_json:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["filename", "prediction", "error"] + list(composers))
+
+        progress = ProgressReporter("score", len(files))
+
+        for i, probs, error in predict_files(_model, files, n_processes, encoding):
+
+            prediction = composers[np.argmax(probs)] if probs is not None else None
+
+            if as_json:
+                row = {"filename": files[i], "prediction": prediction, "error": error,
+                       "probabilities": None if probs is None else dict(zip(composers, probs.tolist()))}
+                f.write(json.dumps(row) + "\n")
+            else:
+                writer.writerow([files[i], prediction, error] + ([] if probs is None else probs.tolist()))
+
+            # write through so a crash doesn't lose scored files
+            f.flush()
+            progress.update()
+
+        progress.close()
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+    from src.model_final import load_from_disk
+    from src.file_handlers.dataset import VectorGetterNHot
+
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    as_json = "--json" in argv
+    n_processes = None
+    for arg in argv[1:]:
+        if arg.startswith("--processes="):
+            n_processes = int(arg.split("=", 1)[1])
+
+    if len(args) != 2 or not os.path.isdir(args[0]):
+        print("Usage:\n  python batch_predict.py [--json] [--processes=N] <midi_dir> <output_file>")
+
+    else:
+        composers = VectorGetterNHot("midi/classical").composers
+        model = load_from_disk("models/final")
+        score_directory(model, composers, args[0], args[1], as_json, n_processes, load_encoding("models/final"))
@@ -0,0 +1,125 @@
+# Mark Evers
+# Created: 10/19/2026
+# checkpoint.py
+# Saves and restores everything needed to resume training in the middle of an epoch
+
+import json
+import os
+import pickle
+import numpy as np
+
+from src.globals import *
+
+
+
+class TrainingCheckpoint:
+    """
+    A directory holding the model's weights, the optimizer's state, the dataset (with its train/test split) and the
+    training cursor: {"epoch", "chunk_i", "batch_i", "seed"}.
+
+    Every save writes new weight files and then atomically replaces state.json, which names them, so a run killed
+    half way through a save still has the previous checkpoint.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIR):
+        """
+        :param directory: Where to keep the checkpoint.
+        """
+
+        self.directory = directory
+        self.state_file = os.path.join(directory, "state.json")
+        self.dataset_file = os.path.join(directory, "dataset.pkl")
+
+
+
+    def exists(self):
+        """
+        :return: Whether there is a checkpoint to resume from.
+        """
+        return os.path.exists(self.state_file) and os.path.exists(self.dataset_file)
+
+
+
+    def save_dataset(self, _dataset):
+        """
+        Saves the VectorGetter, so a resumed run uses the same composers and train/test split.
+
+        :param _dataset: The VectorGetter.
+        :return: None
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.dataset_file + ".tmp", "wb") as f:
+            pickle.dump(_dataset, f)
+        os.replace(self.dataset_file + ".tmp", self.dataset_file)
+
+
+
+    def load_dataset(self):
+        """
+        :return: The VectorGetter saved by save_dataset().
+        """
+        with open(self.dataset_file, "rb") as f:
+            return pickle.load(f)
+
+
+
+    def save(self, _model, state):
+        """
+        Saves a checkpoint.
+
+        :param _model: The model being trained.
+        :param state: The training cursor, a json-able dict.
+        :return: None
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        old_state = self.read_state() if os.path.exists(self.state_file) else None
+        n = old_state["n"] + 1 if old_state else 0
+
+        weights_file = "weights_{}.h5".format(n)
+        optimizer_file = "optimizer_{}.npz".format(n)
+        _model.save_weights(os.path.join(self.directory, weights_file))
+        np.savez(os.path.join(self.directory, optimizer_file), *_model.optimizer.get_weights())
+
+        state = dict(state, n=n, weights=weights_file, optimizer=optimizer_file)
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+        # the previous checkpoint isn't needed anymore
+        if old_state:
+            for file in (old_state["weights"], old_state["optimizer"]):
+                if os.path.exists(os.path.join(self.directory, file)):
+                    os.remove(os.path.join(self.directory, file))
+
+
+
+    def read_state(self):
+        """
+        :return: The training cursor of the last checkpoint.
+        """
+        with open(self.state_file, "r") as f:
+            return json.load(f)
+
+
+
+    def load(self, _model):
+        """
+        Restores the weights and optimizer state of the last checkpoint into a freshly compiled model.
+
+        :param _model: A model from create_model() with the same architecture.
+        :return: The training cursor
+        """
+
+        state = self.read_state()
+        _model.load_weights(os.path.join(self.directory, state["weights"]))
+
+        # the optimizer only creates its weights when the train function is built
+        if hasattr(_model, "_make_train_function"):
+            _model._make_train_function()
+        with np.load(os.path.join(self.directory, state["optimizer"])) as f:
+            _model.optimizer.set_weights([f["arr_{}".format(i)] for i in range(len(f.files))])
+
+        print("Resuming from epoch", state["epoch"] + 1, "file", state["chunk_i"], "batch", state["batch_i"])
+        return state
@@ -0,0 +1,454 @@
+# Mark Evers
+# Created: 10/19/2026
+# data_parallel.py
+# Trains one model with several worker processes, on one machine or several, that each train on their own shard of
+# the training files and average their weights over TCP
+
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from src.globals import *
+from src.progress import ProgressReporter
+
+
+
+class WorkerGroup:
+    """
+    The workers of one training run, connected in a star: worker 0 listens on the address and the others connect to
+    it.  Worker 0 collects what the others send, reduces it and sends the result back to all of them, so every call
+    has to be made by every worker in the same order.  If a worker dies the others get a ConnectionError instead of
+    waiting for it forever.
+    """
+
+    def __init__(self, rank, world_size, address=(DATA_PARALLEL_HOST, DATA_PARALLEL_PORT),
+                 timeout=DATA_PARALLEL_CONNECT_TIMEOUT):
+        """
+        Blocks until every worker has joined.
+
+        :param rank: This worker, 0 to world_size - 1.
+        :param world_size: How many workers there are.
+        :param address: (host, port) of worker 0.
+        :param timeout: How many seconds the other workers keep trying to connect.
+        """
+
+        self.rank = rank
+        self.world_size = world_size
+        self.peers = {}  # rank -> connection, only in worker 0
+        self.conn = None  # the connection to worker 0 in the others
+        self.sync_seconds = 0.  # time spent in average(), waiting for slower workers included
+
+        if world_size == 1:
+            return
+
+        if rank == 0:
+            with Listener(address, authkey=DATA_PARALLEL_AUTHKEY) as listener:
+                print("Waiting for", world_size - 1, "workers on {}:{}...".format(*address))
+                while len(self.peers) < world_size - 1:
+                    conn = listener.accept()
+                    peer_rank, peer_world_size = conn.recv()
+                    if peer_world_size != world_size or peer_rank in self.peers or not 0 < peer_rank < world_size:
+                        conn.close()
+                        raise ValueError("Worker {} of {} tried to join a group of {} that has workers {}".format(
+                            peer_rank, peer_world_size, world_size, sorted(self.peers)))
+                    self.peers[peer_rank] = conn
+            for conn in self.peers.values():
+                conn.send(True)
+
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    self.conn = Client(address, authkey=DATA_PARALLEL_AUTHKEY)
+                    break
+                except ConnectionRefusedError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(.5)
+            self.conn.send((rank, world_size))
+            self._recv(self.conn, 0)
+
+        print("All", world_size, "workers joined")
+
+
+
+    def close(self):
+
+        for conn in list(self.peers.values()) + [self.conn]:
+            if conn is not None:
+                conn.close()
+        self.peers = {}
+        self.conn = None
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+    @staticmethod
+    def _recv(conn, rank, as_bytes=False):
+
+        try:
+            return conn.recv_bytes() if as_bytes else conn.recv()
+        except (EOFError, OSError):
+            raise ConnectionError("Lost the connection to worker {}".format(rank))
+
+
+
+    def broadcast(self, value):
+        """
+        :param value: Worker 0's value, ignored in the others.  It's pickled.
+        :return: Worker 0's value, in every worker
+        """
+
+        if self.rank:
+            return self._recv(self.conn, 0)
+
+        for conn in self.peers.values():
+            conn.send(value)
+
+        return value
+
+
+
+    def gather(self, value):
+        """
+        :param value: This worker's value.  It's pickled.
+        :return: Every worker's value in rank order in worker 0, None in the others
+        """
+
+        if self.rank:
+            self.conn.send(value)
+            return None
+
+        return [value] + [self._recv(self.peers[rank], rank) for rank in sorted(self.peers)]
+
+
+
+    def average(self, arrays):
+        """
+        Averages a list of arrays over the workers.  They are sent as one float32 buffer and summed in rank order, so
+        every worker gets exactly the same result.
+
+        :param arrays: This worker's arrays, the same shapes in every worker (e.g. model.get_weights()).
+        :return: The averages, in the same shapes and dtypes
+        """
+
+        if self.world_size == 1:
+            return arrays
+
+        started = time.time()
+        flat = np.concatenate([np.asarray(array, dtype=np.float32).ravel() for array in arrays])
+
+        if self.rank:
+            self.conn.send_bytes(flat)
+            flat = np.frombuffer(self._recv(self.conn, 0, as_bytes=True), dtype=np.float32)
+        else:
+            total = flat.astype(np.float64)
+            for rank in sorted(self.peers):
+                total += np.frombuffer(self._recv(self.peers[rank], rank, as_bytes=True), dtype=np.float32)
+            flat = (total / self.world_size).astype(np.float32)
+            for conn in self.peers.values():
+                conn.send_bytes(flat)
+
+        result = []
+        offset = 0
+        for array in arrays:
+            array = np.asarray(array)
+            result.append(flat[offset:offset + array.size].reshape(array.shape).astype(array.dtype))
+            offset += array.size
+        self.sync_seconds += time.time() - started
+
+        return result
+
+
+
+def train_worker(rank, world_size, address=(DATA_PARALLEL_HOST, DATA_PARALLEL_PORT), archive_dir="midi/classical",
+                 prefix="models/data_parallel", epochs=N_EPOCHS, sync_steps=DATA_PARALLEL_SYNC_STEPS,
+                 batch_size=BATCH_SIZE, learning_rate=None, seed=0, n_threads=None, cores=None):
+    """
+    Runs one worker of a data parallel training run.  Every worker encodes its shard of the training files (see
+    sharding.shard_of()), starts from worker 0's initial weights and takes the same number of steps per epoch, going
+    round its shard again if it's smaller than the others.  The validation files (see VectorGetter.get_validation_files())
+    aren't in any shard.  The weights are averaged every sync_steps batches and at the end of every epoch, then worker 0
+    scores the validation files with a TrainingController and tells the others the learning rate and whether to stop.  Each worker keeps its own optimizer state.
+
+    With sync_steps=1 an epoch is 1 / world_size as many steps of world_size times as many windows, so a learning rate
+    scaled up with the workers may get closer to the single process loss in the same number of epochs.
+
+    :param rank: This worker, 0 to world_size - 1.
+    :param world_size: How many workers there are.
+    :param address: (host, port) of worker 0.
+    :param archive_dir: The archive.  Every machine needs its dataset.pkl and MIDI files at the same paths.
+    :param prefix: Worker 0 saves the model to <prefix>.json/.h5, and its history and report next to it.
+    :param epochs: The most epochs to train for.
+    :param sync_steps: How many batches between averaging the weights.
+    :param batch_size: Windows per batch in each worker.
+    :param learning_rate: Adam's learning rate, None for keras' default.
+    :param seed: The seed the workers' window orders come from.
+    :param n_threads: Threads for this worker's math libraries and tensorflow, None to leave them alone.
+    :param cores: CPUs to pin this worker to, None to leave it alone.
+    :return: The report in worker 0, None in the others
+    """
+
+    if n_threads:
+        from src.sweep import limit_threads
+        limit_threads(n_threads, cores)
+
+    # keras is only imported once the threads are limited
+    from keras import backend as K
+    from src.model_final import create_model, eval_file_accuracy, save_to_disk
+    from src.sharding import shard_of, load_dataset
+    from src.file_handlers.augmentation import augment_batch
+    from src.training_controller import TrainingController
+
+    with WorkerGroup(rank, world_size, address) as group:
+
+        dataset = load_dataset(archive_dir)
+        model = create_model(dataset, learning_rate=learning_rate)
+        model.set_weights(group.broadcast(model.get_weights() if rank == 0 else None))
+
+        keep = [i for i, file in enumerate(dataset.X_train_filenames[:dataset.get_n_fit_files()])
+                if shard_of(file, world_size, archive_dir) == rank]
+        X, y, counts, lengths, drums = dataset.assemble([dataset.X_train_filenames[i] for i in keep],
+                                                        [dataset.y_train_filenames[i] for i in keep], stage="encode")
+        windows = group.broadcast(group.gather(len(y)))
+        if not min(windows):
+            raise ValueError("Worker {} has no training windows, {} workers are too many".format(
+                windows.index(0), world_size))
+        steps = int(np.ceil(sum(windows) / (world_size * batch_size)))
+        print("Worker", rank, "has", len(keep), "files,", len(y), "windows,", steps, "steps per epoch")
+
+        controller = None
+        if rank == 0:
+            controller = TrainingController(lambda m: eval_file_accuracy(dataset, m, split="validation"), prefix=prefix)
+            controller.set_model(model)
+
+        started = time.time()
+        history = []
+        for epoch in range(epochs):
+
+            print("EPOCH", epoch + 1, "/", epochs)
+            if controller:
+                controller.on_epoch_begin(epoch)
+
+            random_state = np.random.RandomState([seed, epoch, rank])
+            n_passes = int(np.ceil(steps * batch_size / len(y)))
+            order = np.concatenate([random_state.permutation(len(y)) for i in range(n_passes)])
+
+            epoch_started = time.time()
+            sync_seconds = group.sync_seconds
+            losses = []
+            with ProgressReporter("train", steps, unit="batches") as progress:
+                for step in range(steps):
+                    batch = order[step * batch_size:(step + 1) * batch_size]
+                    X_batch = X[batch]
+                    if AUGMENT_TRANSPOSE:
+                        X_batch = augment_batch(X_batch, drums[batch], np.random.RandomState([seed, epoch, rank, step]),
+                                                max_polyphony=dataset.max_polyphony)
+                    losses.append(model.train_on_batch(X_batch, y[batch]))
+
+                    if not (step + 1) % sync_steps or step + 1 == steps:
+                        model.set_weights(group.average(model.get_weights()))
+                    progress.update(windows=len(batch))
+
+            timings = group.gather((time.time() - epoch_started, group.sync_seconds - sync_seconds,
+                                    np.mean(losses, axis=0)))
+
+            decision = None
+            if rank == 0:
+                train_seconds = max(seconds for seconds, sync, loss in timings)
+                loss = np.mean([loss for seconds, sync, loss in timings], axis=0)
+                logs = dict(zip(getattr(model, "metrics_names", ["loss"]), np.atleast_1d(loss)))
+
+                eval_started = time.time()
+                controller.on_epoch_end(epoch, logs)
+                record = {"epoch": epoch + 1, "train_seconds": train_seconds,
+                          "sync_seconds": float(np.mean([sync for seconds, sync, loss in timings])),
+                          "eval_seconds": time.time() - eval_started,
+                          "windows_per_second": world_size * steps * batch_size / train_seconds,
+                          "accuracy": float(controller.history[-1]["accuracy"]), "lr": controller.get_lr()}
+                record.update({key: float(value) for key, value in logs.items()})
+                history.append(record)
+                print("\nEpoch {}: loss {:.4f}, validation accuracy {:.3f}, {:,.0f} windows/s, {:.0%} of it syncing".format(
+                    epoch + 1, record["loss"], record["accuracy"], record["windows_per_second"],
+                    record["sync_seconds"] / train_seconds))
+
+                decision = {"stop": controller.stopped_epoch is not None, "lr": controller.get_lr()}
+
+            decision = group.broadcast(decision)
+            K.set_value(model.optimizer.lr, decision["lr"])
+            if decision["stop"]:
+                break
+
+    if rank:
+        return None
+
+    if os.path.exists(prefix + "_best.h5"):
+        model.load_weights(prefix + "_best.h5")
+    save_to_disk(model, prefix, dataset)
+    # the best weights were picked on the validation files, the test files weren't looked at until now
+    test_accuracy = float(eval_file_accuracy(dataset, model)[0])
+
+    report = {"workers": world_size, "sync_steps": sync_steps, "batch_size": batch_size,
+              "learning_rate": learning_rate, "seed": seed, "n_threads": n_threads, "windows": windows,
+              "steps_per_epoch": steps, "seconds": time.time() - started,
+              "windows_per_second": float(np.median([record["windows_per_second"] for record in history])),
+              "final_loss": history[-1]["loss"], "best_accuracy": controller.best_accuracy,
+              "best_epoch": controller.best_epoch, "test_accuracy": test_accuracy, "epochs": history}
+    with open(prefix + "_report.json", "w") as f:
+        json.dump(report, f, indent=1)
+    print("\nSaved the model to", prefix + ".json/.h5 and the report to", prefix + "_report.json")
+
+    return report
+
+
+
+def worker_args(rank, world_size, address, **kwargs):
+    """
+    :return: The command line that runs train_worker() with these arguments
+    """
+
+    args = [sys.executable, "-m", "src.data_parallel", "worker", "--rank=" + str(rank), "--workers=" + str(world_size),
+            "--address={}:{}".format(*address)]
+    for key, value in kwargs.items():
+        if value is None:
+            continue
+        if key == "cores":
+            value = ",".join(str(core) for core in value)
+        args.append("--{}={}".format(key.replace("_", "-"), value))
+
+    return args
+
+
+
+def run_local(world_size, archive_dir="midi/classical", prefix="models/data_parallel", epochs=N_EPOCHS,
+              sync_steps=DATA_PARALLEL_SYNC_STEPS, batch_size=BATCH_SIZE, learning_rate=None, seed=0,
+              port=DATA_PARALLEL_PORT):
+    """
+    Runs every worker on this machine, each in its own process with an even share of the cores.
+
+    :param world_size: How many workers.
+    :param archive_dir: The archive, its dataset.pkl is made if it isn't there.
+    :param prefix: Where the model and its report go.
+    :param epochs: See train_worker().
+    :param sync_steps: See train_worker().
+    :param batch_size: See train_worker().
+    :param learning_rate: See train_worker().
+    :param seed: See train_worker().
+    :param port: The port worker 0 listens on.
+    :return: The report
+    """
+
+    dataset_pickle = os.path.join(archive_dir, "dataset.pkl")
+    if not os.path.exists(dataset_pickle):
+        from src.file_handlers.dataset import VectorGetterNHot
+        dataset = VectorGetterNHot(archive_dir)
+        with open(dataset_pickle, "wb") as f:
+            pickle.dump(dataset, f)
+
+    n_cores = os.cpu_count() or 1
+    n_threads = max(n_cores // world_size, 1)
+    print("Training with", world_size, "workers,", n_threads, "threads each")
+
+    workers = []
+    for rank in range(world_size):
+        cores = [core % n_cores for core in range(rank * n_threads, (rank + 1) * n_threads)]
+        workers.append(subprocess.Popen(worker_args(
+            rank, world_size, ("127.0.0.1", port), archive=archive_dir, prefix=prefix, epochs=epochs,
+            sync_steps=sync_steps, batch_size=batch_size, learning_rate=learning_rate, seed=seed, threads=n_threads,
+            cores=cores if world_size * n_threads <= n_cores else None)))
+
+    failed = [rank for rank, worker in enumerate(workers) if worker.wait()]
+    if failed:
+        raise RuntimeError("Workers {} failed".format(", ".join(str(rank) for rank in failed)))
+
+    with open(prefix + "_report.json", "r") as f:
+        return json.load(f)
+
+
+
+def scaling(worker_counts=(1, 2, 4), prefix="models/data_parallel", **kwargs):
+    """
+    Trains the same model with different numbers of local workers and compares their throughput, loss and accuracy.
+
+    :param worker_counts: The numbers of workers to try.
+    :param prefix: Each run goes to <prefix>_<workers>, the comparison to <prefix>_scaling.json.
+    :param kwargs: The rest of run_local()'s arguments.
+    :return: The reports
+    """
+
+    reports = [run_local(world_size, prefix="{}_{}".format(prefix, world_size), **kwargs)
+               for world_size in worker_counts]
+    baseline = reports[0]["windows_per_second"] / reports[0]["workers"]
+
+    print("\n{:>7}  {:>13}  {:>7}  {:>10}  {:>8}  {:>10}  {:>14}  {:>13}".format(
+        "workers", "windows/s", "speedup", "efficiency", "syncing", "final loss", "valid accuracy", "test accuracy"))
+    for report in reports:
+        speedup = report["windows_per_second"] / baseline
+        syncing = sum(epoch["sync_seconds"] for epoch in report["epochs"]) / \
+            sum(epoch["train_seconds"] for epoch in report["epochs"])
+        report["speedup"] = speedup
+        print("{:>7}  {:>13,.0f}  {:>6.2f}x  {:>10.0%}  {:>8.0%}  {:>10.4f}  {:>14.3f}  {:>13.3f}".format(
+            report["workers"], report["windows_per_second"], speedup, speedup / report["workers"], syncing,
+            report["final_loss"], report["best_accuracy"], report["test_accuracy"]))
+
+    with open(prefix + "_scaling.json", "w") as f:
+        json.dump(reports, f, indent=1)
+
+    return reports
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in argv[1:] if arg.startswith("--") and "=" in arg)
+
+    if len(args) != 1 or args[0] not in ("worker", "local", "scaling") or \
+            (args[0] == "worker" and not {"rank", "workers"}.issubset(options)):
+        print("Usage:\n"
+              "  python data_parallel.py worker --rank=K --workers=N [--address=host:port] [--threads=T]\n"
+              "  python data_parallel.py local [--workers=N]\n"
+              "  python data_parallel.py scaling [--workers=1,2,4]\n"
+              "All take [--archive=DIR] [--prefix=models/data_parallel] [--epochs=E] [--sync-steps=S] "
+              "[--batch-size=B] [--learning-rate=LR] [--seed=S].\n"
+              "To train across machines run 'worker' on each with its own --rank, the same --workers and the address "
+              "of the machine running rank 0.")
+        exit(1)
+
+    kwargs = {"archive_dir": options.get("archive", "midi/classical"),
+              "prefix": options.get("prefix", "models/data_parallel"),
+              "epochs": int(options.get("epochs", N_EPOCHS)),
+              "sync_steps": int(options.get("sync-steps", DATA_PARALLEL_SYNC_STEPS)),
+              "batch_size": int(options.get("batch-size", BATCH_SIZE)),
+              "learning_rate": float(options["learning-rate"]) if "learning-rate" in options else None,
+              "seed": int(options.get("seed", 0))}
+
+    if args[0] == "worker":
+        host, port = options.get("address", "{}:{}".format(DATA_PARALLEL_HOST, DATA_PARALLEL_PORT)).rsplit(":", 1)
+        train_worker(int(options["rank"]), int(options["workers"]), (host, int(port)),
+                     n_threads=int(options["threads"]) if "threads" in options else None,
+                     cores=[int(core) for core in options["cores"].split(",")] if "cores" in options else None,
+                     **kwargs)
+
+    elif args[0] == "local":
+        run_local(int(options.get("workers", 2)), **kwargs)
+
+    else:
+        del kwargs["prefix"]
+        scaling(tuple(int(n) for n in options.get("workers", "1,2,4").split(",")),
+                options.get("prefix", "models/data_parallel"), **kwargs)
@@ -0,0 +1,276 @@
+# Mark Evers
+# Created: 10/19/2026
+# distillation.py
+# Trains a small student model on the soft predictions of the final model and compares their accuracy and latency
+
+import json
+import os
+import pickle
+import time
+import numpy as np
+from keras.layers import RNN
+from sklearn.metrics import precision_recall_fscore_support
+
+from src.globals import *
+from src.file_handlers.dataset import VectorGetterNHot
+from src.file_handlers.shared_corpus import SharedCorpus, attach_from_file
+from src.file_handlers.bucketing import lstm_flops_per_step
+from src.model_final import create_model, load_from_disk, save_to_disk
+from src.sweep import file_predictions
+from src.training_controller import TrainingController
+
+
+
+def soft_targets(teacher, X, temperature=DISTILL_TEMPERATURE):
+    """
+    The teacher's predictions, softened.  The model ends in a softmax, so its log probabilities are its logits (up to a
+    constant that the softmax ignores) and dividing them by the temperature spreads the probability over the composers
+    it thinks are close.
+
+    :param teacher: The trained model.
+    :param X: The windows.
+    :param temperature: 1 for the teacher's own probabilities, higher for softer ones.
+    :return: A float32 numpy array of shape (n_windows, n_composers)
+    """
+
+    probs = teacher.predict(X, batch_size=PREDICT_BATCH_SIZE, verbose=1)
+
+    logits = np.log(np.clip(probs, 1e-7, 1)) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    soft = np.exp(logits)
+
+    return (soft / soft.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+
+def distillation_targets(y, soft, alpha=DISTILL_ALPHA):
+    """
+    Mixes the true labels into the soft targets.  Training on the mix with categorical crossentropy is the usual
+    distillation loss with the student at temperature 1.
+
+    :param y: One-hot labels.
+    :param soft: From soft_targets().
+    :param alpha: How much of the target is the true label.
+    :return: A float32 numpy array the shape of y
+    """
+
+    return (alpha * y + (1 - alpha) * soft).astype(np.float32)
+
+
+
+def file_metrics(_model, corpus, n_composers, first_file, last_file):
+    """
+    File level metrics over a range of a corpus' files, like eval_file_accuracy() without encoding them again.
+
+    :param _model: The model.
+    :param corpus: A SharedCorpus.
+    :param n_composers: How many composers the dataset has.
+    :param first_file: The first file to score.
+    :param last_file: One past the last file.
+    :return: accuracy, precision, recall, fscore
+    """
+
+    y = corpus.file_labels[first_file:last_file]
+    y_pred = file_predictions(_model, corpus, first_file, last_file)
+
+    accuracy = float((y == y_pred).mean()) if len(y) else 0.
+    precision, recall, fscore, support = precision_recall_fscore_support(y, y_pred, labels=np.arange(n_composers))
+
+    return accuracy, precision, recall, fscore
+
+
+
+def measure_latency(_model, X, batch_size, repeats=DISTILL_LATENCY_REPEATS):
+    """
+    Times model.predict() on the same windows a few times.
+
+    :param _model: The model.
+    :param X: The windows.
+    :param batch_size: The batch size to predict with.
+    :param repeats: How many times, the fastest counts.
+    :return: Seconds per window
+    """
+
+    # the first call builds the predict function
+    _model.predict(X[:batch_size], batch_size=batch_size)
+
+    fastest = None
+    for i in range(repeats):
+        started = time.perf_counter()
+        _model.predict(X, batch_size=batch_size)
+        seconds = time.perf_counter() - started
+        fastest = seconds if fastest is None else min(fastest, seconds)
+
+    return fastest / len(X)
+
+
+
+def model_units(_model):
+    """
+    :param _model: A model from create_model().
+    :return: The units of each of its LSTMs
+    """
+    # the index encoders' first LSTM is an RNN(BagLSTMCell), LSTM is an RNN too
+    return tuple(layer.cell.units for layer in _model.layers if isinstance(layer, RNN))
+
+
+
+def profile(_model, _dataset, corpus, X_latency):
+    """
+    Measures everything the report compares.
+
+    :param _model: The model.
+    :param _dataset: The VectorGetter the corpus was encoded from.
+    :param corpus: A SharedCorpus.
+    :param X_latency: The windows to time it on.
+    :return: A json-able dict
+    """
+
+    accuracy, precision, recall, fscore = file_metrics(_model, corpus, _dataset.n_composers, corpus.n_train_files,
+                                                       len(corpus.file_labels))
+    units = model_units(_model)
+    # the index encoders look up at most max_polyphony rows of the first LSTM's kernel instead of multiplying it out
+    n_inputs = _dataset.max_polyphony or _dataset.n_features
+
+    return {"units": units,
+            "parameters": int(_model.count_params()),
+            "multiply_adds_per_window": lstm_flops_per_step(n_inputs, units) * NUM_STEPS,
+            "accuracy": accuracy,
+            "fscore": float(np.mean(fscore)),
+            # the webapp predicts each upload with keras' default batch size
+            "ms_per_window_serving": measure_latency(_model, X_latency, 32) * 1000,
+            "ms_per_window_bulk": measure_latency(_model, X_latency, PREDICT_BATCH_SIZE) * 1000}
+
+
+
+def print_report(report):
+    """
+    :param report: From distill().
+    :return: None
+    """
+
+    teacher = report["teacher"]
+    student = report["student"]
+
+    print("\n{:>12}  {:>18}  {:>10}  {:>14}  {:>8}  {:>7}  {:>14}  {:>12}".format(
+        "model", "units", "params", "MACs/window", "accuracy", "fscore", "ms/window @32", "ms/window @" + str(PREDICT_BATCH_SIZE)))
+    for name, result in (("teacher", teacher), ("student", student)):
+        print("{:>12}  {:>18}  {:>10,}  {:>14,}  {:>8.3f}  {:>7.3f}  {:>14.4f}  {:>12.4f}".format(
+            name, str(tuple(result["units"])), result["parameters"], result["multiply_adds_per_window"],
+            result["accuracy"], result["fscore"], result["ms_per_window_serving"], result["ms_per_window_bulk"]))
+
+    print("\nStudent vs teacher: {:+.1f} points of file accuracy, {:.1f}x fewer multiply-adds, {:.1f}x faster serving, "
+          "{:.1f}x faster in bulk".format(
+              (student["accuracy"] - teacher["accuracy"]) * 100,
+              teacher["multiply_adds_per_window"] / student["multiply_adds_per_window"],
+              teacher["ms_per_window_serving"] / student["ms_per_window_serving"],
+              teacher["ms_per_window_bulk"] / student["ms_per_window_bulk"]))
+
+
+
+def distill(archive_dir="midi/classical", teacher_file="models/final", student_file="models/student",
+            units=DISTILL_UNITS, dropout=DISTILL_DROPOUT, epochs=DISTILL_EPOCHS, alpha=DISTILL_ALPHA,
+            temperature=DISTILL_TEMPERATURE):
+    """
+    Trains a student on the teacher's soft predictions over the training windows, keeps its best epoch by file accuracy
+    on the validation files (see VectorGetter.get_validation_files(), they aren't trained on) and saves it like
+    save_to_disk(), so webapp.py can serve it (see SERVING_MODEL).  The windows come from
+    the shared corpus if shared_corpus.py is serving it, otherwise they are encoded once here.
+
+    :param archive_dir: The archive, its dataset.pkl is made if it isn't there.
+    :param teacher_file: The trained model, from save_to_disk().
+    :param student_file: Where the student goes.  Its history and weights from training go next to it.
+    :param units: The student's LSTMs.
+    :param dropout: The dropout after each of them.
+    :param epochs: The most epochs to train it for.
+    :param alpha: How much of the targets are the true labels.
+    :param temperature: How much the teacher's predictions are softened.
+    :return: The report, which is also saved to <student_file>_report.json
+    """
+
+    dataset_pickle = os.path.join(archive_dir, "dataset.pkl")
+    manifest_file = os.path.join(archive_dir, "shared_corpus.json")
+
+    # the same train/test split the teacher was trained on
+    if os.path.exists(dataset_pickle):
+        with open(dataset_pickle, "rb") as f:
+            dataset = pickle.load(f)
+    else:
+        dataset = VectorGetterNHot(archive_dir)
+        with open(dataset_pickle, "wb") as f:
+            pickle.dump(dataset, f)
+
+    if os.path.exists(manifest_file):
+        corpus = attach_from_file(manifest_file)
+    else:
+        corpus = SharedCorpus.from_dataset(dataset)
+
+    try:
+        X_train, X_test, y_train, y_test = corpus.split()
+        X_latency = X_test[:DISTILL_LATENCY_WINDOWS]
+        n_fit_files = dataset.get_n_fit_files()
+        n_fit_windows = int(corpus.file_offsets[n_fit_files])
+        X_train, y_train = X_train[:n_fit_windows], y_train[:n_fit_windows]
+
+        teacher = load_from_disk(teacher_file)
+        print("\nPredicting soft targets for", len(X_train), "training windows...")
+        targets = distillation_targets(y_train, soft_targets(teacher, X_train, temperature), alpha)
+
+        student = create_model(dataset, units=units, dropout=dropout)
+        controller = TrainingController(lambda m: file_metrics(m, corpus, dataset.n_composers, n_fit_files,
+                                                               corpus.n_train_files),
+                                        prefix=student_file, keep_last=0)
+        student.fit(X_train, targets, epochs=epochs, batch_size=BATCH_SIZE, callbacks=[controller])
+
+        if os.path.exists(student_file + "_best.h5"):
+            student.load_weights(student_file + "_best.h5")
+        save_to_disk(student, student_file, dataset)
+
+        print("\nProfiling...")
+        report = {"teacher_file": teacher_file, "student_file": student_file, "alpha": alpha,
+                  "temperature": temperature, "latency_windows": len(X_latency),
+                  "teacher": profile(teacher, dataset, corpus, X_latency),
+                  "student": profile(student, dataset, corpus, X_latency)}
+
+    finally:
+        corpus.close()
+
+    with open(student_file + "_report.json", "w") as f:
+        json.dump(report, f, indent=1)
+    print_report(report)
+    print("\nSaved the student to", student_file + ".json/.h5, set SERVING_MODEL to serve it.")
+
+    return report
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+
+    kwargs = {}
+    for arg in argv[1:]:
+        if arg.startswith("--teacher="):
+            kwargs["teacher_file"] = arg.split("=", 1)[1]
+        elif arg.startswith("--student="):
+            kwargs["student_file"] = arg.split("=", 1)[1]
+        elif arg.startswith("--units="):
+            kwargs["units"] = tuple(int(n) for n in arg.split("=", 1)[1].split(","))
+        elif arg.startswith("--dropout="):
+            kwargs["dropout"] = tuple(float(rate) for rate in arg.split("=", 1)[1].split(","))
+        elif arg.startswith("--epochs="):
+            kwargs["epochs"] = int(arg.split("=", 1)[1])
+        elif arg.startswith("--alpha="):
+            kwargs["alpha"] = float(arg.split("=", 1)[1])
+        elif arg.startswith("--temperature="):
+            kwargs["temperature"] = float(arg.split("=", 1)[1])
+        else:
+            print("Usage:\n  python distillation.py [--teacher=models/final] [--student=models/student] "
+                  "[--units=256,128] [--dropout=.3,.1] [--epochs=N] [--alpha=A] [--temperature=T]")
+            exit(1)
+
+    if "units" in kwargs and "dropout" not in kwargs:
+        kwargs["dropout"] = DISTILL_DROPOUT[:1] * len(kwargs["units"])
+
+    distill(**kwargs)
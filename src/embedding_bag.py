@@ -0,0 +1,142 @@
+# Mark Evers
+# Created: 10/19/2026
+# embedding_bag.py
+# Keras layers that feed the index encoders into the first LSTM without multiplying out the n-hot steps
+
+import numpy as np
+from keras import backend as K
+from keras import initializers
+from keras.layers import Layer, LSTMCell
+
+
+
+class EmbeddingBag(Layer):
+    """
+    Input layer for the index encoders (MidiTrackNHotIndex, MidiTrackNHotTimeSeriesIndex).  Each step is a list of
+    feature indexes + 1 padded with 0s, the output is the sum of the embeddings of the indexes that aren't padding.
+    That's the same as multiplying the n-hot step by the embedding matrix, but only touches the rows that are active.
+
+    create_model() makes it the input kernel of the first LSTM (4 x units wide, see BagLSTMCell), so the model is the
+    n-hot model with the first matmul replaced by at most MAXIMUM_POLYPHONY row lookups per step.
+    """
+
+    def __init__(self, input_dim, output_dim, embeddings_initializer="glorot_uniform", **kwargs):
+        """
+        :param input_dim: The number of features + 1 (for the padding index).
+        :param output_dim: The width of the embeddings.
+        :param embeddings_initializer: Initializer for the embedding matrix, the LSTM kernel's by default.
+        """
+
+        super().__init__(**kwargs)
+
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.embeddings_initializer = initializers.get(embeddings_initializer)
+        self.embeddings = None
+
+
+
+    def build(self, input_shape):
+
+        self.embeddings = self.add_weight(shape=(self.input_dim, self.output_dim),
+                                          initializer=self.embeddings_initializer, name="embeddings")
+        super().build(input_shape)
+
+
+
+    def call(self, inputs):
+
+        # the windows come in as floats like every other input, only the lookup needs them as ints
+        indexes = K.cast(inputs, "int32")
+        # (batch, steps, polyphony, output_dim), with the padding zeroed out
+        embedded = K.gather(self.embeddings, indexes)
+        present = K.expand_dims(K.cast(K.greater(indexes, 0), K.floatx()))
+
+        return K.sum(embedded * present, axis=-2)
+
+
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.output_dim,)
+
+
+
+    def get_config(self):
+
+        config = {"input_dim": self.input_dim,
+                  "output_dim": self.output_dim,
+                  "embeddings_initializer": initializers.serialize(self.embeddings_initializer)}
+        base_config = super().get_config()
+
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+
+class BagLSTMCell(LSTMCell):
+    """
+    An LSTMCell whose inputs have already been through its input kernel: an EmbeddingBag with output_dim = 4 * units
+    is the kernel.  Everything else (the gates, activations, recurrent kernel and bias) is keras' LSTMCell, so
+    RNN(BagLSTMCell(units)) after the bag computes exactly what LSTM(units) does on the n-hot steps.  Dropout on the
+    inputs isn't supported, create_model() uses Dropout layers between the LSTMs instead.
+    """
+
+    def build(self, input_shape):
+
+        if input_shape[-1] != 4 * self.units:
+            raise ValueError("BagLSTMCell needs inputs 4 * units = {} wide, not {}".format(4 * self.units,
+                                                                                           input_shape[-1]))
+
+        self.recurrent_kernel = self.add_weight(shape=(self.units, self.units * 4), name="recurrent_kernel",
+                                                initializer=self.recurrent_initializer,
+                                                regularizer=self.recurrent_regularizer,
+                                                constraint=self.recurrent_constraint)
+
+        self.bias = None
+        if self.use_bias:
+            if self.unit_forget_bias:
+                def forget_bias_initializer(_, *args, **kwargs):
+                    return K.concatenate([self.bias_initializer((self.units,), *args, **kwargs),
+                                          initializers.Ones()((self.units,), *args, **kwargs),
+                                          self.bias_initializer((self.units * 2,), *args, **kwargs)])
+                bias_initializer = forget_bias_initializer
+            else:
+                bias_initializer = self.bias_initializer
+            self.bias = self.add_weight(shape=(self.units * 4,), name="bias", initializer=bias_initializer,
+                                        regularizer=self.bias_regularizer, constraint=self.bias_constraint)
+
+        self.built = True
+
+
+
+    def call(self, inputs, states, training=None):
+
+        h_tm1, c_tm1 = states[0], states[1]
+
+        z = inputs + K.dot(h_tm1, self.recurrent_kernel)
+        if self.use_bias:
+            z = K.bias_add(z, self.bias)
+
+        i = self.recurrent_activation(z[:, :self.units])
+        f = self.recurrent_activation(z[:, self.units:2 * self.units])
+        c = f * c_tm1 + i * self.activation(z[:, 2 * self.units:3 * self.units])
+        o = self.recurrent_activation(z[:, 3 * self.units:])
+        h = o * self.activation(c)
+
+        return h, [h, c]
+
+
+
+def bag_weights(dense_weights):
+    """
+    Converts the weights of an n-hot model from create_model() to the same model for the index encoders: the first
+    LSTM's kernel becomes the bag's embeddings, under a row of zeros for the padding index.  Both models give the same
+    predictions for the same files.
+
+    :param dense_weights: model.get_weights() of the n-hot model.
+    :return: The weights for set_weights() of the index model
+    """
+
+    kernel = dense_weights[0]
+    embeddings = np.concatenate([np.zeros((1, kernel.shape[1]), dtype=kernel.dtype), kernel])
+
+    return [embeddings] + list(dense_weights[1:])
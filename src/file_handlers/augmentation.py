@@ -0,0 +1,148 @@
+# Mark Evers
+# Created: 10/19/2026
+# augmentation.py
+# Random transposition of already encoded windows, so the model sees every piece in more than one key
+
+import numpy as np
+
+from src.globals import *
+from src.file_handlers.bucketing import bucket_batches
+
+
+
+# the first 128 features of the n-hot encoders are MIDI notes, the index encoders store them as note + 1
+N_PITCHES = 128
+
+
+
+def note_range(X, max_polyphony=None):
+    """
+    Gets the lowest and highest note of each window.
+
+    :param X: Windows from an n-hot encoder, or from an index encoder if max_polyphony is set.
+    :param max_polyphony: The dataset's max_polyphony.
+    :return: Two numpy arrays of MIDI notes, -1 where a window has no notes
+    """
+
+    if max_polyphony:
+        notes = X.astype(np.int16) - 1
+        is_note = (notes >= 0) & (notes < N_PITCHES)
+        lowest = np.where(is_note, notes, N_PITCHES).min(axis=(1, 2))
+        highest = np.where(is_note, notes, -1).max(axis=(1, 2))
+    else:
+        present = X[:, :, :N_PITCHES].any(axis=1)
+        lowest = present.argmax(axis=1)
+        highest = np.where(present.any(axis=1), N_PITCHES - 1 - present[:, ::-1].argmax(axis=1), -1)
+
+    return np.where(highest < 0, -1, lowest), highest
+
+
+
+def transpose_intervals(X, drums, random_state, max_shift=AUGMENT_MAX_SHIFT, max_polyphony=None):
+    """
+    Draws an interval for each window between -max_shift and max_shift semitones.  Each one is clipped so none of its
+    window's notes leave the MIDI range, and windows from drum tracks (whose notes are instruments) or without notes
+    get 0.
+
+    :param X: The windows.
+    :param drums: Whether each window is from a drum track.
+    :param random_state: A numpy RandomState.
+    :param max_shift: The largest shift, 6 reaches every key from C.
+    :param max_polyphony: The dataset's max_polyphony.
+    :return: A numpy array of intervals
+    """
+
+    lowest, highest = note_range(X, max_polyphony)
+    intervals = random_state.randint(-max_shift, max_shift + 1, size=X.shape[0])
+    intervals = np.clip(intervals, -lowest, N_PITCHES - 1 - highest)
+    intervals[np.asarray(drums, dtype=bool) | (highest < 0)] = 0
+
+    return intervals
+
+
+
+def transpose_windows(X, intervals, max_polyphony=None):
+    """
+    Shifts the notes of each window by its interval.  Durations and track markers stay where they are.
+
+    :param X: The windows.
+    :param intervals: One interval per window, from transpose_intervals() so no note falls off the range.
+    :param max_polyphony: The dataset's max_polyphony.
+    :return: A transposed copy of X
+    """
+
+    intervals = np.asarray(intervals)
+
+    if max_polyphony:
+        # the notes keep their order, so each step stays sorted highest first
+        is_note = (X >= 1) & (X <= N_PITCHES)
+        return np.where(is_note, X + intervals[:, None, None], X).astype(X.dtype)
+
+    # the note in column c comes from column c - interval
+    source = np.arange(N_PITCHES) - intervals[:, None]
+    in_range = (source >= 0) & (source < N_PITCHES)
+    notes = np.take_along_axis(X[:, :, :N_PITCHES], np.clip(source, 0, N_PITCHES - 1)[:, None, :], axis=2)
+
+    result = np.array(X)
+    result[:, :, :N_PITCHES] = notes * in_range[:, None, :]
+
+    return result
+
+
+
+def augment_batch(X, drums, random_state, max_shift=AUGMENT_MAX_SHIFT, max_polyphony=None):
+    """
+    Randomly transposes a batch, see transpose_intervals().
+
+    :param X: The batch.
+    :param drums: Whether each window is from a drum track.
+    :param random_state: A numpy RandomState.
+    :param max_shift: The largest shift.
+    :param max_polyphony: The dataset's max_polyphony.
+    :return: A transposed copy of X
+    """
+
+    return transpose_windows(X, transpose_intervals(X, drums, random_state, max_shift, max_polyphony), max_polyphony)
+
+
+
+def augmented_generator(X, y, drums, lengths=None, batch_size=BATCH_SIZE, seed=0, first_epoch=0,
+                        max_shift=AUGMENT_MAX_SHIFT, max_polyphony=None):
+    """
+    Endless generator of randomly transposed batches for model.fit_generator().  Every epoch the windows are shuffled
+    and each one gets a new interval, both drawn from RandomState([seed, epoch]), so the same seed always gives the
+    same batches and a run resumed at an epoch sees the batches it would have.
+
+    :param X: Windows of shape (n, NUM_STEPS, n_features).
+    :param y: Labels.
+    :param drums: Whether each window is from a drum track.
+    :param lengths: The true length of each window to bucket the batches like bucketing.bucketed_generator(), None to
+                    pad them all to NUM_STEPS.
+    :param batch_size: How many windows per batch.
+    :param seed: The seed the epochs' seeds come from.
+    :param first_epoch: The epoch to start at, like fit_generator()'s initial_epoch.
+    :param max_shift: The largest shift.
+    :param max_polyphony: The dataset's max_polyphony.
+    :return: A generator of (X_batch, y_batch).  ceil(len(y) / batch_size) batches make an epoch.
+    """
+
+    drums = np.asarray(drums, dtype=bool)
+    epoch = first_epoch
+
+    while True:
+
+        random_state = np.random.RandomState([seed, epoch])
+        if lengths is None:
+            order = random_state.permutation(len(y))
+            batches = [order[i:i + batch_size] for i in range(0, len(y), batch_size)]
+        else:
+            lengths = np.asarray(lengths)
+            batches = bucket_batches(lengths, batch_size, random_state)
+
+        for batch in batches:
+            X_batch = X[batch]
+            if lengths is not None:
+                X_batch = X_batch[:, :lengths[batch].max()]
+            yield augment_batch(X_batch, drums[batch], random_state, max_shift, max_polyphony), y[batch]
+
+        epoch += 1
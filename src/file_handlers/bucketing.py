@@ -0,0 +1,145 @@
+# Mark Evers
+# Created: 10/19/2026
+# bucketing.py
+# Batches windows of similar length together so the LSTM doesn't spend time on padding
+
+import numpy as np
+
+from src.globals import *
+
+
+
+def bucket_batches(lengths, batch_size=BATCH_SIZE, random_state=np.random):
+    """
+    Groups windows into batches of similar length.  Windows are sorted by length (ties broken randomly), cut into
+    batches and the order of the batches is shuffled.
+
+    :param lengths: The true length of each window.
+    :param batch_size: How many windows per batch.
+    :param random_state: A numpy RandomState (or the np.random module).
+    :return: A list of numpy arrays of window indexes, one per batch
+    """
+
+    lengths = np.asarray(lengths)
+    by_length = np.lexsort((random_state.random_sample(lengths.size), lengths))
+    batches = [by_length[i:i + batch_size] for i in range(0, lengths.size, batch_size)]
+    random_state.shuffle(batches)
+
+    return batches
+
+
+
+def bucketed_generator(X, y, lengths, batch_size=BATCH_SIZE, random_state=np.random):
+    """
+    Endless generator of length bucketed batches for model.fit_generator().  Each batch is only as long as its longest
+    window, so the model needs to accept any number of timesteps (see create_model(ragged=True)).
+
+    :param X: Windows of shape (n, NUM_STEPS, n_features), zero padded at the end.
+    :param y: Labels.
+    :param lengths: The true length of each window.
+    :param batch_size: How many windows per batch.
+    :param random_state: A numpy RandomState (or the np.random module).
+    :return: A generator of (X_batch, y_batch).  len(bucket_batches()) batches make an epoch.
+    """
+
+    lengths = np.asarray(lengths)
+
+    while True:
+        for batch in bucket_batches(lengths, batch_size, random_state):
+            max_length = lengths[batch].max()
+            yield X[batch, :max_length], y[batch]
+
+
+
+def padded_steps(lengths, batch_size=BATCH_SIZE, bucketed=False):
+    """
+    Counts the timesteps the LSTM runs over in one epoch.
+
+    :param lengths: The true length of each window.
+    :param batch_size: How many windows per batch.
+    :param bucketed: Bucketed batches padded to their own maximum, otherwise every window is padded to NUM_STEPS.
+    :return: The number of timesteps
+    """
+
+    if not bucketed:
+        return len(lengths) * NUM_STEPS
+
+    lengths = np.sort(lengths)
+    return sum(lengths[i:i + batch_size].max() * lengths[i:i + batch_size].size for i in range(0, lengths.size, batch_size))
+
+
+
+def lstm_flops_per_step(n_features, units=(665, 444, 222)):
+    """
+    Multiply-adds of one timestep through create_model()'s LSTM stack: 4 gates of (input + recurrent) x units.
+
+    :param n_features: Width of the input.
+    :param units: Units of each LSTM layer.
+    :return: Multiply-adds per timestep per window
+    """
+
+    flops = 0
+    n_inputs = n_features
+    for n_units in units:
+        flops += 4 * (n_inputs + n_units) * n_units
+        n_inputs = n_units
+
+    return flops
+
+
+
+def padding_benchmark(lengths, n_features, batch_size=BATCH_SIZE):
+    """
+    Compares how much LSTM work fixed NUM_STEPS padding and length bucketing each cost.
+
+    :param lengths: The true length of each window.
+    :param n_features: Width of the input.
+    :param batch_size: How many windows per batch.
+    :return: A dict of {strategy: timesteps}
+    """
+
+    lengths = np.asarray(lengths)
+    results = {"padded to NUM_STEPS": padded_steps(lengths, batch_size),
+               "bucketed": padded_steps(lengths, batch_size, bucketed=True),
+               "true length (no padding)": int(lengths.sum())}
+
+    flops = lstm_flops_per_step(n_features)
+    print("\nWindows:", lengths.size, " shorter than NUM_STEPS:", (lengths < NUM_STEPS).sum())
+    for strategy, steps in results.items():
+        print("{:>26}: {:>14,} steps {:>8.2f} TFLOP/epoch {:>7.1%}".format(strategy, steps, steps * flops * 2 / 1e12,
+                                                                            steps / results["padded to NUM_STEPS"]))
+
+    return results
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+    import os
+    import pandas as pd
+    from src.midi_handlers.midi_file import MidiFileNHot
+    from src.progress import ProgressReporter
+
+    base_dir = argv[1] if len(argv) > 1 else "midi/classical"
+    n_files = int(argv[2]) if len(argv) > 2 else 500
+
+    meta_df = pd.read_csv(os.path.join(base_dir, "meta.csv"), index_col="filename")
+    meta_df = meta_df[meta_df.type == 1].sample(min(n_files, (meta_df.type == 1).sum()), random_state=777)
+
+    lengths = []
+    progress = ProgressReporter("encode", meta_df.index.size)
+    for filename in meta_df.index.values:
+        try:
+            mid = MidiFileNHot(filename, meta_df.loc[filename][MUSIC_NOTES], use_cache=True)
+            mid.to_X()
+            lengths.extend(mid.window_lengths)
+            progress.update(notes=mid.n_notes, windows=len(mid.window_lengths))
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except:
+            progress.update()
+    progress.close()
+
+    padding_benchmark(lengths, 128 + len(DURATION_BINS) + 4)
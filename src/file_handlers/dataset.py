@@ -4,24 +4,48 @@
 # Functions for getting the data set
 
 import os
-import pandas as pd
 import pickle
+import tempfile
 import numpy as np
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.preprocessing import LabelEncoder, OneHotEncoder
-from sklearn.model_selection import train_test_split
 
+# pandas and sklearn are imported where they are used, so processes that only encode files don't load them
 from src.globals import *
-from src.midi_handlers.midi_file import MidiFileText, MidiTrackText, MidiFileNHot, MidiFileNHotTimeSeries
+from src.midi_handlers.midi_file import MidiFileText, MidiTrackText, MidiFileNHot, MidiFileNHotTimeSeries, MidiFileNHotIndex, \
+    MidiFileNHotTimeSeriesIndex
+from src.midi_handlers.window_policy import WindowPolicy
+from src.midi_handlers import note_cache
+from src.file_handlers.meta_index import MetaIndex
+from src.file_handlers.quarantine import Quarantine, ParseWorker, ParseLimitError
+from src.progress import ProgressReporter
+
+
+
+def count_file_windows(filename, file_converter, note_dist, window_policy=None):
+    """
+    How many windows a file has.  Made to run in a ParseWorker.
+
+    :param filename: The file.
+    :param file_converter: The MidiFile class that encodes it.
+    :param note_dist: Its distribution of MUSIC_NOTES.
+    :param window_policy: The WindowPolicy it's encoded with.
+    :return: int
+    """
+
+    return file_converter(filename, note_dist, window_policy=window_policy, use_cache=True).count_windows()
 
 
 
 class VectorGetter:
 
+    X_dtype = np.byte  # dtype of the windows
+    max_polyphony = None  # set by the index encoders, whose steps are lists of this many feature indexes
+
     def __init__(self, base_dir, file_converter):
         self.base_dir = base_dir
         self.file_converter = file_converter
+        self.window_policy = WindowPolicy()  # from the globals when the dataset is made, see get_window_policy()
         self.meta_df = None
+        self.meta_index = None
         self.composers = None
         self.n_composers = 0
         self.X_filenames = None
@@ -32,8 +56,10 @@ class VectorGetter:
         self.y_test_filenames = None
         self.last_train_chunk_i = 0
         self.last_test_chunk_i = 0
+        self.train_order = None  # the order get_chunk() reads the training files in, see shuffle_train_files()
         self.n_train_files = 0
         self.n_test_files = 0
+        self.quarantine = None
 
         self.y_label_encoder = None
         self.y_onehot_encoder = None
@@ -50,6 +76,45 @@ class VectorGetter:
 
 
 
+    def shuffle_train_files(self, random_state):
+        """
+        Shuffles the order get_chunk() reads the training files in, leaving out the validation files.  The split itself
+        doesn't change.
+
+        :param random_state: A numpy RandomState, seed it to get the same order again.
+        :return: None
+        """
+        self.train_order = random_state.permutation(self.get_n_fit_files())
+
+
+
+    def get_n_fit_files(self):
+        """
+        The training files are split again like sweep.py does: the first ones are trained on and the last
+        VALIDATION_FRACTION of them are held out to pick the epoch and tune the learning rate with, see
+        get_validation_files().  There's at least one of each when there are two training files.
+
+        :return: How many of the training files are trained on
+        """
+
+        n_validation = int(round(self.n_train_files * VALIDATION_FRACTION))
+        if VALIDATION_FRACTION and self.n_train_files > 1:
+            n_validation = min(max(n_validation, 1), self.n_train_files - 1)
+
+        return self.n_train_files - n_validation
+
+
+
+    def get_validation_files(self):
+        """
+        :return: X_validation_filenames, y_validation_filenames, the training files that aren't trained on
+        """
+
+        n_fit_files = self.get_n_fit_files()
+        return self.X_train_filenames[n_fit_files:], self.y_train_filenames[n_fit_files:]
+
+
+
 
     def get_meta_df(self, csv_file = "meta.csv"):
         """
@@ -58,12 +123,63 @@ class VectorGetter:
         :param csv_file: The name of the csv file.
         :return: A pandas dataframe with the metadate.
         """
+        import pandas as pd
         self.meta_df = pd.read_csv(os.path.join(self.base_dir, csv_file), index_col="filename")
         self.meta_df = self.meta_df[self.meta_df.type == 1]
+        # keep one file from each cluster of duplicates so the same piece can't be in both the train and test sets
+        if DROP_DUPLICATES and "duplicate_of" in self.meta_df.columns:
+            self.meta_df = self.meta_df[self.meta_df.duplicate_of.isnull()]
+        self.meta_index = MetaIndex(self.meta_df)
         return self.meta_df
 
 
 
+    def get_note_dist(self, filename):
+        """
+        Gets a file's distribution of MUSIC_NOTES from the meta index.
+
+        :param filename: The file.
+        :return: A float32 numpy array
+        """
+
+        # datasets pickled before the index existed build it the first time
+        if getattr(self, "meta_index", None) is None:
+            self.meta_index = MetaIndex(self.meta_df)
+
+        return self.meta_index.note_dist(filename)
+
+
+
+    def get_quarantine(self):
+        """
+        Gets the archive's list of files that went over the parse limits, see quarantine.py.
+
+        :return: A Quarantine
+        """
+
+        # datasets pickled before the quarantine existed make it the first time
+        if getattr(self, "quarantine", None) is None:
+            self.quarantine = Quarantine(os.path.join(self.base_dir, QUARANTINE_FILE))
+
+        return self.quarantine
+
+
+
+    def get_window_policy(self):
+        """
+        Gets the WindowPolicy the files are encoded with, the one in the globals when the dataset was made.
+
+        :return: A WindowPolicy
+        """
+
+        # datasets pickled before the policy existed kept every window
+        if getattr(self, "window_policy", None) is None:
+            self.window_policy = WindowPolicy(None, None, min_track_notes=0)
+
+        return self.window_policy
+
+
+
     def get_composers(self):
         """
         Returns a list of composers that have at least MINIMUM_WORKS pieces.
@@ -71,6 +187,9 @@ class VectorGetter:
         :return: A list of composers
         """
 
+        import pandas as pd
+        from sklearn.preprocessing import LabelEncoder, OneHotEncoder
+
         if self.base_dir.startswith("midi/classical"):
             valid_composers = ["Bach", "Beethoven", "Chopin", "Debussy", "Giuliani", "Handel", "Hays", "Hewitt", "Mozart", "Paganini", "Scarlatti", "Schubert", "Sor", "Tchaikovsky", "Thomas", "Tucker", "Vivaldi", "Webster"]
         else:
@@ -95,17 +214,22 @@ class VectorGetter:
 
         :return: <list of tracks as text>, <list of labels>
         """
+        from sklearn.model_selection import train_test_split
+
         self.X_filenames = []
         self.y_filenames = []
+        quarantine = self.get_quarantine()
 
         for composer in self.composers:
 
-            composers_works = self.meta_df[self.meta_df.composer == composer]
-            if composers_works.composer.count() > MAXIMUM_WORKS:
-                composers_works = composers_works.sample(MAXIMUM_WORKS)
+            composers_works = self.meta_index.composer_filenames(composer)
+            if len(quarantine):
+                composers_works = composers_works[[filename not in quarantine for filename in composers_works]]
+            if composers_works.size > MAXIMUM_WORKS:
+                composers_works = composers_works[np.random.choice(composers_works.size, MAXIMUM_WORKS, replace=False)]
 
-            self.X_filenames.extend(composers_works.index.values)
-            self.y_filenames.extend(composers_works.composer.values)
+            self.X_filenames.extend(composers_works)
+            self.y_filenames.extend([composer] * composers_works.size)
 
 
         self.X_train_filenames, self.X_test_filenames, self.y_train_filenames, self.y_test_filenames = train_test_split(self.X_filenames, self.y_filenames, stratify=self.y_filenames)
@@ -118,133 +242,246 @@ class VectorGetter:
 
 
 
-    def get_chunk(self, chunk_size, train_or_test):
+    def window_counts_key(self):
         """
-        Easy wrapper function to get all the docs and their labels
+        :return: Everything a file's window count depends on, see count_windows()
+        """
+        return (self.file_converter.__name__, repr(self.get_window_policy()), note_cache.cache_version(), NUM_STEPS,
+                MINIMUM_TAIL_STEPS)
 
-        :return: docs: list of docs, y: list of docs' labels, composers: list of composers, n_features: number of features
+
+
+    def count_windows(self, filenames):
+        """
+        The first pass of assemble(): how many windows each file will have.  Each count is looked up in the meta index
+        (files that have been counted before, every assemble() after the first one), otherwise counted from the note
+        cache.  Only the files that are in neither are parsed, in a ParseWorker, so without the note cache they're
+        parsed twice the first time.  The ones that go over the limits are quarantined and get no windows, so the
+        second pass skips them too.
+
+        :param filenames: The files.
+        :return: A numpy array of window counts
         """
 
-        if train_or_test == "train":
-            X_chunk_filenames = self.X_train_filenames[self.last_train_chunk_i:self.last_train_chunk_i + chunk_size]
-            y_chunk_filenames = self.y_train_filenames[self.last_train_chunk_i:self.last_train_chunk_i + chunk_size]
-        elif train_or_test == "test":
-            X_chunk_filenames = self.X_test_filenames[self.last_test_chunk_i:self.last_test_chunk_i + chunk_size]
-            y_chunk_filenames = self.y_test_filenames[self.last_test_chunk_i:self.last_test_chunk_i + chunk_size]
-        else:
-            raise ValueError("train_or_test must be either 'train' or 'test'.")
+        counts = np.zeros(len(filenames), dtype=np.int64)
+        key = self.window_counts_key()
+        # datasets pickled before the index existed build it the first time
+        if getattr(self, "meta_index", None) is None:
+            self.meta_index = MetaIndex(self.meta_df)
+        meta_index = self.meta_index
+
+        with ProgressReporter("count", len(filenames)) as progress:
+
+            to_parse = []
+            for i, filename in enumerate(filenames):
+                count = meta_index.window_count(filename, key)
+                if count is None:
+                    count = self.file_converter(filename, self.get_note_dist(filename),
+                                                window_policy=self.get_window_policy(),
+                                                use_cache=True).count_windows(parse=False)
+                if count is None:
+                    to_parse.append(i)
+                    continue
+
+                counts[i] = count
+                meta_index.set_window_count(filename, key, count)
+                progress.update(windows=count)
+
+            if to_parse:
+                with ParseWorker(self.get_quarantine()) as worker:
+                    for i in to_parse:
+                        try:
+                            counts[i] = worker.parse(count_file_windows, filenames[i], self.file_converter,
+                                                     self.get_note_dist(filenames[i]), self.get_window_policy())
+                            meta_index.set_window_count(filenames[i], key, counts[i])
+                            progress.update(windows=counts[i])
+                        except ParseLimitError as e:
+                            print("\nERROR -> Quarantined file:", e)
+                            progress.update(quarantined=1)
+
+        return counts
+
+
+
+    def window_shapes(self, n_windows):
+        """
+        :param n_windows: How many windows.
+        :return: The shapes of X and y for them and how many bytes the two take
+        """
 
-        X = []
-        y = []
+        X_shape = (n_windows, NUM_STEPS, self.max_polyphony or self.n_features)
+        y_shape = (n_windows, self.n_composers)
+        n_bytes = int(np.prod(X_shape)) * np.dtype(self.X_dtype).itemsize + int(np.prod(y_shape))
 
-        complete = 0
-        total = len(X_chunk_filenames)
-        # print("\nLoading MIDI files...")
-        progress_bar(complete, total)
+        return X_shape, y_shape, n_bytes
 
-        for filename, composer in zip(X_chunk_filenames, y_chunk_filenames):
 
-            X_file = self.file_converter(filename, self.meta_df.loc[filename][MUSIC_NOTES]).to_X()
-            X.extend(X_file)
-            y.extend([composer] * len(X_file))
 
-            complete += 1
-            if train_or_test == "train":
-                self.last_train_chunk_i += 1
-                progress_bar(self.last_train_chunk_i, self.n_train_files)
-            elif train_or_test == "test":
-                self.last_test_chunk_i += 1
-                progress_bar(self.last_test_chunk_i, self.n_test_files)
+    def allocate(self, n_windows):
+        """
+        Preallocates zeroed X and y arrays.  Over DATASET_MEMORY_BUDGET, DATASET_OVER_BUDGET decides what happens.
 
+        :param n_windows: How many windows they hold.
+        :return: X, y
+        """
 
+        X_shape, y_shape, n_bytes = self.window_shapes(n_windows)
 
-        y = self.y_label_encoder.transform(y).reshape(-1, 1)
-        y = np.array(self.y_onehot_encoder.transform(y).todense(), dtype=np.byte)
+        if DATASET_MEMORY_BUDGET is None or n_bytes <= DATASET_MEMORY_BUDGET:
+            return np.zeros(X_shape, dtype=self.X_dtype), np.zeros(y_shape, dtype=np.byte)
 
+        if DATASET_OVER_BUDGET != "memmap":
+            raise MemoryError("{} windows need {:.2f} GB, DATASET_MEMORY_BUDGET is {:.2f} GB".format(
+                n_windows, n_bytes / 2 ** 30, DATASET_MEMORY_BUDGET / 2 ** 30))
 
+        print("{} windows need {:.2f} GB, over DATASET_MEMORY_BUDGET.  Memory mapping them in {}".format(
+            n_windows, n_bytes / 2 ** 30, DATASET_MEMMAP_DIR))
+        os.makedirs(DATASET_MEMMAP_DIR, exist_ok=True)
 
-        X = np.array(X, dtype=np.byte)
-        # print(len(y), "individual tracks loaded!")
+        arrays = []
+        for shape, dtype in ((X_shape, self.X_dtype), (y_shape, np.byte)):
+            fd, filename = tempfile.mkstemp(suffix=".npy", dir=DATASET_MEMMAP_DIR)
+            os.close(fd)
+            arrays.append(np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape))
+            # the mapping outlives the name, the file goes away with the array
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
 
-        return X, y
+        return arrays
 
 
 
-    def get_all(self):
+    def assemble(self, filenames, composers, shuffle=False, stage="load", allocate=None):
+        """
+        Encodes files into preallocated arrays in two passes: count_windows() sizes them, then every file's windows are
+        written straight into their rows.  Nothing is collected in lists or copied afterwards, so the peak memory is
+        about the size of the result.
+
+        :param filenames: The files.
+        :param composers: Each file's composer.
+        :param shuffle: Write the windows in a random order (the same one get_all_split() always used) instead of
+                        shuffling them afterwards.
+        :param stage: The name to show on the progress reports.
+        :param allocate: Called with the number of windows to get the zeroed X and y to write into, allocate() if None.
+        :return: X, y, the number of windows of each file, the unpadded length of each window and whether each window is
+                 from a drum track (the last two in X's order)
+        """
 
-        print("\nLoading MIDI files...")
+        counts = self.count_windows(filenames)
+        n_windows = int(counts.sum())
+        X, y = (allocate or self.allocate)(n_windows)
+        lengths = np.zeros(n_windows, dtype=np.int64)
+        drums = np.zeros(n_windows, dtype=bool)
 
-        X = []
-        y = []
+        positions = np.arange(n_windows)
+        if shuffle:
+            # window i ends up where X[shuffled_i] would have put it
+            shuffled_i = np.arange(n_windows)
+            np.random.shuffle(shuffled_i)
+            positions = np.argsort(shuffled_i)
 
-        complete = 0
-        total = len(self.X_filenames)
-        progress_bar(complete, total)
+        labels = self.y_label_encoder.transform(composers) if len(composers) else []
+        offsets = np.concatenate(([0], np.cumsum(counts)))
 
-        for filename, composer in zip(self.X_filenames, self.y_filenames):
-            X_file = self.file_converter(filename, self.meta_df.loc[filename][MUSIC_NOTES]).to_X()
-            X.extend(X_file)
-            y.extend([composer] * len(X_file))
+        with ProgressReporter(stage, len(filenames)) as progress:
+            for i, (filename, label) in enumerate(zip(filenames, labels)):
 
-            complete += 1
-            progress_bar(complete, total)
+                if not counts[i]:
+                    # nothing to write, quarantined files included
+                    progress.update()
+                    continue
 
-        y = self.y_label_encoder.transform(y).reshape(-1, 1)
-        y = np.array(self.y_onehot_encoder.transform(y).todense(), dtype=np.byte)
-        X = np.array(X, dtype=np.byte)
-        return X, y
+                file_positions = positions[offsets[i]:offsets[i + 1]]
+                mid = self.file_converter(filename, self.get_note_dist(filename), window_policy=self.get_window_policy(),
+                                          use_cache=True)
+                n_file_windows = mid.write_X(X, file_positions)
+                if n_file_windows != counts[i]:
+                    raise ValueError("{} has {} windows, {} were counted".format(filename, n_file_windows, counts[i]))
+
+                y[file_positions, label] = 1
+                lengths[file_positions] = mid.window_lengths
+                drums[file_positions] = mid.window_drums
 
+                progress.update(notes=mid.n_notes, windows=n_file_windows)
 
+        return X, y, counts, lengths, drums
 
 
-    def get_all_split(self):
+
+    def get_chunk(self, chunk_size, train_or_test, return_drums=False):
         """
         Easy wrapper function to get all the docs and their labels
 
+        :param return_drums: Also return which windows are from drum tracks (for augmentation.transpose_windows()).
         :return: docs: list of docs, y: list of docs' labels, composers: list of composers, n_features: number of features
         """
 
-        print("\nLoading MIDI files...")
+        if train_or_test == "train":
+            # datasets pickled before train_order existed don't have it
+            train_order = getattr(self, "train_order", None)
+            if train_order is None:
+                train_order = np.arange(self.n_train_files)
+            chunk_i = train_order[self.last_train_chunk_i:self.last_train_chunk_i + chunk_size]
+            X_chunk_filenames = [self.X_train_filenames[i] for i in chunk_i]
+            y_chunk_filenames = [self.y_train_filenames[i] for i in chunk_i]
+        elif train_or_test == "test":
+            X_chunk_filenames = self.X_test_filenames[self.last_test_chunk_i:self.last_test_chunk_i + chunk_size]
+            y_chunk_filenames = self.y_test_filenames[self.last_test_chunk_i:self.last_test_chunk_i + chunk_size]
+        else:
+            raise ValueError("train_or_test must be either 'train' or 'test'.")
 
+        X, y, counts, lengths, drums = self.assemble(X_chunk_filenames, y_chunk_filenames, stage="load " + train_or_test)
 
-        X_train = []
-        X_test = []
-        y_train = []
-        y_test = []
+        if train_or_test == "train":
+            self.last_train_chunk_i += len(X_chunk_filenames)
+        elif train_or_test == "test":
+            self.last_test_chunk_i += len(X_chunk_filenames)
 
-        complete = 0
-        total = len(self.X_filenames)
-        progress_bar(complete, total)
+        if return_drums:
+            return X, y, drums
+        return X, y
 
-        for filename, composer in zip(self.X_train_filenames, self.y_train_filenames):
-            X_file = self.file_converter(filename, self.meta_df.loc[filename][MUSIC_NOTES]).to_X()
-            X_train.extend(X_file)
-            y_train.extend([composer] * len(X_file))
 
-            complete += 1
-            progress_bar(complete, total)
 
-        for filename, composer in zip(self.X_test_filenames, self.y_test_filenames):
-            X_file = self.file_converter(filename, self.meta_df.loc[filename][MUSIC_NOTES]).to_X()
-            X_test.extend(X_file)
-            y_test.extend([composer] * len(X_file))
+    def get_all(self):
+
+        print("\nLoading MIDI files...")
+
+        X, y, counts, lengths, drums = self.assemble(self.X_filenames, self.y_filenames)
+
+        return X, y
+
+
 
-            complete += 1
-            progress_bar(complete, total)
 
+    def get_all_split(self, return_lengths=False, return_drums=False, hold_out_validation=False):
+        """
+        Easy wrapper function to get all the docs and their labels
 
-        # get shuffled indexes
-        shuffled_i = np.arange(len(X_train))
-        np.random.shuffle(shuffled_i)
+        :param hold_out_validation: Leave the validation files (see get_validation_files()) out of the training windows.
+        :param return_lengths: Also return the unpadded length of each window (for bucketing.bucketed_generator()).
+        :param return_drums: Also return which windows are from drum tracks (for augmentation.transpose_windows()),
+                             after the lengths.
+        :return: docs: list of docs, y: list of docs' labels, composers: list of composers, n_features: number of features
+        """
 
-        X_train = np.array(X_train, dtype=np.byte)[shuffled_i]
-        y_train = self.y_label_encoder.transform(y_train).reshape(-1, 1)
-        y_train = np.array(self.y_onehot_encoder.transform(y_train).todense(), dtype=np.byte)[shuffled_i]
+        print("\nLoading MIDI files...")
+
+        n_fit_files = self.get_n_fit_files() if hold_out_validation else self.n_train_files
+        X_train, y_train, counts_train, lengths_train, drums_train = self.assemble(self.X_train_filenames[:n_fit_files],
+                                                                                  self.y_train_filenames[:n_fit_files],
+                                                                                  shuffle=True, stage="load train")
+        X_test, y_test, counts_test, lengths_test, drums_test = self.assemble(self.X_test_filenames, self.y_test_filenames,
+                                                                              stage="load test")
 
-        X_test = np.array(X_test, dtype=np.byte)
-        y_test = self.y_label_encoder.transform(y_test).reshape(-1, 1)
-        y_test = np.array(self.y_onehot_encoder.transform(y_test).todense(), dtype=np.byte)
-        return X_train, X_test, y_train, y_test
+        result = [X_train, X_test, y_train, y_test]
+        if return_lengths:
+            result.extend([lengths_train, lengths_test])
+        if return_drums:
+            result.extend([drums_train, drums_test])
+        return tuple(result)
 
 
 
@@ -291,22 +528,22 @@ class VectorGetterText(VectorGetter):
 
     def train_vectorizer(self):
 
+        from sklearn.feature_extraction.text import CountVectorizer
+
         print("Learning vocabulary...")
         vocab = set()
 
         df = self.meta_df[self.meta_df.composer.isin(self.composers)]
 
-        i = 0
-        total = df.index.size
-        for file in df.index.values:
-            mid = MidiFileText(file, self.meta_df)
-            text = mid.to_text()
+        with ProgressReporter("vocabulary", df.index.size) as progress:
+            for file in df.index.values:
+                mid = MidiFileText(file, self.get_note_dist(file), use_cache=True)
+                text = mid.to_text()
 
-            for track in text:
-                vocab.update(track)
+                for track in text:
+                    vocab.update(track)
 
-            i += 1
-            progress_bar(i, total)
+                progress.update(notes=mid.n_notes)
 
         vocab = list(vocab)
 
@@ -337,6 +574,33 @@ class VectorGetterNHotTimeSeries(VectorGetter):
 
 
 
+class VectorGetterNHotIndex(VectorGetter):
+    """
+    The same steps as VectorGetterNHot, stored as MAXIMUM_POLYPHONY feature indexes instead of n_features bytes.  Needs
+    a model with an EmbeddingBag input (create_model() does that for it, the bag is the first LSTM's input kernel so
+    it's the same model as the n-hot one, see bag_weights()).
+    """
+
+    X_dtype = np.uint8
+    max_polyphony = MAXIMUM_POLYPHONY
+
+    def __init__(self, base_dir="midi"):
+        super().__init__(base_dir, MidiFileNHotIndex)
+        self.n_features = 128 + len(DURATION_BINS) + 4
+
+
+
+class VectorGetterNHotTimeSeriesIndex(VectorGetter):
+
+    X_dtype = np.uint8
+    max_polyphony = MAXIMUM_POLYPHONY
+
+    def __init__(self, base_dir="midi"):
+        super().__init__(base_dir, MidiFileNHotTimeSeriesIndex)
+        self.n_features = 128 + len(DURATION_BINS) + 4
+
+
+
 
 
 if __name__ == "__main__":
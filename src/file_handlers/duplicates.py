@@ -0,0 +1,213 @@
+# Mark Evers
+# Created: 10/19/2026
+# duplicates.py
+# Finds duplicate and near duplicate MIDI files in an archive
+
+import hashlib
+import numpy as np
+
+from src.globals import *
+
+
+
+# arbitrary constants for the shingle hash and the MinHash permutations, fixed so signatures are reproducible
+_SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_random = np.random.RandomState(1337)
+# (a * x + b) with odd a is a permutation of the uint64s
+_PERMUTATIONS_A = _random.randint(0, 2 ** 62, size=(MINHASH_PERMUTATIONS, 1), dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+_PERMUTATIONS_B = _random.randint(0, 2 ** 62, size=(MINHASH_PERMUTATIONS, 1), dtype=np.int64).astype(np.uint64)
+
+
+
+def note_sequence(mid):
+    """
+    Gets every played note of a MIDI file (all tracks merged, drums skipped) on a grid of 1/32 beats so files saved with
+    a different ticks_per_beat line up.
+
+    :param mid: An smf_reader.SmfFile
+    :return: (onsets, pitches) as numpy arrays sorted by onset then pitch, with repeated (onset, pitch) pairs removed
+    """
+
+    if not mid.tracks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    events = np.concatenate([track.events for track in mid.tracks])
+    events = events[events["on"] & (events["velocity"] > 0) & (events["channel"] != 9)]
+
+    onsets = np.round(events["time"] * 32 / mid.ticks_per_beat).astype(np.int64)
+    pitches = events["note"].astype(np.int64)
+
+    # unique() sorts by onset then pitch and drops notes doubled in several tracks
+    notes = np.unique(onsets * 128 + pitches)
+
+    return notes // 128, notes % 128
+
+
+
+def exact_fingerprint(onsets, pitches):
+    """
+    Hashes a note sequence so that the same notes transposed to another key or shifted in time hash the same.
+
+    :param onsets: Note onsets from note_sequence()
+    :param pitches: Note pitches from note_sequence()
+    :return: A hex digest, None if there are no notes
+    """
+
+    if not onsets.size:
+        return None
+
+    normalized = np.stack([onsets - onsets[0], pitches - pitches[0]]).astype(np.int64)
+    return hashlib.sha1(normalized.tobytes()).hexdigest()
+
+
+
+def shingles(onsets, pitches, n=DUPLICATE_NGRAM):
+    """
+    Hashes every n-gram of (pitch interval, onset gap) pairs.  Intervals make it transposition invariant.
+
+    :param onsets: Note onsets from note_sequence()
+    :param pitches: Note pitches from note_sequence()
+    :param n: The n-gram length
+    :return: A numpy array of unique uint64 shingle hashes
+    """
+
+    if onsets.size < n + 1:
+        return np.empty(0, dtype=np.uint64)
+
+    # cap the gaps so long rests don't make every shingle unique
+    tokens = ((np.diff(pitches) + 128) * 1024 + np.clip(np.diff(onsets), 0, 1023)).astype(np.uint64)
+
+    # rolling polynomial hash over a sliding window of n tokens, overflow is fine here
+    hashes = np.zeros(tokens.size - n + 1, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for i in range(n):
+            hashes = hashes * _SHINGLE_MULTIPLIER + tokens[i:i + hashes.size]
+
+    return np.unique(hashes)
+
+
+
+def minhash_signature(shingle_hashes):
+    """
+    Computes the MinHash signature of a set of shingles.
+
+    :param shingle_hashes: The shingles from shingles()
+    :return: A numpy array of MINHASH_PERMUTATIONS uint64 values, None if there are no shingles
+    """
+
+    if not shingle_hashes.size:
+        return None
+
+    with np.errstate(over="ignore"):
+        permuted = _PERMUTATIONS_A * shingle_hashes.reshape(1, -1) + _PERMUTATIONS_B
+
+    return permuted.min(axis=1)
+
+
+
+class DuplicateIndex:
+    """
+    Collects fingerprints of MIDI files and groups exact and near duplicates into clusters.  Near duplicates are found
+    with locality sensitive hashing over MinHash signatures, then confirmed by their estimated Jaccard similarity.
+    """
+
+    def __init__(self, n_bands=MINHASH_BANDS, threshold=DUPLICATE_THRESHOLD):
+        """
+        :param n_bands: How many bands to split the MinHash signature into.  More bands finds more (weaker) candidates.
+        :param threshold: The estimated Jaccard similarity two files need to be called duplicates.
+        """
+
+        self.n_bands = n_bands
+        self.threshold = threshold
+
+        self.fingerprints = {}  # {filename: exact fingerprint}
+        self.signatures = {}  # {filename: MinHash signature}
+
+
+
+    def add(self, filename, mid):
+        """
+        Fingerprints a file.
+
+        :param filename: The file's path
+        :param mid: The file as an smf_reader.SmfFile
+        :return: None
+        """
+
+        onsets, pitches = note_sequence(mid)
+        fingerprint = exact_fingerprint(onsets, pitches)
+        if fingerprint is None:
+            return
+
+        self.fingerprints[filename] = fingerprint
+        signature = minhash_signature(shingles(onsets, pitches))
+        if signature is not None:
+            self.signatures[filename] = signature
+
+
+
+    def update(self, other):
+        """
+        Adds the fingerprints of another index, e.g. one built on another machine.
+
+        :param other: A DuplicateIndex.
+        :return: None
+        """
+
+        self.fingerprints.update(other.fingerprints)
+        self.signatures.update(other.signatures)
+
+
+
+    def clusters(self):
+        """
+        Groups the fingerprinted files into duplicate clusters.
+
+        :return: A list of clusters, each is a sorted list of 2 or more filenames
+        """
+
+        parents = {filename: filename for filename in self.fingerprints}
+
+        def find(filename):
+            while parents[filename] != filename:
+                parents[filename] = parents[parents[filename]]
+                filename = parents[filename]
+            return filename
+
+        def union(a, b):
+            a = find(a)
+            b = find(b)
+            if a != b:
+                parents[max(a, b)] = min(a, b)
+
+        # exact duplicates
+        first_seen = {}
+        for filename, fingerprint in sorted(self.fingerprints.items()):
+            if fingerprint in first_seen:
+                union(first_seen[fingerprint], filename)
+            else:
+                first_seen[fingerprint] = filename
+
+        # near duplicates: files that share any band of their signature are candidates
+        buckets = {}
+        for filename, signature in sorted(self.signatures.items()):
+            for band_i, band in enumerate(np.array_split(signature, self.n_bands)):
+                buckets.setdefault((band_i, band.tobytes()), []).append(filename)
+
+        checked = set()
+        for bucket in buckets.values():
+            for i, other in enumerate(bucket):
+                for filename in bucket[:i]:
+                    if (filename, other) in checked or find(filename) == find(other):
+                        continue
+                    checked.add((filename, other))
+
+                    similarity = (self.signatures[filename] == self.signatures[other]).mean()
+                    if similarity >= self.threshold:
+                        union(filename, other)
+
+        clusters = {}
+        for filename in parents:
+            clusters.setdefault(find(filename), []).append(filename)
+
+        return sorted(sorted(cluster) for cluster in clusters.values() if len(cluster) > 1)
@@ -0,0 +1,89 @@
+# Mark Evers
+# Created: 10/19/2026
+# meta_index.py
+# Fast per-file lookups into the meta dataframe for the data loaders
+
+import numpy as np
+
+from src.globals import *
+
+
+
+class MetaIndex:
+    """
+    The parts of the meta dataframe the loaders need for every file, in plain python and numpy so a lookup is a dict
+    access and an array index instead of a pandas .loc[] that builds a Series each time.
+    """
+
+    def __init__(self, meta_df):
+        """
+        :param meta_df: The meta dataframe, indexed by filename.
+        """
+
+        self.filenames = meta_df.index.values
+        self.rows = {filename: i for i, filename in enumerate(self.filenames)}  # {filename: row}
+        self.note_dists = np.ascontiguousarray(meta_df[MUSIC_NOTES].values, dtype=np.float32)
+        # {composer: rows of their files in meta_df order}
+        self.composer_rows = {composer: np.asarray(rows) for composer, rows in meta_df.groupby("composer").indices.items()}
+        self.window_counts = None  # how many windows each file has, -1 until counted, see VectorGetter.count_windows()
+        self.window_counts_key = None  # what the counts were made with
+
+
+
+    def window_count(self, filename, key):
+        """
+        Gets how many windows a file was counted to have.
+
+        :param filename: The file.
+        :param key: What the windows are made with.  Counts made with anything else are forgotten.
+        :return: int, None if it hasn't been counted
+        """
+
+        # indexes pickled before the counts existed start without them
+        if getattr(self, "window_counts", None) is None or self.window_counts_key != key:
+            self.window_counts = np.full(len(self.filenames), -1, dtype=np.int64)
+            self.window_counts_key = key
+
+        row = self.rows.get(filename)
+        if row is None or self.window_counts[row] < 0:
+            return None
+        return int(self.window_counts[row])
+
+
+
+    def set_window_count(self, filename, key, n_windows):
+        """
+        Records how many windows a file has, for window_count().
+
+        :param filename: The file.
+        :param key: What the windows are made with.
+        :param n_windows: How many it has.
+        :return: None
+        """
+
+        self.window_count(filename, key)
+        row = self.rows.get(filename)
+        if row is not None:
+            self.window_counts[row] = n_windows
+
+
+
+    def note_dist(self, filename):
+        """
+        Gets a file's distribution of MUSIC_NOTES.
+
+        :param filename: The file.
+        :return: A float32 numpy array (a view, don't modify it)
+        """
+        return self.note_dists[self.rows[filename]]
+
+
+
+    def composer_filenames(self, composer):
+        """
+        Gets all of a composer's files.
+
+        :param composer: The composer.
+        :return: A numpy array of filenames in meta_df order
+        """
+        return self.filenames[self.composer_rows.get(composer, np.empty(0, dtype=np.int64))]
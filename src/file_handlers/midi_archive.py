@@ -4,13 +4,15 @@
 # Functions for processing MIDI files
 
 
-import mido
 import os
-import pandas as pd
 import threading
 import numpy as np
 
 from src.globals import *
+from src.midi_handlers.smf_reader import read_midi, EVENT_DTYPE
+from src.file_handlers.duplicates import DuplicateIndex
+from src.file_handlers.quarantine import Quarantine, ParseWorker, ParseLimitError
+from src.progress import ProgressReporter
 
 
 
@@ -33,6 +35,10 @@ class MidiArchive():
         self.midi_filenames_total = 0
         self.midi_filenames_invalid = []
         self.midi_filenames_parsed = 0
+        self.midi_filenames_quarantined = []
+
+        # imported here so the processes that only use smf_meta() don't load pandas
+        import pandas as pd
 
         columns = ["composer", "type", "tracks", "ticks_per_beat", "first_key_sig", "predicted_key_sig", "first_time_n", "first_time_d", "first_time_32nd", "time_clocks_per_click", "first_note", "first_note_time", "has_note_off", "has_key_change"]
         columns.extend(MUSIC_NOTES)
@@ -40,9 +46,14 @@ class MidiArchive():
         self.meta_df = pd.DataFrame(columns=columns)
         self.meta_df.index.name = "filename"
 
+        self.duplicate_index = DuplicateIndex()
+        self.duplicate_clusters = []
+
         self.threads = []
         self.thread_lock = None
         self.stop_threads = False
+        self.progress = None
+        self.quarantine = None
 
         # self.key_sigs = set()
         # self.time_sigs = set()
@@ -64,6 +75,9 @@ class MidiArchive():
 
         for composer in os.listdir(self.base_dir):
 
+            if composer == SHARD_DIR:
+                # sharding.py's partial outputs
+                continue
 
             composer_files = []
             for root, dirs, files in os.walk(os.path.join(self.base_dir, composer)):
@@ -100,6 +114,21 @@ class MidiArchive():
 
 
 
+    def keep_filenames(self, keep):
+        """
+        Narrows the files found by get_all_filenames() down to some of them, e.g. one shard of the archive.
+
+        :param keep: Called with each filename, returns whether to keep it.
+        :return: None
+        """
+
+        kept = [(file, label) for file, label in zip(self.midi_filenames, self.midi_filenames_labels) if keep(file)]
+        self.midi_filenames = [file for file, label in kept]
+        self.midi_filenames_labels = [label for file, label in kept]
+        self.midi_filenames_total = len(self.midi_filenames)
+
+
+
     def build_meta_df(self):
         """
         Builds the meta data pandas dataframe
@@ -117,6 +146,10 @@ class MidiArchive():
         print("Loading midi files with", len(chunkified_filenames), "threads...")
         self.thread_lock = threading.Lock()
         self.stop_threads = False
+        self.progress = ProgressReporter("meta", self.midi_filenames_total)
+        self.quarantine = Quarantine(os.path.join(self.base_dir, QUARANTINE_FILE))
+        if len(self.quarantine):
+            print("Skipping files in", self.quarantine.filename)
 
         for filenames, labels in zip(chunkified_filenames, chunkified_labels):
             thread = threading.Thread(target=MidiArchive.build_meta_df_chunk,
@@ -132,8 +165,12 @@ class MidiArchive():
             self.stop_threads = True
             raise KeyboardInterrupt
 
+        finally:
+            self.progress.close()
+
         self.threads = []
         self.thread_lock = None
+        self.progress = None
 
 
         return self.meta_df
@@ -142,17 +179,27 @@ class MidiArchive():
 
     def build_meta_df_chunk(self, filenames, labels):
         """
-        Gets the metadata for a list of files.  This exists as a chunk to work with threading.
+        Gets the metadata for a list of files.  This exists as a chunk to work with threading.  Each thread parses its
+        files in its own ParseWorker, so one pathological file only holds it up for PARSE_TIMEOUT.
 
         :param filenames: list of paths to MIDI files
         :param labels: list of labels (composers) for the MIDI files
         :return: None
         """
 
-        for file, composer in zip(filenames, labels):
-            if self.stop_threads:
-                break
-            self.save_midi_meta(file, composer)
+        with ParseWorker(self.quarantine) as worker:
+            for file, composer in zip(filenames, labels):
+                if self.stop_threads:
+                    break
+
+                if file in self.quarantine:
+                    with self.thread_lock:
+                        self.midi_filenames_quarantined.append(file)
+                        self.midi_filenames_parsed += 1
+                    self.progress.update(quarantined=1)
+                    continue
+
+                self.save_midi_meta(file, composer, worker)
 
         # with self.thread_lock:
         #     print("\nThread finished!")
@@ -163,77 +210,108 @@ class MidiArchive():
     @staticmethod
     def parse_midi_meta(file, composer="unknown"):
         """
-        Adds a MIDI file's metadata to the meta_df pandas dataframe.
+        Gets a MIDI file's metadata for the meta_df pandas dataframe.
 
         :param file: path to a MIDI file
         :param composer: the label (composer) for this file
-        :return: None
+        :return: A list of values in the order of meta_df's columns
         """
 
-        key_sig = time_n = time_d = time_32nd = time_clocks_per_click = first_note = first_note_time = None
-        has_note_off = has_key_change = False
-        music_notes_before_key_change = np.zeros((12,))
-        # midi_notes_before_key_change = np.zeros((128,))
+        return MidiArchive.smf_meta(read_midi(file, FAST_MIDI_READER), composer)
 
-        time_now = 0
-        last_key_change_time = 0
-        last_key = None
 
-        mid = mido.MidiFile(file)
 
-        for msg in mid:
-            time_now += msg.time
+    @staticmethod
+    def read_midi_meta(file, composer="unknown"):
+        """
+        Reads a MIDI file and gets its metadata.  Made to run in a ParseWorker.
 
+        :param file: path to a MIDI file
+        :param composer: the label (composer) for this file
+        :return: The smf_reader.SmfFile and a list of values in the order of meta_df's columns
+        """
 
-            if msg.type == "key_signature":
-                if msg.key == last_key:
-                    continue
+        mid = read_midi(file, FAST_MIDI_READER)
 
-                # self.key_sigs.add(msg.key)
-                # if 0 < time_now - last_key_change_time < 5:
-                #     print("\nVery short key signature change ({}s) -> {}".format(time_now - last_key_change_time, mid.filename))
+        return mid, MidiArchive.smf_meta(mid, composer)
 
-                if not key_sig or not music_notes_before_key_change.sum():
-                    key_sig = msg.key
-                elif time_now - last_key_change_time != 0:  # if the time since the last key change is zero
-                    has_key_change = True
 
-                last_key_change_time = time_now
-                last_key = msg.key
 
+    @staticmethod
+    def smf_meta(mid, composer="unknown"):
+        """
+        Gets the metadata of an already read MIDI file.  Messages from all the tracks are looked at in the order mido
+        plays them: by time, then by track, then by their order in the track.
 
-            elif msg.type == "time_signature":
-                # self.time_sigs.add("{}/{}/{}/{}".format(msg.numerator, msg.denominator, msg.notated_32nd_notes_per_beat, msg.clocks_per_click))
-                if not time_n:
-                    time_n = msg.numerator
-                    time_d = msg.denominator
-                    time_32nd = msg.notated_32nd_notes_per_beat
-                    time_clocks_per_click = msg.clocks_per_click
+        :param mid: An smf_reader.SmfFile
+        :param composer: the label (composer) for this file
+        :return: A list of values in the order of meta_df's columns
+        """
 
+        key_sig = time_n = time_d = time_32nd = time_clocks_per_click = first_note = first_note_time = None
+        has_note_off = has_key_change = False
+        music_notes_before_key_change = np.zeros((12,))
 
-            elif msg.type == "note_on":
-                if not msg.velocity:
-                    continue
-                if not first_note:
-                    first_note = midi_to_music(msg.note)[0]
-                    first_note_time = msg.time
-                if not has_key_change and msg.channel != 10:  # skip channel 10 (drums)
-                    # midi_notes_before_key_change[msg.note] += 1
-                    music_notes_before_key_change[msg.note % 12] += 1
+        if mid.tracks:
+            events = np.concatenate([track.events for track in mid.tracks])
+            track_i = np.concatenate([np.full(track.events.size, track.index) for track in mid.tracks])
+        else:
+            events = np.empty(0, dtype=EVENT_DTYPE)
+            track_i = np.empty(0, dtype=np.int64)
+
+        has_note_off = bool((~events["on"]).any())
 
+        # note_on messages with velocity 0 are really note_offs
+        played = events["on"] & (events["velocity"] > 0)
+        events = events[played]
+        track_i = track_i[played]
+        in_order = np.lexsort((events["seq"], track_i, events["time"]))
+        events = events[in_order]
+        track_i = track_i[in_order]
 
-            elif msg.type == "note_off":
-                if not has_note_off:
-                    has_note_off = True
+        if events.size:
+            first_note = MUSIC_NOTES[events["note"][0] % 12]
+            first_note_time = int(events["time"][0])
 
+        def played_before(time, track, seq):
+            # how many notes were played before the message at (time, track, seq)
+            return int(((events["time"] < time) |
+                        ((events["time"] == time) & ((track_i < track) | ((track_i == track) & (events["seq"] < seq))))).sum())
+
+        # skip channel 10 (drums)
+        counted = events["channel"] != 10
+        n_counted = events.size
+
+        last_key_change_time = 0
+        last_key = None
+        for time, track, seq, key in sorted(mid.key_signatures):
+
+            if key == last_key:
+                continue
+
+            n_before = played_before(time, track, seq)
+            if not key_sig or not counted[:n_before].any():
+                key_sig = key
+            elif time - last_key_change_time != 0:  # if the time since the last key change is zero
+                has_key_change = True
+                n_counted = n_before
+                break
+
+            last_key_change_time = time
+            last_key = key
+
+        notes = events["note"][:n_counted][counted[:n_counted]]
+        music_notes_before_key_change += np.bincount(notes % 12, minlength=12)
+
+        if mid.time_signatures:
+            time, track, seq, time_n, time_d, time_32nd, time_clocks_per_click = min(mid.time_signatures)
 
 
         predicted_key_sig = MUSIC_NOTES[get_key_sig(music_notes_before_key_change)]
-        values = [composer, mid.type, len(mid.tracks), mid.ticks_per_beat, key_sig, predicted_key_sig, time_n,
+        values = [composer, mid.type, mid.n_tracks, mid.ticks_per_beat, key_sig, predicted_key_sig, time_n,
                   time_d, time_32nd, time_clocks_per_click, first_note, first_note_time, has_note_off,
                   has_key_change]
         values.extend(music_notes_before_key_change)
-        # values.extend(midi_notes_before_key_change)
 
 
         return values
@@ -241,30 +319,96 @@ class MidiArchive():
 
 
 
-    def save_midi_meta(self, file, composer):
+    def save_midi_meta(self, file, composer, worker=None):
+        """
+        Adds a file to meta_df and the duplicate index.
 
+        :param file: path to a MIDI file
+        :param composer: the label (composer) for this file
+        :param worker: The ParseWorker to read it in, None to read it in this thread without any limits.
+        :return: None
+        """
 
         try:
 
-            values = self.parse_midi_meta(file, composer)
-
-            self.meta_df.loc[file] = values
-            self.midi_filenames_parsed += 1
+            if worker is None:
+                mid, values = self.read_midi_meta(file, composer)
+            else:
+                mid, values = worker.parse(MidiArchive.read_midi_meta, file, composer)
 
             with self.thread_lock:
-                progress_bar(self.midi_filenames_parsed, self.midi_filenames_total)
+                self.meta_df.loc[file] = values
+                self.midi_filenames_parsed += 1
+            self.duplicate_index.add(file, mid)
+            self.progress.update(notes=mid.count_notes())
 
 
         except KeyboardInterrupt:
             # this is here to make it skip the next except clause
             raise KeyboardInterrupt
 
+        except ParseLimitError as e:
+            with self.thread_lock:
+                self.midi_filenames_quarantined.append(file)
+                self.midi_filenames_parsed += 1
+                print("\nERROR -> Quarantined file:", e)
+            self.progress.update(quarantined=1)
+
         except:
-            self.midi_filenames_invalid.append(file)
-            self.midi_filenames_parsed += 1
             with self.thread_lock:
+                self.midi_filenames_invalid.append(file)
+                self.midi_filenames_parsed += 1
                 print("\nERROR -> Skipping invalid file:", file)
-                progress_bar(self.midi_filenames_parsed, self.midi_filenames_total)
+            self.progress.update()
+
+
+
+
+    def find_duplicates(self):
+        """
+        Groups the files parsed by build_meta_df() into clusters of duplicates and picks one file to represent each
+        cluster.  The others get the representative's filename in the "duplicate_of" column of meta_df.
+
+        :return: A list of clusters, each is a list of filenames with the representative first
+        """
+
+        print("Looking for duplicates...")
+        self.meta_df["duplicate_of"] = None
+        self.duplicate_clusters = []
+
+        for cluster in self.duplicate_index.clusters():
+
+            # the dataset only uses type 1 files, then prefer the original over a _format0 copy, then the shortest name
+            cluster = sorted(cluster, key=lambda file: (self.meta_df.loc[file, "type"] != 1, "_format0" in file, len(file), file))
+            self.meta_df.loc[cluster[1:], "duplicate_of"] = cluster[0]
+            self.duplicate_clusters.append(cluster)
+
+        n_duplicates = sum(len(cluster) - 1 for cluster in self.duplicate_clusters)
+        print("Found", len(self.duplicate_clusters), "clusters of duplicates,", n_duplicates, "files are redundant.")
+
+        return self.duplicate_clusters
+
+
+
+
+def write_meta(archive, dir):
+    """
+    Finds the duplicates of an archive whose meta_df is built and saves meta.csv and duplicates.txt.
+
+    :param archive: The MidiArchive.
+    :param dir: Where to save them, the base directory of the archive.
+    :return: None
+    """
+
+    archive.find_duplicates()
+    with open(os.path.join(dir, "duplicates.txt"), "w") as f:
+        for cluster in archive.duplicate_clusters:
+            f.write("\n".join(cluster) + "\n\n")
+    print("Duplicate clusters saved to", os.path.join(dir, "duplicates.txt"))
+
+    print("Saving meta csv...")
+    archive.meta_df.to_csv(os.path.join(dir, "meta.csv"))
+    print("Meta CSV file saved!")
 
 
 
@@ -281,7 +425,9 @@ def build_all_meta(dir="midi", delete_invalid_files=False):
 
     archive = MidiArchive(dir)
     archive.get_all_filenames()
-    df = archive.build_meta_df()
+    archive.build_meta_df()
+    if archive.midi_filenames_quarantined:
+        print(len(archive.midi_filenames_quarantined), "files are quarantined, see", archive.quarantine.filename)
 
     if delete_invalid_files:
         for file in archive.midi_filenames_invalid:
@@ -289,10 +435,7 @@ def build_all_meta(dir="midi", delete_invalid_files=False):
             os.remove(file)
             print("Deleted corrupt file <", file, ">")
 
-
-    print("Saving meta csv...")
-    df.to_csv(os.path.join(dir, "meta.csv"))
-    print("Meta CSV file saved!")
+    write_meta(archive, dir)
 
     # info = {"key_sigs": list(archive.key_sigs), "time_sigs": list(archive.time_sigs)}
     # with open(os.path.join(dir, "info.json"), "w") as f:
@@ -0,0 +1,362 @@
+# Mark Evers
+# Created: 10/19/2026
+# quarantine.py
+# Parses MIDI files in worker processes under time and memory limits, and remembers the files that broke them
+
+import json
+import multiprocessing
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import time
+from multiprocessing.connection import Connection
+
+try:
+    import resource
+except ImportError:
+    # windows has no resource module, the memory limit is skipped there
+    resource = None
+
+from src.globals import *
+
+
+
+# The workers are fresh interpreters that run this module (see the bottom), handed their end of the pipe as a file
+# descriptor.  Forking the parent isn't safe, it's usually running threads (MidiArchive's pool, flask, tensorflow) and a
+# lock one of them held would never be released in the child.  multiprocessing's "spawn" and "forkserver" don't fork it,
+# but they import the parent's __main__ again in every worker, which is all of webapp.py and its model.  subprocess
+# execs right after the fork, so it's safe from threads, and the workers only import the parsing path (no tensorflow,
+# keras or pandas, see import_cost.py) plus the modules of the functions they're sent.  Windows can't pass the
+# descriptor, it uses "spawn".
+_spawn_context = multiprocessing.get_context("spawn") if os.name == "nt" else None
+
+# the directory src is in, for the workers' PYTHONPATH
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+
+class ParseLimitError(Exception):
+    """
+    A file went over PARSE_TIMEOUT or PARSE_MEMORY_LIMIT, or took down the worker parsing it.
+    """
+
+    def __init__(self, filename, reason, seconds, timeout, memory_limit):
+        """
+        :param filename: The file.
+        :param reason: "timeout", "memory" or "crashed".
+        :param seconds: How long it ran before it was stopped.
+        :param timeout: The worker's time limit.
+        :param memory_limit: The worker's memory limit.
+        """
+
+        super().__init__("{} {} after {:.1f}s".format(filename, reason, seconds))
+        self.filename = filename
+        self.reason = reason
+        self.seconds = seconds
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+
+
+
+class Quarantine:
+    """
+    A json lines file of the files that went over the parse limits, with the reason, how long they ran and their size.
+    A file stays quarantined until its size changes.  Each entry goes out in a single write to a file opened for
+    appending, so any number of threads and processes can add to the same list.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: The quarantine list, usually QUARANTINE_FILE in the archive's directory.
+        """
+
+        self.filename = filename
+        self.entries = {}  # filename -> its latest entry
+        self.load()
+
+
+
+    def load(self):
+        """
+        Reads the list again, entries added by other processes included.
+
+        :return: None
+        """
+
+        self.entries = {}
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # half written by a process that was killed
+                    continue
+                self.entries[entry["filename"]] = entry
+
+
+
+    def __contains__(self, filename):
+
+        entry = self.entries.get(filename)
+        if entry is None:
+            return False
+
+        try:
+            return os.path.getsize(filename) == entry["size"]
+        except OSError:
+            return True
+
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+    def add(self, error):
+        """
+        :param error: The ParseLimitError the file was stopped with.
+        :return: The new entry
+        """
+
+        try:
+            size = os.path.getsize(error.filename)
+        except OSError:
+            size = None
+
+        entry = {"filename": error.filename, "reason": error.reason, "seconds": round(error.seconds, 3), "size": size,
+                 "timeout": error.timeout, "memory_limit": error.memory_limit, "time": time.time()}
+
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + "\n").encode())
+        finally:
+            os.close(fd)
+
+        self.entries[error.filename] = entry
+
+        return entry
+
+
+
+def _limit_memory(memory_limit):
+    """
+    Caps the worker's address space at what it has now plus memory_limit, so the limit doesn't depend on what the
+    interpreter and its imports happen to take.
+
+    :param memory_limit: Bytes, None for no limit.
+    :return: None
+    """
+
+    if memory_limit is None or resource is None:
+        return
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            current = int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        current = 0
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = current + memory_limit
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+
+def _worker_loop(conn, memory_limit):
+    """
+    Runs in the worker process: calls the functions it's sent until it gets None.
+
+    :param conn: Its end of the pipe.
+    :param memory_limit: See _limit_memory().
+    :return: None
+    """
+
+    # ctrl-c is for the parent, which kills the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _limit_memory(memory_limit)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            # the parent is gone
+            break
+        if job is None:
+            break
+
+        func, args = job
+        try:
+            conn.send((True, func(*args)))
+
+        except MemoryError:
+            conn.send((False, "memory"))
+
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(repr(e))
+            conn.send((False, e))
+
+
+
+class ParseWorker:
+    """
+    A process that parses files one at a time for one thread.  A file that runs longer than the timeout gets the
+    process killed and replaced, one that allocates more than the memory limit gets a MemoryError in the worker instead
+    of the parent.  Either way the parent gets a ParseLimitError and the file goes in the quarantine list, if there is
+    one.  Errors that aren't about the limits are raised in the parent as they were raised in the worker.
+    """
+
+    def __init__(self, quarantine=None, timeout=PARSE_TIMEOUT, memory_limit=PARSE_MEMORY_LIMIT):
+        """
+        :param quarantine: A Quarantine to add the files that go over the limits to, None to only raise.
+        :param timeout: Seconds per file, None for no limit.
+        :param memory_limit: Bytes the worker can allocate on top of what it starts with, None for no limit.
+        """
+
+        self.quarantine = quarantine
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.process = None
+        self.conn = None
+
+
+
+    def start(self):
+
+        if _spawn_context is not None:
+            self.conn, child_conn = _spawn_context.Pipe()
+            self.process = _spawn_context.Process(target=_worker_loop, args=(child_conn, self.memory_limit), daemon=True)
+            self.process.start()
+            child_conn.close()
+            return
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(path for path in (_ROOT_DIR, env.get("PYTHONPATH")) if path)
+        self.process = subprocess.Popen([sys.executable, "-m", "src.file_handlers.quarantine", str(child_conn.fileno()),
+                                         str(self.memory_limit)], pass_fds=(child_conn.fileno(),), env=env,
+                                        stdin=subprocess.DEVNULL)
+        child_conn.close()
+
+
+
+    def is_alive(self):
+        """
+        :return: Whether the worker process is running
+        """
+
+        if self.process is None:
+            return False
+        if isinstance(self.process, subprocess.Popen):
+            return self.process.poll() is None
+        return self.process.is_alive()
+
+
+
+    def wait(self, timeout=None):
+
+        if isinstance(self.process, subprocess.Popen):
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                pass
+        else:
+            self.process.join(timeout)
+
+
+
+    def kill(self):
+
+        if self.process is not None:
+            self.process.kill()
+            self.wait()
+            self.conn.close()
+        self.process = None
+        self.conn = None
+
+
+
+    def close(self):
+
+        if self.is_alive():
+            try:
+                self.conn.send(None)
+                self.wait(1)
+            except OSError:
+                pass
+        self.kill()
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+    def parse(self, func, filename, *args):
+        """
+        Calls func(filename, *args) in the worker.  func and its arguments are pickled, so it has to be a module level
+        function or a static method, and so does what it returns.
+
+        :param func: The function.
+        :param filename: The file it parses.
+        :param args: The rest of its arguments.
+        :return: What func returned
+        """
+
+        if not self.is_alive():
+            self.start()
+
+        started = time.time()
+        self.conn.send((func, (filename,) + args))
+
+        reason = None
+        if not self.conn.poll(self.timeout):
+            reason = "timeout"
+        else:
+            try:
+                ok, value = self.conn.recv()
+                if ok:
+                    return value
+                if value == "memory":
+                    reason = "memory"
+            except EOFError:
+                # killed, most likely by the OOM killer if the memory limit is off
+                reason = "crashed"
+
+        seconds = time.time() - started
+        if reason is None:
+            raise value
+
+        if reason != "memory":
+            self.kill()
+        error = ParseLimitError(filename, reason, seconds, self.timeout, self.memory_limit)
+        if self.quarantine is not None:
+            self.quarantine.add(error)
+        raise error
+
+
+
+
+if __name__ == "__main__":
+
+    # a worker started by ParseWorker.start(): <pipe file descriptor> <memory limit>
+    from sys import argv
+
+    _worker_loop(Connection(int(argv[1])), None if argv[2] == "None" else int(argv[2]))
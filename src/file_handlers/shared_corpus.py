@@ -0,0 +1,313 @@
+# Mark Evers
+# Created: 10/19/2026
+# shared_corpus.py
+# Publishes an encoded dataset in shared memory so any number of worker processes can use it without copying
+
+import json
+import os
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from src.globals import *
+
+
+
+def _open_untracked(name):
+    """
+    Opens an existing shared memory block without registering it with this process' resource tracker.  A tracker
+    unlinks everything registered with it when its processes exit, and only the publisher should free the corpus.
+
+    :param name: The name of the block
+    :return: A shared_memory.SharedMemory
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track argument and always registers
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+
+def _new_block(shape, dtype):
+    """
+    Creates a shared memory block and an array over it.  New blocks are zero filled.
+
+    :param shape: The array's shape.
+    :param dtype: The array's dtype.
+    :return: The shared_memory.SharedMemory and the numpy array
+    """
+
+    dtype = np.dtype(dtype)
+    # size 0 blocks aren't allowed
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+
+class SharedCorpus:
+    """
+    The encoded windows, their one-hot labels and a per-file index living in multiprocessing.shared_memory blocks.
+    Training files come first, then test files, so the train and test sets are contiguous slices of X and y.
+
+    One process builds it with from_dataset() (or publish()) and hands manifest, a small json-able dict, to the workers,
+    which call attach().  Attached arrays are read only views of the same memory.
+    """
+
+    # arrays that get a shared memory block each
+    ARRAYS = ("X", "y", "file_offsets", "file_labels")
+
+    def __init__(self, blocks, arrays, filenames, n_train_files, owner):
+        """
+        Use publish(), from_dataset() or attach() instead.
+        """
+
+        self.blocks = blocks
+        self.arrays = arrays
+        self.filenames = filenames
+        self.n_train_files = n_train_files
+        self.owner = owner
+
+        self.X = arrays["X"]
+        self.y = arrays["y"]
+        self.file_offsets = arrays["file_offsets"]  # windows of file i are X[file_offsets[i]:file_offsets[i + 1]]
+        self.file_labels = arrays["file_labels"]  # index of each file's composer
+        self.n_train_windows = int(self.file_offsets[n_train_files])
+
+
+
+    @property
+    def manifest(self):
+        """
+        Everything a worker needs to attach().
+
+        :return: A dict that can be pickled or saved as json
+        """
+
+        return {"blocks": {key: {"name": self.blocks[key].name,
+                                 "shape": list(self.arrays[key].shape),
+                                 "dtype": self.arrays[key].dtype.str} for key in self.ARRAYS},
+                "filenames": self.filenames,
+                "n_train_files": self.n_train_files}
+
+
+
+    @classmethod
+    def publish(cls, X, y, file_offsets, file_labels, filenames, n_train_files):
+        """
+        Copies the arrays into new shared memory blocks.
+
+        :param X: The windows, training files' windows first.
+        :param y: The one-hot labels of the windows.
+        :param file_offsets: Where each file's windows start in X, plus the end of the last file.
+        :param file_labels: The label index of each file.
+        :param filenames: The filename of each file.
+        :param n_train_files: How many of the files are training files.
+        :return: A SharedCorpus that owns the memory
+        """
+
+        source = {"X": X, "y": y, "file_offsets": file_offsets, "file_labels": file_labels}
+        blocks = {}
+        arrays = {}
+
+        for key in cls.ARRAYS:
+            array = np.ascontiguousarray(source[key])
+            blocks[key], arrays[key] = _new_block(array.shape, array.dtype)
+            arrays[key][...] = array
+
+        return cls(blocks, arrays, list(filenames), n_train_files, owner=True)
+
+
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """
+        Encodes all the files of a VectorGetter and publishes them.  assemble() writes the windows straight into the
+        shared memory blocks, so the corpus is never in memory twice.  Shared memory can't be memory mapped to a file,
+        so a corpus over DATASET_MEMORY_BUDGET raises a MemoryError whatever DATASET_OVER_BUDGET says.
+
+        :param dataset: A VectorGetter
+        :return: A SharedCorpus that owns the memory
+        """
+
+        print("\nEncoding MIDI files for the shared corpus...")
+
+        filenames = list(dataset.X_train_filenames) + list(dataset.X_test_filenames)
+        composers = list(dataset.y_train_filenames) + list(dataset.y_test_filenames)
+        file_labels = np.asarray(dataset.y_label_encoder.transform(composers))
+
+        blocks = {}
+        arrays = {}
+
+        def allocate(n_windows):
+            X_shape, y_shape, n_bytes = dataset.window_shapes(n_windows)
+            if DATASET_MEMORY_BUDGET is not None and n_bytes > DATASET_MEMORY_BUDGET:
+                raise MemoryError("{} windows need {:.2f} GB of shared memory, DATASET_MEMORY_BUDGET is {:.2f} GB"
+                                  .format(n_windows, n_bytes / 2 ** 30, DATASET_MEMORY_BUDGET / 2 ** 30))
+            blocks["X"], arrays["X"] = _new_block(X_shape, dataset.X_dtype)
+            blocks["y"], arrays["y"] = _new_block(y_shape, np.byte)
+            return arrays["X"], arrays["y"]
+
+        try:
+            X, y, counts, lengths, drums = dataset.assemble(filenames, composers, stage="encode", allocate=allocate)
+
+            blocks["file_offsets"], arrays["file_offsets"] = _new_block((len(counts) + 1,), np.int64)
+            arrays["file_offsets"][0] = 0
+            np.cumsum(counts, out=arrays["file_offsets"][1:])
+            blocks["file_labels"], arrays["file_labels"] = _new_block(file_labels.shape, file_labels.dtype)
+            arrays["file_labels"][...] = file_labels
+        except BaseException:
+            # don't leave half a corpus in shared memory.  The traceback can still hold views of X and y, so the blocks
+            # are only unlinked here and unmapped when those go
+            for block in blocks.values():
+                block.unlink()
+            raise
+
+        return cls(blocks, arrays, filenames, len(dataset.X_train_filenames), owner=True)
+
+
+
+    @classmethod
+    def attach(cls, manifest):
+        """
+        Attaches to a corpus published by another process.  Nothing is copied.
+
+        :param manifest: The publisher's manifest.
+        :return: A read only SharedCorpus
+        """
+
+        blocks = {}
+        arrays = {}
+
+        for key in cls.ARRAYS:
+            info = manifest["blocks"][key]
+            blocks[key] = _open_untracked(info["name"])
+
+            arrays[key] = np.ndarray(tuple(info["shape"]), dtype=np.dtype(info["dtype"]), buffer=blocks[key].buf)
+            arrays[key].flags.writeable = False
+
+        return cls(blocks, arrays, manifest["filenames"], manifest["n_train_files"], owner=False)
+
+
+
+    def split(self):
+        """
+        Same as VectorGetter.get_all_split() except nothing is shuffled (let model.fit() do it) or copied.
+
+        :return: X_train, X_test, y_train, y_test
+        """
+
+        return self.X[:self.n_train_windows], self.X[self.n_train_windows:], \
+               self.y[:self.n_train_windows], self.y[self.n_train_windows:]
+
+
+
+    def file_windows(self, i):
+        """
+        Gets the windows of one file.
+
+        :param i: The index of the file in filenames.
+        :return: A view of X
+        """
+
+        return self.X[self.file_offsets[i]:self.file_offsets[i + 1]]
+
+
+
+    def close(self):
+        """
+        Detaches from the shared memory.  The owner also frees it.
+
+        :return: None
+        """
+
+        # the numpy views have to go before the blocks can close
+        self.X = self.y = self.file_offsets = self.file_labels = None
+        self.arrays = {}
+
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+
+        self.blocks = {}
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+
+def save_manifest(corpus, filename):
+    """
+    Saves a corpus' manifest so workers started separately can find it.
+
+    :param corpus: A SharedCorpus
+    :param filename: Where to save the json
+    :return: None
+    """
+    with open(filename, "w") as f:
+        json.dump(corpus.manifest, f)
+
+
+
+def attach_from_file(filename):
+    """
+    Attaches to a corpus from a manifest saved by save_manifest().
+
+    :param filename: The json file
+    :return: A read only SharedCorpus
+    """
+    with open(filename, "r") as f:
+        return SharedCorpus.attach(json.load(f))
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+    import pickle
+    import signal
+    from src.file_handlers.dataset import VectorGetterNHot
+
+    if len(argv) != 2 or not os.path.isdir(argv[1]):
+        print("Usage:\n  python shared_corpus.py <archive_dir>")
+        print("Encodes the archive into shared memory and keeps it there until interrupted.  Workers attach with")
+        print("attach_from_file(\"<archive_dir>/shared_corpus.json\").")
+        exit(1)
+
+    manifest_file = os.path.join(argv[1], "shared_corpus.json")
+    dataset_pickle = os.path.join(argv[1], "dataset.pkl")
+
+    # use the same train/test split as everything else that loads dataset.pkl
+    if os.path.exists(dataset_pickle):
+        with open(dataset_pickle, "rb") as f:
+            dataset = pickle.load(f)
+    else:
+        dataset = VectorGetterNHot(argv[1])
+        with open(dataset_pickle, "wb") as f:
+            pickle.dump(dataset, f)
+
+    with SharedCorpus.from_dataset(dataset) as corpus:
+        save_manifest(corpus, manifest_file)
+        print("Published", corpus.X.shape[0], "windows (", corpus.X.nbytes // 2 ** 20, "MB ) ->", manifest_file)
+        print("Press Ctrl+C to free the shared memory.")
+
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(manifest_file)
@@ -0,0 +1,101 @@
+# Mark Evers
+# Created: 10/19/2026
+# stateful.py
+# Schedules tracks onto the batch lanes of stateful LSTMs that carry their state from one window to the next
+
+import heapq
+import numpy as np
+
+from src.globals import *
+
+
+
+def split_windows(sequence):
+    """
+    Cuts a track into back to back windows of NUM_STEPS, no overlap.  The last one is zero padded at the end.
+
+    :param sequence: A track from MidiFileBase.to_sequences(), shape (n_steps, n_features).
+    :return: A numpy array of shape (n_windows, NUM_STEPS, n_features)
+    """
+
+    n_windows = max(int(np.ceil(sequence.shape[0] / NUM_STEPS)), 1)
+    windows = np.zeros((n_windows * NUM_STEPS, sequence.shape[1]), dtype=sequence.dtype)
+    windows[:sequence.shape[0]] = sequence
+
+    return windows.reshape(n_windows, NUM_STEPS, sequence.shape[1])
+
+
+
+def stateful_batches(track_windows, batch_size=BATCH_SIZE):
+    """
+    Feeds tracks through the lanes of a fixed size batch.  Lane j of consecutive batches holds consecutive windows of
+    the same track, so a stateful model carries the track's state from window to window.  When a track runs out its
+    lane is given the next track (longest first) and has to have its state reset before the batch is run.
+
+    :param track_windows: A list of windows per track, from split_windows().
+    :param batch_size: The stateful model's batch size (number of lanes).
+    :return: A generator of (X, lane_tracks, reset_lanes).  X has shape (batch_size, NUM_STEPS, n_features),
+             lane_tracks[j] is the index in track_windows of the track in lane j (-1 for an empty lane, which is all
+             zeros) and reset_lanes are the lanes that started a new track in this batch.
+    """
+
+    if not track_windows:
+        return
+
+    order = list(np.argsort([-len(windows) for windows in track_windows], kind="stable"))
+    order.reverse()  # pop() takes the longest
+
+    lane_tracks = np.full(batch_size, -1)
+    lane_positions = np.zeros(batch_size, dtype=np.int64)
+    window_shape = track_windows[0].shape[1:]
+    window_dtype = track_windows[0].dtype
+
+    while True:
+
+        reset_lanes = []
+        for lane in range(batch_size):
+            track_i = lane_tracks[lane]
+            if track_i >= 0 and lane_positions[lane] < len(track_windows[track_i]):
+                continue
+            lane_tracks[lane] = -1
+            if order:
+                lane_tracks[lane] = order.pop()
+                lane_positions[lane] = 0
+                reset_lanes.append(lane)
+
+        if (lane_tracks < 0).all():
+            return
+
+        X = np.zeros((batch_size,) + window_shape, dtype=window_dtype)
+        for lane in np.flatnonzero(lane_tracks >= 0):
+            X[lane] = track_windows[lane_tracks[lane]][lane_positions[lane]]
+            lane_positions[lane] += 1
+
+        yield X, lane_tracks.copy(), reset_lanes
+
+
+
+def stateful_work(sequence_lengths, batch_size=BATCH_SIZE):
+    """
+    Counts the windows a stateful model runs with stateful_batches() (empty lanes included) against the overlapping
+    windows of to_X().
+
+    :param sequence_lengths: The number of steps in each track.
+    :param batch_size: The stateful model's batch size.
+    :return: (stateful windows, to_X() windows)
+    """
+
+    sequence_lengths = np.asarray(sequence_lengths)
+    n_windows = np.sort(np.maximum(np.ceil(sequence_lengths / NUM_STEPS), 1).astype(np.int64))[::-1]
+
+    # longest first onto whichever lane frees up first
+    lanes = [0] * batch_size
+    for windows in n_windows:
+        heapq.heappush(lanes, heapq.heappop(lanes) + int(windows))
+    stateful = max(lanes) * batch_size
+
+    # to_X() takes a window every NUM_STEPS plus one overlapping the boundary after each, see MidiFileBase.to_X()
+    full = sequence_lengths // NUM_STEPS
+    overlapping = int((1 + full + full - (sequence_lengths % NUM_STEPS == 0)).sum())
+
+    return stateful, overlapping
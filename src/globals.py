@@ -4,6 +4,7 @@
 # Global variables and functions
 
 from sys import stdout
+import numpy as np
 from numpy import argsort
 
 
@@ -14,10 +15,27 @@ from numpy import argsort
 MINIMUM_WORKS = 100
 # How many pieces will we use from each composer?
 MAXIMUM_WORKS = 120
+# Only use one file from each cluster of duplicates found by midi_archive.py?
+DROP_DUPLICATES = True
 
 ###### HYPER PARAMETERS
 # How many threads to use when parsing the MIDI archive?
 MIDI_ARCHIVE_NUM_THREADS = 3
+# Read MIDI files straight from their bytes instead of through mido?  Falls back to mido on anything unusual.
+FAST_MIDI_READER = True
+
+# Files are parsed in worker processes (see quarantine.py) that get this many seconds and this many bytes on top of
+# what they start with per file, None for no limit.  The files that go over are listed in QUARANTINE_FILE in the
+# archive's directory and skipped from then on.
+PARSE_TIMEOUT = 60
+PARSE_MEMORY_LIMIT = 2 * 2 ** 30
+QUARANTINE_FILE = "quarantine.jsonl"
+# How many seconds between progress reports, and a json lines file to log them to (None to only show the bar)
+PROGRESS_INTERVAL = .5
+PROGRESS_LOG = None
+# Where to cache the archive's parsed note arrays (see note_cache.py).  None turns the cache off.  Uploads and files
+# scored from outside the archive are never cached.
+NOTE_CACHE_DIR = "note_cache"
 # How many ticks per beat should each track be converted to?
 TICKS_PER_BEAT = 1024
 # The resolution of music notes
@@ -27,17 +45,145 @@ MAXIMUM_NOTE_LENGTH = TICKS_PER_BEAT * 8   # two whole notes
 # Look at the first x notes to train/classify.  MUST BE DIVISIBLE BY 2
 # NUM_STEPS = 3072
 NUM_STEPS = 64  # for n-hot sequence
+# Windows at the end of a track shorter than this many steps are dropped.  0 keeps everything.
+MINIMUM_TAIL_STEPS = 0
+# Most active features (notes, duration bins and track markers) a step keeps in the index encoders.  Steps with more
+# keep the highest ones.  12 covers 99.98% of the steps of MidiTrackNHot.
+MAXIMUM_POLYPHONY = 12
 # The number of unique features to use in the CountVectorizer.
 TEXT_MAXIMUM_FEATURES = 50000
 # How many midi files to load at once
 BATCH_FILES = 50
+# The most memory a loaded dataset may take, in bytes (None for no limit).  Over it, "refuse" raises a MemoryError
+# and "memmap" puts the arrays in files in DATASET_MEMMAP_DIR, paged in as they're used.
+DATASET_MEMORY_BUDGET = 8 * 2 ** 30
+DATASET_OVER_BUDGET = "refuse"
+DATASET_MEMMAP_DIR = "dataset_memmaps"
 # How many chunks of NUM_STEPS to load
 BATCH_SIZE = 64
 # How many epochs to train for?
 N_EPOCHS = 20
+# The fraction of the training files held out of training and scored after every epoch.  Early stopping, the learning
+# rate plateaus and the best weights go by their file accuracy, so the test files are only ever reported on.
+VALIDATION_FRACTION = .2
+# Stop once file accuracy hasn't gone up by more than EARLY_STOPPING_MIN_DELTA for this many epochs (None never stops)
+EARLY_STOPPING_PATIENCE = 4
+EARLY_STOPPING_MIN_DELTA = .001
+# Multiply the learning rate by LR_REDUCE_FACTOR after this many epochs without improvement, down to LR_MINIMUM
+LR_PLATEAU_PATIENCE = 2
+LR_REDUCE_FACTOR = .5
+LR_MINIMUM = 1e-5
+# How many of the latest epochs' weights to keep besides the best ones
+KEEP_LAST_CHECKPOINTS = 2
+# Where checkpointed_training() keeps its checkpoint, and how many batches to train between checkpoints
+CHECKPOINT_DIR = "models/checkpoint"
+CHECKPOINT_EVERY = 200
+# How many windows to give model.predict() at once when classifying many files
+PREDICT_BATCH_SIZE = 4096
 # Smallest step in a timeseries (in ticks)
 MINIMUM_TIMESERIES_STEP = MINIMUM_NOTE_LENGTH
 
+###### AUGMENTATION
+# Randomly transpose the training windows by up to AUGMENT_MAX_SHIFT semitones, a new interval every epoch (see
+# augmentation.py).  Drum tracks are left alone and no note is shifted out of the MIDI range.
+AUGMENT_TRANSPOSE = False
+AUGMENT_MAX_SHIFT = 6
+
+###### WINDOW SAMPLING
+# The most windows to_X() keeps of each file and of each track, None for no limit (see window_policy.py).  VectorGetters
+# keep the policy they were made with, so a pickled dataset trains and evaluates with the same one.
+WINDOW_MAX_PER_FILE = None
+WINDOW_MAX_PER_TRACK = None
+# "uniform" picks them at random, "stratified" picks one from each of that many equal parts of the piece
+WINDOW_SAMPLING = "stratified"
+# Tracks with fewer notes than this get no windows, unless no track has that many
+WINDOW_MIN_TRACK_NOTES = 0
+# Mixed with each filename to seed the sampling, so a file always gets the same windows
+WINDOW_SEED = 0
+
+###### DUPLICATE DETECTION
+# How many notes in each n-gram that gets hashed
+DUPLICATE_NGRAM = 8
+# Length of the MinHash signature
+MINHASH_PERMUTATIONS = 64
+# How many LSH bands the signature is split into
+MINHASH_BANDS = 16
+# Estimated Jaccard similarity at which two files are duplicates
+DUPLICATE_THRESHOLD = .8
+
+###### LIVE CLASSIFICATION
+# Tempo assumed for live input (files being replayed use their own tempo)
+LIVE_BEATS_PER_MINUTE = 120
+# Notes that start within this many ticks of a chord's first note are part of the chord
+LIVE_CHORD_TICKS = MINIMUM_NOTE_LENGTH * 2
+# How much the rolling probabilities of earlier windows are kept when a new window is scored.  1 never forgets.
+LIVE_PROBABILITY_DECAY = .9
+# How many windows can wait to be scored before new ones are dropped
+LIVE_MAXIMUM_QUEUED_WINDOWS = 16
+
+###### HYPERPARAMETER SWEEP
+# How many trials to train at once, and how many threads each one gets (None splits the cores evenly)
+SWEEP_WORKERS = 4
+SWEEP_THREADS = None
+# The fraction of the training files held out to score the trials on, the same ones the final model is tuned on.  The
+# test split is left alone.
+SWEEP_VALIDATION_FRACTION = VALIDATION_FRACTION
+# From this epoch on, a trial whose file accuracy is below the median of the other trials at the same epoch is
+# stopped, as long as at least SWEEP_MINIMUM_PEERS of them got that far
+SWEEP_GRACE_EPOCHS = 2
+SWEEP_MINIMUM_PEERS = 3
+
+###### DISTILLATION
+# The student's LSTMs and dropout.  (256, 128) runs about 7.7x fewer multiply-adds per step than the final model.
+DISTILL_UNITS = (256, 128)
+DISTILL_DROPOUT = (.3, .1)
+# The student learns DISTILL_ALPHA of the true labels and the rest of the final model's predictions, softened by
+# DISTILL_TEMPERATURE
+DISTILL_ALPHA = .1
+DISTILL_TEMPERATURE = 2
+DISTILL_EPOCHS = N_EPOCHS
+# How many test windows each model is timed on, and how many times (the fastest counts)
+DISTILL_LATENCY_WINDOWS = 1024
+DISTILL_LATENCY_REPEATS = 5
+
+###### DATA PARALLEL TRAINING
+# Where worker 0 of data_parallel.py listens for the others
+DATA_PARALLEL_HOST = "127.0.0.1"
+DATA_PARALLEL_PORT = 5252
+# The workers authenticate each other with this.  It only keeps out strays, run them on a network you trust.
+DATA_PARALLEL_AUTHKEY = b"composer-classifier"
+# How many seconds the other workers keep trying to reach worker 0
+DATA_PARALLEL_CONNECT_TIMEOUT = 120
+# The workers average their weights every DATA_PARALLEL_SYNC_STEPS batches.  1 keeps them in lockstep, like one model
+# trained on batches of workers * BATCH_SIZE windows, more spends less time on the network.
+DATA_PARALLEL_SYNC_STEPS = 1
+
+###### WEBAPP
+# The model webapp.py serves, "models/student" for the one distillation.py makes
+SERVING_MODEL = "models/final"
+# How many ParseWorkers encode uploads at once.  Each is a python process, more uploads than this wait for one.
+WEBAPP_PARSE_WORKERS = 4
+
+###### LOAD TESTING
+# Where load_test.py starts webapp.py, and how long it waits for the model to load
+LOAD_TEST_PORT = 5050
+LOAD_TEST_STARTUP_TIMEOUT = 120
+# Uploads in flight at once, for how many seconds, and how long before one counts as an error
+LOAD_TEST_CONCURRENCY = 8
+LOAD_TEST_DURATION = 60
+LOAD_TEST_REQUEST_TIMEOUT = 60
+# How many MIDI files to upload, and the fraction of them that are corrupt
+LOAD_TEST_FIXTURES = 60
+LOAD_TEST_CORRUPT_FRACTION = .1
+# Seconds between samples of the server's memory
+LOAD_TEST_RSS_INTERVAL = .5
+
+###### SHARDING
+# Where sharding.py keeps each stage's partial outputs, inside the archive's directory (it has to be on a filesystem
+# every node can see), and how many shards to split the archive into by default
+SHARD_DIR = "shards"
+SHARD_COUNT = 4
+
 
 
 ####################### CONSTANTS #######################
@@ -177,12 +323,36 @@ def bin_note_duration(duration):
     # this should never execute but just for sanity's sake
     return best_match
 
+def bin_note_durations(durations):
+    """
+    Vectorized bin_note_duration.  Rounds every duration to the closest value in DURATION_BINS, ties go to the longer
+    bin just like bin_note_duration.
+    :param durations: A numpy array of note durations in ticks
+    :return: A numpy array of binned durations in ticks
+    """
+
+    bins = np.array(DURATION_BINS)
+    best_i = np.abs(np.asarray(durations).reshape(-1, 1) - bins).argmin(axis=1)
+
+    return bins[best_i]
+
+def duration_bin_index(durations):
+    """
+    Gets the index in DURATION_BINS of already binned durations.
+    :param durations: A numpy array of durations that are members of DURATION_BINS
+    :return: A numpy array of indexes into DURATION_BINS
+    """
+
+    # DURATION_BINS is descending so search the negated list
+    return np.searchsorted(-np.array(DURATION_BINS), -np.asarray(durations))
+
 
 
 _PROGRESS_BAR_LAST_I = 100
 def progress_bar(done, total, resolution = 0, text=""):
     """
-    Prints a progress bar to stdout.
+    Prints a progress bar to stdout.  The long running stages use progress.ProgressReporter instead, which is thread
+    safe, rate limited and reports throughput.
 
     :param done: Number of items complete
     :param total: Total number if items
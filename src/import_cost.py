@@ -0,0 +1,104 @@
+# Mark Evers
+# Created: 10/19/2026
+# import_cost.py
+# Measures how long each entry point takes to import, how much memory it takes and which heavy libraries it loads
+
+import json
+import subprocess
+import sys
+
+from src.globals import *
+
+
+
+# what each kind of process imports first
+ENTRY_POINTS = [
+    ("midi parsing", "src.midi_handlers.smf_reader"),
+    ("encoding", "src.midi_handlers.midi_file"),
+    ("parse workers", "src.file_handlers.quarantine"),
+    ("meta building", "src.file_handlers.midi_archive"),
+    ("datasets", "src.file_handlers.dataset"),
+    ("batch_predict.py", "src.batch_predict"),
+    ("sharding.py", "src.sharding"),
+    ("training", "src.model_final"),
+    ("webapp.py", "webapp"),
+]
+
+# the libraries that only training and serving should pay for
+HEAVY_MODULES = ("tensorflow", "keras", "sklearn", "scipy", "pandas")
+
+# runs in a fresh interpreter, prints json
+_MEASURE = """
+import importlib, json, resource, sys, time
+started = time.perf_counter()
+error = None
+try:
+    importlib.import_module({module!r})
+except Exception as e:
+    error = "{{}}: {{}}".format(type(e).__name__, e)
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  "heavy": [name for name in {heavy!r} if name in sys.modules], "error": error}}))
+"""
+
+
+
+def measure(module, repeats=3):
+    """
+    Imports a module in fresh interpreters.
+
+    :param module: The module's name, e.g. "src.midi_handlers.midi_file".
+    :param repeats: How many times, the fastest counts (the first is usually slower while the files are read from disk).
+    :return: {"seconds", "rss" (peak bytes, interpreter included), "heavy" (the HEAVY_MODULES it loaded), "error"}
+    """
+
+    best = None
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, "-c", _MEASURE.format(module=module, heavy=HEAVY_MODULES)],
+                                stdout=subprocess.PIPE, check=True).stdout
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+
+    return best
+
+
+
+def report(entry_points=ENTRY_POINTS, repeats=3):
+    """
+    Measures every entry point next to a bare interpreter with numpy.
+
+    :param entry_points: A list of (name, module).
+    :param repeats: See measure().
+    :return: {name: measure()}
+    """
+
+    results = {"numpy only": measure("numpy", repeats)}
+    for name, module in entry_points:
+        results[name] = measure(module, repeats)
+
+    print("\n{:>18}  {:>9}  {:>8}  {}".format("entry point", "import s", "RSS MB", "heavy modules loaded"))
+    for name, result in results.items():
+        heavy = ", ".join(result["heavy"]) or "-"
+        if result["error"]:
+            heavy += "  (failed: {})".format(result["error"])
+        print("{:>18}  {:>9.3f}  {:>8.1f}  {}".format(name, result["seconds"], result["rss"] / 2 ** 20, heavy))
+
+    return results
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+
+    repeats = 3
+    for arg in argv[1:]:
+        if arg.startswith("--repeats="):
+            repeats = int(arg.split("=", 1)[1])
+        else:
+            print("Usage:\n  python import_cost.py [--repeats=3]")
+            exit(1)
+
+    report(repeats=repeats)
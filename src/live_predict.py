@@ -0,0 +1,252 @@
+# Mark Evers
+# Created: 10/19/2026
+# live_predict.py
+# Classifies MIDI as it is being played, from a MIDI input port or a file replayed at tempo
+
+import queue
+import threading
+import time
+import numpy as np
+import mido
+
+from src.globals import *
+from src.midi_handlers.midi_stream import MidiStream
+
+
+
+def replay_file(filename, speed=1.):
+    """
+    Plays a MIDI file back as if it was coming in live.  Stands in for an input port when there is no keyboard around.
+
+    :param filename: Path to the MIDI file.
+    :param speed: How much faster than the file's tempo to play it.  0 doesn't wait at all.
+    :return: A generator of (message, seconds since the start).  set_tempo meta messages are included so the stream can
+             follow the file's tempo.
+    """
+
+    start = time.perf_counter()
+    seconds = 0.
+
+    for message in mido.MidiFile(filename):
+        seconds += message.time
+        if speed:
+            wait = start + seconds / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+        if not message.is_meta or message.type == "set_tempo":
+            yield message, seconds
+
+
+
+def port_messages(port_name=None, poll_interval=.005):
+    """
+    Reads a MIDI input port.  Polls instead of blocking, so the stream's clock keeps moving during rests and finished
+    chords still get scored.
+
+    :param port_name: The port to open, mido's default input if None.
+    :param poll_interval: How long to sleep when nothing is waiting, in seconds.
+    :return: A generator of (message or None, seconds).  None just means time went by.
+    """
+
+    start = time.perf_counter()
+
+    with mido.open_input(port_name) as port:
+        while True:
+            got_one = False
+            for message in port.iter_pending():
+                got_one = True
+                yield message, time.perf_counter() - start
+            if not got_one:
+                yield None, time.perf_counter() - start
+                time.sleep(poll_interval)
+
+
+
+class LiveClassifier:
+    """
+    Feeds messages to a MidiStream and scores its windows on a separate thread, so a slow model.predict() never holds
+    up the messages.  The estimate is a decaying sum of the window probabilities: every new window multiplies the sum
+    by LIVE_PROBABILITY_DECAY before it's added.  If the model falls behind by more than LIVE_MAXIMUM_QUEUED_WINDOWS
+    windows, new windows are dropped instead of queued.
+    """
+
+    def __init__(self, _model, composers, beats_per_minute=LIVE_BEATS_PER_MINUTE, decay=LIVE_PROBABILITY_DECAY,
+                 on_update=None):
+        """
+        :param _model: The model.
+        :param composers: The composer of each of the model's outputs.
+        :param beats_per_minute: The tempo of the input.
+        :param decay: How much of the earlier windows' probabilities to keep with each new window.
+        :param on_update: Called with the LiveClassifier (from the scoring thread) every time a window is scored.
+        """
+
+        # tensorflow is only needed once there's a model to run
+        import tensorflow as tf
+
+        self.model = _model
+        # keras' TF graph is the default graph of the thread that loaded the model, the scoring thread has to use it too
+        # (same as webapp.py)
+        self.graph = tf.get_default_graph()
+        self.composers = composers
+        self.decay = decay
+        self.on_update = on_update
+
+        self.stream = MidiStream(beats_per_minute)
+        self.windows = queue.Queue(maxsize=LIVE_MAXIMUM_QUEUED_WINDOWS)
+        self.lock = threading.Lock()
+
+        self.sum_probs = np.zeros(len(composers))
+        self.n_scored = 0
+        self.n_dropped = 0
+        self.n_messages = 0
+        self.feed_seconds = 0.  # time spent in feed(), to keep an eye on the per message latency
+        self.max_feed_seconds = 0.
+
+        self.scorer = threading.Thread(target=self.score_windows, daemon=True)
+        self.scorer.start()
+
+
+
+    def feed(self, message, seconds):
+        """
+        Handles one incoming message.
+
+        :param message: A mido message, or None if only time went by.
+        :param seconds: When it arrived.
+        :return: None
+        """
+
+        started = time.perf_counter()
+
+        if message is None:
+            windows = self.stream.advance(seconds)
+        elif message.type == "set_tempo":
+            windows = self.stream.advance(seconds)
+            self.stream.set_tempo(mido.tempo2bpm(message.tempo))
+        else:
+            windows = self.stream.feed(message, seconds)
+
+        self.queue_windows(windows)
+
+        took = time.perf_counter() - started
+        self.n_messages += 1
+        self.feed_seconds += took
+        self.max_feed_seconds = max(self.max_feed_seconds, took)
+
+
+
+    def queue_windows(self, windows):
+
+        for channel, window in windows:
+            try:
+                self.windows.put_nowait(window)
+            except queue.Full:
+                self.n_dropped += 1
+
+
+
+    def score_windows(self):
+        """
+        The scoring thread.  Runs until a None comes out of the queue.
+
+        :return: None
+        """
+
+        while True:
+            window = self.windows.get()
+            if window is None:
+                return
+
+            with self.graph.as_default():
+                y_pred = self.model.predict(window[np.newaxis], batch_size=1)[0]
+
+            with self.lock:
+                self.sum_probs = self.sum_probs * self.decay + y_pred
+                self.n_scored += 1
+
+            if self.on_update:
+                self.on_update(self)
+
+
+
+    def probabilities(self):
+        """
+        :return: The current estimate, normed probabilities per composer (all zeros until a window has been scored).
+        """
+
+        with self.lock:
+            total = self.sum_probs.sum()
+            return self.sum_probs / total if total else self.sum_probs.copy()
+
+
+
+    def prediction(self):
+        """
+        :return: The most likely composer so far, None until a window has been scored.
+        """
+        return self.composers[int(np.argmax(self.probabilities()))] if self.n_scored else None
+
+
+
+    def close(self):
+        """
+        Scores what's left of the tracks and waits for the scoring thread to finish.
+
+        :return: The final probabilities
+        """
+
+        for channel, window in self.stream.close():
+            self.windows.put(window)
+        self.windows.put(None)
+        self.scorer.join()
+
+        return self.probabilities()
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+    from src.model_final import load_from_disk
+    from src.file_handlers.dataset import VectorGetterNHot
+
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    port_name = None
+    speed = 1.
+    use_port = False
+    for arg in argv[1:]:
+        if arg.startswith("--port"):
+            use_port = True
+            if "=" in arg:
+                port_name = arg.split("=", 1)[1]
+        elif arg.startswith("--speed="):
+            speed = float(arg.split("=", 1)[1])
+
+    if not use_port and len(args) != 1:
+        print("Usage:\n  python live_predict.py --port[=<input port name>]\n  python live_predict.py [--speed=N] <midi_file>")
+        print("Input ports:", ", ".join(mido.get_input_names()) or "none")
+        exit(1)
+
+    composers = VectorGetterNHot("midi/classical").composers
+    model = load_from_disk("models/final")
+
+    def show(classifier):
+        probs = classifier.probabilities()
+        top = np.argsort(probs)[::-1][:3]
+        print("\r" + "  ".join("{}: {:.0%}".format(composers[i], probs[i]) for i in top),
+              "({} windows, {:.0f}us/message)".format(classifier.n_scored, classifier.feed_seconds / classifier.n_messages * 1e6).ljust(30), end="")
+
+    classifier = LiveClassifier(model, composers, on_update=show)
+    messages = port_messages(port_name) if use_port else replay_file(args[0], speed)
+
+    try:
+        for message, seconds in messages:
+            classifier.feed(message, seconds)
+    except KeyboardInterrupt:
+        pass
+
+    classifier.close()
+    print("\nPrediction:", classifier.prediction(), "  dropped windows:", classifier.n_dropped,
+          "  worst message: {:.0f}us".format(classifier.max_feed_seconds * 1e6))
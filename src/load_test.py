@@ -0,0 +1,459 @@
+# Mark Evers
+# Created: 10/19/2026
+# load_test.py
+# Replays MIDI uploads against the webapp and reports latency, errors and the server's memory
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import numpy as np
+import pandas as pd
+
+from src.globals import *
+
+
+
+# a response with this in it is the webapp's corrupt.html
+CORRUPT_PAGE_MARKER = b"Corrupt MIDI file!"
+
+
+
+def make_fixtures(archive_dir="midi/classical", n_files=LOAD_TEST_FIXTURES, corrupt_fraction=LOAD_TEST_CORRUPT_FRACTION,
+                  seed=0):
+    """
+    Picks MIDI files of mixed sizes from an archive and makes some corrupt ones.  The valid files are split evenly
+    between the smallest, middle and largest thirds of the archive.
+
+    :param archive_dir: The archive with meta.csv.
+    :param n_files: How many fixtures in all.
+    :param corrupt_fraction: How many of them are corrupt.
+    :param seed: For the same fixtures again.
+    :return: A list of (name, kind, bytes).  kind is small, medium, large or corrupt.
+    """
+
+    random_state = np.random.RandomState(seed)
+    meta_df = pd.read_csv(os.path.join(archive_dir, "meta.csv"), index_col="filename")
+    filenames = [filename for filename in meta_df.index[meta_df.type == 1] if os.path.exists(filename)]
+    filenames.sort(key=os.path.getsize)
+
+    n_corrupt = int(round(n_files * corrupt_fraction))
+    n_valid = n_files - n_corrupt
+    fixtures = []
+
+    for kind, sizes in zip(("small", "medium", "large"), np.array_split(np.array(filenames), 3)):
+        for filename in random_state.choice(sizes, min(int(np.ceil(n_valid / 3)), sizes.size), replace=False):
+            with open(filename, "rb") as f:
+                fixtures.append((os.path.basename(filename), kind, f.read()))
+    fixtures = fixtures[:n_valid]
+
+    # broken in the ways uploads tend to be: cut off, empty, not MIDI at all, or a header with garbage after it
+    for i in range(n_corrupt):
+        source = fixtures[i % len(fixtures)][2] if fixtures else b""
+        damage = i % 4
+        if damage == 0:
+            data = source[:len(source) // 2]
+        elif damage == 1:
+            data = b""
+        elif damage == 2:
+            data = random_state.bytes(random_state.randint(1, 1 << 16))
+        else:
+            data = source[:14] + random_state.bytes(random_state.randint(1, 1 << 16))
+        fixtures.append(("corrupt_{}.mid".format(i), "corrupt", data))
+
+    return fixtures
+
+
+
+def encode_upload(filename, data):
+    """
+    Builds the multipart/form-data body of the upload form.
+
+    :param filename: The uploaded file's name.
+    :param data: Its contents.
+    :return: (body, content type)
+    """
+
+    boundary = uuid.uuid4().hex
+    body = b"".join((b"--", boundary.encode(), b"\r\n",
+                     b'Content-Disposition: form-data; name="file"; filename="', filename.encode(), b'"\r\n',
+                     b"Content-Type: audio/midi\r\n\r\n", data, b"\r\n",
+                     b"--", boundary.encode(), b"--\r\n"))
+
+    return body, "multipart/form-data; boundary=" + boundary
+
+
+
+def process_rss(pid):
+    """
+    :param pid: A process.
+    :return: Its resident memory in bytes, None if it's gone
+    """
+
+    try:
+        with open("/proc/{}/status".format(pid), "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # no /proc (macOS)
+    try:
+        return int(subprocess.check_output(["ps", "-o", "rss=", "-p", str(pid)])) * 1024
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+
+def child_pids(pid):
+    """
+    :param pid: A process.
+    :return: The pids of its children, their children and so on
+    """
+
+    children = []
+    try:
+        for task in os.listdir("/proc/{}/task".format(pid)):
+            with open("/proc/{}/task/{}/children".format(pid, task), "r") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        # no /proc (macOS), or it's gone
+        try:
+            children = [int(child) for child in subprocess.check_output(["pgrep", "-P", str(pid)]).split()]
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            children = []
+
+    return children + [grandchild for child in children for grandchild in child_pids(child)]
+
+
+
+def server_rss(pid):
+    """
+    Uploads are parsed in ParseWorker processes the server starts, so their memory counts as the server's.
+
+    :param pid: The server's process.
+    :return: The resident memory of it and all its child processes in bytes, None if it's gone
+    """
+
+    rss = process_rss(pid)
+    if rss is None:
+        return None
+
+    # children that exit between listing and reading them count as 0
+    return rss + sum(process_rss(child) or 0 for child in child_pids(pid))
+
+
+
+def start_server(port, timeout=LOAD_TEST_STARTUP_TIMEOUT):
+    """
+    Starts webapp.py on localhost and waits until it answers.
+
+    :param port: The port to serve on.
+    :param timeout: How long to wait for it, the model takes a while to load.
+    :return: (the server's Popen, its url)
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # webapp.py saves uploads here but doesn't make it
+    os.makedirs(os.path.join(root, "temp_midi_uploads"), exist_ok=True)
+
+    server = subprocess.Popen([sys.executable, "-c",
+                               "import webapp; webapp.app.run(host='127.0.0.1', port={}, debug=False)".format(port)],
+                              cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = "http://127.0.0.1:{}".format(port)
+
+    started = time.time()
+    while time.time() - started < timeout:
+        if server.poll() is not None:
+            raise RuntimeError("webapp.py exited with code {}".format(server.returncode))
+        try:
+            urllib.request.urlopen(url + "/", timeout=1).read()
+            return server, url
+        except (urllib.error.URLError, OSError):
+            time.sleep(.25)
+
+    server.kill()
+    raise RuntimeError("webapp.py didn't answer within {} seconds".format(timeout))
+
+
+
+class LoadTest:
+    """
+    Uploads fixtures to /midi.html from `concurrency` threads for `duration` seconds.
+
+    Without a rate every thread sends its next upload as soon as the last one comes back (closed loop, finds the
+    maximum throughput).  With a rate the uploads are scheduled rate times a second and the latency is measured from
+    when each was due, not when a thread got around to it, so a server that falls behind shows it in the percentiles.
+    """
+
+    def __init__(self, url, fixtures, concurrency=LOAD_TEST_CONCURRENCY, rate=None, duration=LOAD_TEST_DURATION,
+                 timeout=LOAD_TEST_REQUEST_TIMEOUT, server_pid=None, seed=0):
+        """
+        :param url: The webapp's base url.
+        :param fixtures: From make_fixtures().
+        :param concurrency: How many uploads can be in flight.
+        :param rate: Uploads per second, None for as fast as they come back.
+        :param duration: How many seconds to send uploads for.
+        :param timeout: Seconds before an upload counts as an error.
+        :param server_pid: The server's process, to sample its memory.  None skips that.
+        :param seed: For the same order of fixtures again.
+        """
+
+        self.url = url + "/midi.html"
+        self.fixtures = fixtures
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.timeout = timeout
+        self.server_pid = server_pid
+        self.order = np.random.RandomState(seed)
+
+        self.lock = threading.Lock()
+        self.n_sent = 0
+        self.requests = []  # one dict per upload
+        self.rss = []  # (seconds, bytes)
+        self.start = None
+        self.done = threading.Event()
+
+
+
+    def next_request(self):
+        """
+        :return: (request number, fixture, when it's due) or None when the test is over
+        """
+
+        with self.lock:
+            i = self.n_sent
+            self.n_sent += 1
+            fixture = self.fixtures[self.order.randint(len(self.fixtures))]
+
+        if self.rate:
+            due = self.start + i / self.rate
+        else:
+            due = time.perf_counter()
+
+        if due - self.start >= self.duration:
+            return None
+
+        return i, fixture, due
+
+
+
+    def send(self, fixture):
+        """
+        Uploads one fixture.  Every upload gets its own name, the webapp keeps uploads in one folder by name.
+
+        :param fixture: (name, kind, bytes)
+        :return: (status code or None, outcome).  outcome is predicted, corrupt or error.
+        """
+
+        name, kind, data = fixture
+        body, content_type = encode_upload(uuid.uuid4().hex[:8] + "_" + name.replace('"', ""), data)
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": content_type})
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                page = response.read()
+                return response.status, "corrupt" if CORRUPT_PAGE_MARKER in page else "predicted"
+        except urllib.error.HTTPError as e:
+            return e.code, "error"
+        except (urllib.error.URLError, OSError):
+            return None, "error"
+
+
+
+    def worker(self):
+
+        while True:
+            next_request = self.next_request()
+            if next_request is None:
+                return
+            i, fixture, due = next_request
+
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+            sent = time.perf_counter()
+            status, outcome = self.send(fixture)
+            finished = time.perf_counter()
+
+            expected = "corrupt" if fixture[1] == "corrupt" else "predicted"
+            with self.lock:
+                self.requests.append({"i": i, "fixture": fixture[0], "kind": fixture[1], "bytes": len(fixture[2]),
+                                      "due": due - self.start, "latency": finished - due,
+                                      "service": finished - sent, "status": status, "outcome": outcome,
+                                      "wrong": outcome != "error" and outcome != expected})
+
+
+
+    def sample_rss(self):
+
+        while not self.done.is_set():
+            rss = server_rss(self.server_pid)
+            if rss is not None:
+                self.rss.append((time.perf_counter() - self.start, rss))
+            self.done.wait(LOAD_TEST_RSS_INTERVAL)
+
+
+
+    def run(self):
+        """
+        :return: The report, see report()
+        """
+
+        self.start = time.perf_counter()
+
+        sampler = None
+        if self.server_pid:
+            sampler = threading.Thread(target=self.sample_rss, daemon=True)
+            sampler.start()
+
+        workers = [threading.Thread(target=self.worker, daemon=True) for i in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.done.set()
+        if sampler:
+            sampler.join()
+
+        return self.report(time.perf_counter() - self.start)
+
+
+
+    def report(self, elapsed):
+        """
+        :param elapsed: How long the test took.
+        :return: A json-able dict with the summary overall and per kind of fixture, the memory samples and every upload
+        """
+
+        def summarize(requests):
+            if not requests:
+                return {"requests": 0}
+            latencies = np.array([r["latency"] for r in requests])
+            errors = sum(r["outcome"] == "error" for r in requests)
+            return {"requests": len(requests),
+                    "per_second": len(requests) / elapsed,
+                    "p50": float(np.percentile(latencies, 50)),
+                    "p90": float(np.percentile(latencies, 90)),
+                    "p99": float(np.percentile(latencies, 99)),
+                    "max": float(latencies.max()),
+                    "mean_service": float(np.mean([r["service"] for r in requests])),
+                    "errors": errors,
+                    "error_rate": errors / len(requests),
+                    "wrong": sum(r["wrong"] for r in requests)}
+
+        requests = sorted(self.requests, key=lambda r: r["i"])
+        kinds = sorted(set(r["kind"] for r in requests))
+        rss = [size for seconds, size in self.rss]
+
+        return {"url": self.url, "concurrency": self.concurrency, "rate": self.rate, "duration": self.duration,
+                "elapsed": elapsed,
+                "overall": summarize(requests),
+                "kinds": {kind: summarize([r for r in requests if r["kind"] == kind]) for kind in kinds},
+                "statuses": {str(status): sum(r["status"] == status for r in requests) for status in set(r["status"] for r in requests)},
+                "rss": {"start": rss[0] if rss else None, "peak": max(rss) if rss else None,
+                        "end": rss[-1] if rss else None, "samples": self.rss},
+                "requests": requests}
+
+
+
+def print_report(report):
+    """
+    :param report: From LoadTest.run().
+    :return: None
+    """
+
+    print("\n{} uploads in {:.1f}s to {} (concurrency {}, {})".format(
+        report["overall"]["requests"], report["elapsed"], report["url"], report["concurrency"],
+        "{}/s".format(report["rate"]) if report["rate"] else "closed loop"))
+
+    print("\n{:>8}  {:>8}  {:>6}  {:>8}  {:>8}  {:>8}  {:>8}  {:>7}  {:>6}".format(
+        "kind", "requests", "per s", "p50 ms", "p90 ms", "p99 ms", "max ms", "errors", "wrong"))
+    for kind, summary in [("all", report["overall"])] + sorted(report["kinds"].items()):
+        if not summary["requests"]:
+            continue
+        print("{:>8}  {:>8}  {:>6.2f}  {:>8.0f}  {:>8.0f}  {:>8.0f}  {:>8.0f}  {:>6.1%}  {:>6}".format(
+            kind, summary["requests"], summary["per_second"], summary["p50"] * 1000, summary["p90"] * 1000,
+            summary["p99"] * 1000, summary["max"] * 1000, summary["error_rate"], summary["wrong"]))
+
+    print("\nStatus codes:", ", ".join("{}: {}".format(status, n) for status, n in sorted(report["statuses"].items())))
+
+    rss = report["rss"]
+    if rss["samples"]:
+        print("Server RSS (with parse workers): {:.0f} MB at the start, {:.0f} MB peak, {:.0f} MB at the end".format(
+            rss["start"] / 2 ** 20, rss["peak"] / 2 ** 20, rss["end"] / 2 ** 20))
+        # one line per tenth of the test
+        for seconds, size in rss["samples"][::max(len(rss["samples"]) // 10, 1)]:
+            print("  {:>6.1f}s  {:>6.0f} MB".format(seconds, size / 2 ** 20))
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+
+    url = None
+    port = LOAD_TEST_PORT
+    concurrency = LOAD_TEST_CONCURRENCY
+    rate = None
+    duration = LOAD_TEST_DURATION
+    n_fixtures = LOAD_TEST_FIXTURES
+    corrupt_fraction = LOAD_TEST_CORRUPT_FRACTION
+    report_file = None
+    for arg in argv[1:]:
+        name, _, value = arg.partition("=")
+        if name == "--url":
+            url = value.rstrip("/")
+        elif name == "--port":
+            port = int(value)
+        elif name == "--concurrency":
+            concurrency = int(value)
+        elif name == "--rate":
+            rate = float(value)
+        elif name == "--duration":
+            duration = float(value)
+        elif name == "--fixtures":
+            n_fixtures = int(value)
+        elif name == "--corrupt":
+            corrupt_fraction = float(value)
+        elif name == "--report":
+            report_file = value
+        else:
+            print("Usage:\n  python load_test.py [--url=<running webapp> | --port=N] [--concurrency=N] [--rate=<uploads/s>]")
+            print("                      [--duration=<seconds>] [--fixtures=N] [--corrupt=<fraction>] [--report=<json>]")
+            print("Starts webapp.py on localhost unless --url is given.  The server's RSS is only sampled when it's")
+            print("started here.")
+            exit(1)
+
+    fixtures = make_fixtures(n_files=n_fixtures, corrupt_fraction=corrupt_fraction)
+    print("Made", len(fixtures), "fixtures,", sum(len(data) for name, kind, data in fixtures) // 1024, "KB")
+
+    server = None
+    server_pid = None
+    if url is None:
+        print("Starting webapp.py on port", port, "...")
+        server, url = start_server(port)
+        server_pid = server.pid
+
+    try:
+        report = LoadTest(url, fixtures, concurrency, rate, duration, server_pid=server_pid).run()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print_report(report)
+    if report_file:
+        with open(report_file, "w") as f:
+            json.dump(report, f)
+        print("Saved", report_file)
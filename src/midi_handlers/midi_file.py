@@ -3,29 +3,122 @@
 # midi_file.py
 # Functions for processing MIDI files
 
-import mido
-import pandas as pd
 import numpy as np
-from scipy.sparse import csr_matrix
-from keras.preprocessing import sequence
 
-from src.midi_handlers.midi_track import MidiTrackText, MidiTrackNHot, MidiTrackNHotTimeSeries
+from src.midi_handlers.midi_track import MidiTrack, MidiTrackText, MidiTrackNHot, MidiTrackNHotTimeSeries, \
+    MidiTrackNHotIndex, MidiTrackNHotTimeSeriesIndex
+from src.midi_handlers.smf_reader import read_midi, is_buffer
+from src.midi_handlers.transposition import keysig_transpose_interval, DRUM_CHANNEL
+from src.midi_handlers.window_policy import WindowPolicy
+from src.midi_handlers import note_cache
 from src.globals import *
 
 
 
+def window_bounds(n_steps):
+    """
+    Where to_X() cuts a track's windows: one every NUM_STEPS steps, plus one overlapping each boundary by half.  The
+    short fragments at the end are dropped if MINIMUM_TAIL_STEPS is set, but never the track's first window.
+
+    :param n_steps: The length of the track's sequence.
+    :return: A list of (start step, length), length is at most NUM_STEPS
+    """
+
+    bounds = []
+
+    for i in range(n_steps // NUM_STEPS + 1):
+
+        #  an overlapping window from the step before
+        if i:
+            start = i * NUM_STEPS - NUM_STEPS // 2
+            bounds.append((start, min(NUM_STEPS, n_steps - start)))
+
+        start = i * NUM_STEPS
+        if start < n_steps:
+            bounds.append((start, min(NUM_STEPS, n_steps - start)))
+
+    if MINIMUM_TAIL_STEPS:
+        bounds = [(start, length) for i, (start, length) in enumerate(bounds) if not i or length >= MINIMUM_TAIL_STEPS]
+
+    return bounds
+
+
+
 class MidiFileBase:
 
-    def __init__(self, filename, note_dist, track_converter):
+    def __init__(self, filename, note_dist, track_converter, mid=None, window_policy=None, use_cache=False):
+        """
+        :param filename: Path to the MIDI file, or the contents of one as bytes.
+        :param note_dist: The file's distribution of MUSIC_NOTES, used to find its key signature.
+        :param track_converter: The MidiTrack subclass to encode each track with.
+        :param mid: The file if it has already been read with smf_reader.read_midi().
+        :param window_policy: The WindowPolicy that picks which windows to_X() makes, None for the one in globals.
+        :param use_cache: Whether the file's notes can go in the note cache.  Only for the archive's files, anything else
+                          (uploads, files to score) would fill the cache with entries nothing ever reads or removes.
+        """
 
         self.filename = filename
         self.note_dist = note_dist
+        self.window_policy = window_policy or WindowPolicy()
+        self.use_cache = use_cache
 
-        self.mid = mido.MidiFile(self.filename)
+        # only read when the notes aren't in the note cache, see get_note_arrays()
+        self.mid = mid
         self.key_sig_transpose = self.get_keysig_transpose_interval()
-        self.ticks_transformer = TICKS_PER_BEAT / self.mid.ticks_per_beat  # coefficient to convert msg.time
 
         self.track_converter = track_converter
+        self.window_lengths = None  # the unpadded length of each window from to_X()
+        self.sequence_drums = None  # whether each sequence from to_sequences() is a drum track
+        self.window_drums = None  # whether each window from to_X() is from a drum track
+        self.n_notes = 0  # how many notes get_note_arrays() found, for progress reports
+
+
+
+    def use_note_cache(self):
+        """
+        Whether this file's notes can go in the note cache: it was made with use_cache and it has a path to key them by
+        (files passed in as bytes don't).
+
+        :return: bool
+        """
+        return self.use_cache and NOTE_CACHE_DIR is not None and not is_buffer(self.filename)
+
+
+
+    def get_note_arrays(self, parse=True):
+        """
+        Gets the paired, binned and transposed notes of every track, from the note cache if they are there.  Otherwise
+        the file is parsed and the result cached.  Nothing in here depends on the encoding, so every encoder shares it.
+
+        :param parse: Parse the file if its notes aren't in the note cache.  False returns None instead.
+        :return: A list of (track_array, channel, program), one per track that has notes.
+        """
+
+        if self.use_note_cache():
+            tracks = note_cache.load(self.filename, self.key_sig_transpose)
+            if tracks is not None:
+                self.n_notes = sum(track_array.size for track_array, channel, program in tracks)
+                return tracks
+
+        if not parse:
+            return None
+
+        if self.mid is None:
+            self.mid = read_midi(self.filename, FAST_MIDI_READER)
+        ticks_transformer = TICKS_PER_BEAT / self.mid.ticks_per_beat  # coefficient to convert ticks
+
+        tracks = []
+        for track in self.mid.tracks:
+            midi_track = MidiTrack(track, ticks_transformer, self.key_sig_transpose)
+            if midi_track.to_array() is not None:
+                tracks.append((midi_track.track_array, midi_track.channel, midi_track.program))
+
+        if self.use_note_cache():
+            note_cache.save(self.filename, self.key_sig_transpose, tracks)
+
+        self.n_notes = sum(track_array.size for track_array, channel, program in tracks)
+
+        return tracks
 
 
 
@@ -37,67 +130,162 @@ class MidiFileBase:
         :return: The interval to use to transpose this file to the correct key signature.
         """
 
-        # get the key signature
-        key_sig = get_key_sig(self.note_dist)
+        return keysig_transpose_interval(self.note_dist)
+
+
+
+    def to_sequences(self):
+        """
+        Encodes every track as one sequence, before it is cut into windows.  Which of them are drum tracks is saved in
+        self.sequence_drums.
+
+        :return: A list of numpy arrays of shape (n_steps, n_features), one per track with notes
+        """
+
+        sequences = []
+        self.sequence_drums = []
+
+        for track_array, channel, program in self.get_note_arrays():
+
+            track_result = self.encode_track(self.track_converter.from_array(track_array, channel, program))
+            if track_result is None:
+                continue
+
+            sequences.append(track_result)
+            self.sequence_drums.append(channel == DRUM_CHANNEL)
+
+        return sequences
+
+
+
+    @staticmethod
+    def encode_track(track):
+        """
+        :param track: A track_converter made with from_array().
+        :return: Its sequence as a numpy array of shape (n_steps, n_features), None if it has none
+        """
+
+        track_result = track.to_sequence()
+
+        if track_result is None:
+            return None
+        if hasattr(track_result, "todense"):
+            # a scipy sparse matrix, checked without importing scipy
+            track_result = np.array(track_result.todense(), dtype=np.byte)
+        elif type(track_result) != np.ndarray:
+            track_result = np.array(track_result, dtype=np.byte)
 
-        # first transpose based on key signature
-        if key_sig < 6:
-            transpose_interval = -key_sig
-        else:
-            transpose_interval = 12 - key_sig
+        return track_result
+
+
+
+    def select_windows(self, parse=True):
+        """
+        Decides which windows to make with the window policy, from the tracks' lengths before anything is encoded, so
+        the tracks it leaves out are never encoded.
+
+        :param parse: Parse the file if its notes aren't in the note cache.  False returns None instead.
+        :return: A list of (track, is_drums, windows) for each track that keeps any, track is a track_converter to
+                 encode and windows a list of (start step, length) like window_bounds()
+        """
 
+        note_arrays = self.get_note_arrays(parse)
+        if note_arrays is None:
+            return None
 
-        return transpose_interval
+        tracks = []
+        for track_array, channel, program in note_arrays:
+            track = self.track_converter.from_array(track_array, channel, program)
+            tracks.append((track, channel == DRUM_CHANNEL, window_bounds(track.n_steps()), track_array.size))
+
+        selected = self.window_policy.select([bounds for track, is_drums, bounds, n_notes in tracks],
+                                             [n_notes for track, is_drums, bounds, n_notes in tracks], self.filename)
+
+        return [(track, is_drums, windows) for (track, is_drums, bounds, n_notes), windows in zip(tracks, selected)
+                if windows]
 
 
 
     def to_X(self):
         """
-        Converts a mido MidiFile into a list of dictionaries.
-        :return: A list of dictionaries.  Each dictionary represents a track.  The dictionaries are in the format
-                 {start_time: [tuple(note, duration, velocity), ...]}
+        Converts the MIDI file into windows of NUM_STEPS steps, the ones the window policy picks.  Windows shorter than
+        that are zero padded at the end, their true lengths are saved in self.window_lengths and whether they're from a
+        drum track in self.window_drums.
+
+        :return: A list of numpy arrays of shape (NUM_STEPS, n_features)
         """
 
         X = []
+        self.window_lengths = []
+        self.window_drums = []
 
-        for track in self.mid.tracks:
+        for track, is_drums, windows in self.select_windows():
+            track_result = self.encode_track(track)
+            if track_result is None:
+                continue
+
+            for start, length in windows:
+
+                window = track_result[start:start + length]
+                if length < NUM_STEPS:
+                    padded = np.zeros((NUM_STEPS,) + window.shape[1:], dtype=window.dtype)
+                    padded[:length] = window
+                    window = padded
 
-            track_converter = self.track_converter(track, self.ticks_transformer, self.key_sig_transpose)
-            track_result = track_converter.to_sequence()
+                X.append(window)
+                self.window_lengths.append(length)
+                self.window_drums.append(is_drums)
 
+        return X
+
+
+
+    def write_X(self, X, positions):
+        """
+        Same windows as to_X(), written straight into a preallocated array instead of collected in a list.
+
+        :param X: A zeroed numpy array of shape (n, NUM_STEPS, n_features).
+        :param positions: Where in X each window goes, one per window from count_windows().
+        :return: How many windows were written
+        """
+
+        self.window_lengths = []
+        self.window_drums = []
+        n_windows = 0
 
+        for track, is_drums, windows in self.select_windows():
+            track_result = self.encode_track(track)
             if track_result is None:
                 continue
-            if type(track_result) == csr_matrix:
-                track_result = np.array(track_result.todense(), dtype=np.byte)
-            elif type(track_result) != np.ndarray:
-                track_result = np.array(track_result, dtype=np.byte)
 
+            for start, length in windows:
 
-            partitions = int(track_result.shape[0] / NUM_STEPS) + 1
-            chunks = []
-            for i in range(partitions):
+                if n_windows >= len(positions):
+                    raise ValueError("{} has more windows than the {} counted".format(self.filename, len(positions)))
 
-                if i:
+                X[positions[n_windows], :length] = track_result[start:start + length]
+                self.window_lengths.append(length)
+                self.window_drums.append(is_drums)
+                n_windows += 1
 
-                    #  take an overlapping chunk from the step before
-                    pre_chunk = track_result[(i * NUM_STEPS) - int(NUM_STEPS / 2):((i + 1) * NUM_STEPS) - int(NUM_STEPS / 2)]
-                    if pre_chunk.shape[0] < NUM_STEPS:
-                        chunks.append(sequence.pad_sequences(pre_chunk.T, maxlen=NUM_STEPS, padding="post").T)
-                    else:
-                        chunks.append(pre_chunk)
+        return n_windows
 
-                chunk = track_result[i * NUM_STEPS:(i + 1) * NUM_STEPS]
-                if not chunk.shape[0]:
-                    continue
-                elif chunk.shape[0] < NUM_STEPS:
-                    chunks.append(sequence.pad_sequences(chunk.T, maxlen=NUM_STEPS, padding="post").T)
-                else:
-                    chunks.append(chunk)
 
-            X.extend(chunks)
 
-        return X
+    def count_windows(self, parse=True):
+        """
+        How many windows to_X() will make, without encoding anything.  Only needs the note arrays, which come from the
+        note cache when they're in it (and are put in it when they're not).
+
+        :param parse: Parse the file if its notes aren't in the note cache.  False returns None instead.
+        :return: int, None if it wasn't cached and parse is False
+        """
+
+        selected = self.select_windows(parse)
+        if selected is None:
+            return None
+
+        return sum(len(windows) for track, is_drums, windows in selected)
 
 
 
@@ -105,8 +293,8 @@ class MidiFileBase:
 class MidiFileText(MidiFileBase):
 
 
-    def __init__(self, filename, note_dist):
-        MidiFileBase.__init__(self, filename, note_dist, MidiTrackText)
+    def __init__(self, filename, note_dist, mid=None, window_policy=None, use_cache=False):
+        MidiFileBase.__init__(self, filename, note_dist, MidiTrackText, mid, window_policy, use_cache)
 
 
     def to_text(self):
@@ -118,9 +306,9 @@ class MidiFileText(MidiFileBase):
 
         result = []
 
-        for track in self.mid.tracks:
+        for track_array, channel, program in self.get_note_arrays():
 
-            track_converter = MidiTrackText(track, self.ticks_transformer, self.key_sig_transpose)
+            track_converter = MidiTrackText.from_array(track_array, channel, program)
             track_result = track_converter.to_text()
 
             if track_result:
@@ -133,20 +321,36 @@ class MidiFileText(MidiFileBase):
 
 class MidiFileNHot(MidiFileBase):
 
-    def __init__(self, filename, note_dist):
-        super().__init__(filename, note_dist, MidiTrackNHot)
+    def __init__(self, filename, note_dist, mid=None, window_policy=None, use_cache=False):
+        super().__init__(filename, note_dist, MidiTrackNHot, mid, window_policy, use_cache)
 
 
 
 class MidiFileNHotTimeSeries(MidiFileBase):
 
-    def __init__(self, filename, note_dist):
-        super().__init__(filename, note_dist, MidiTrackNHotTimeSeries)
+    def __init__(self, filename, note_dist, mid=None, window_policy=None, use_cache=False):
+        super().__init__(filename, note_dist, MidiTrackNHotTimeSeries, mid, window_policy, use_cache)
+
+
+
+class MidiFileNHotIndex(MidiFileBase):
+
+    def __init__(self, filename, note_dist, mid=None, window_policy=None, use_cache=False):
+        super().__init__(filename, note_dist, MidiTrackNHotIndex, mid, window_policy, use_cache)
+
+
+
+class MidiFileNHotTimeSeriesIndex(MidiFileBase):
+
+    def __init__(self, filename, note_dist, mid=None, window_policy=None, use_cache=False):
+        super().__init__(filename, note_dist, MidiTrackNHotTimeSeriesIndex, mid, window_policy, use_cache)
 
 
 
 
 if __name__ == "__main__":
+    import mido
+    import pandas as pd
     file = "midi/classical/Arndt/Nola, Novelty piano solo.mid"
     df = pd.read_csv("midi/classical/meta.csv", index_col="filename")
     mid = mido.MidiFile(file)
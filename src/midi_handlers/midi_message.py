@@ -3,8 +3,24 @@
 # midi_file.py
 # Functions for processing MIDI files
 
+import numpy as np
+
+
+# one row per note in a track's note array
+NOTE_DTYPE = np.dtype([("start_time", np.int64),
+                       ("duration", np.int32),
+                       ("note", np.int16),
+                       ("velocity", np.int16),
+                       ("channel", np.int8)])
+
+
 
 class MidiMessage:
+    """
+    A note that is still playing (note_on without a matching note_off yet).
+    """
+
+    __slots__ = ("note", "velocity", "duration", "channel", "start_time")
 
     def __init__(self, msg, start_time):
         self.note = msg.note
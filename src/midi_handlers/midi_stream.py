@@ -0,0 +1,326 @@
+# Mark Evers
+# Created: 10/19/2026
+# midi_stream.py
+# Online n-hot encoding of MIDI messages as they arrive, for live classification
+
+from collections import deque
+import numpy as np
+
+from src.globals import *
+from src.midi_handlers.transposition import DRUM_CHANNEL, keysig_transpose_interval, octave_transpose_interval
+
+
+
+N_FEATURES = 128 + len(DURATION_BINS) + 4
+TRACK_ON_I = 128 + len(DURATION_BINS)
+TRACK_OFF_I = TRACK_ON_I + 1
+DRUM_TRACK_ON_I = TRACK_OFF_I + 1
+DRUM_TRACK_OFF_I = DRUM_TRACK_ON_I + 1
+
+_DURATION_BINS = np.array(DURATION_BINS)
+# every MIDI note, for octave histograms of transposed notes
+_PITCHES = np.arange(128)
+
+
+
+def bin_note_duration(duration):
+    """
+    Scalar bin_note_durations() for one note, without building arrays.
+
+    :param duration: The note's duration in ticks.
+    :return: The index of the closest bin in DURATION_BINS, ties go to the longer bin
+    """
+    return int(np.abs(_DURATION_BINS - duration).argmin())
+
+
+
+class Chord:
+    """
+    Notes that started together, waiting for all of them to end so their durations are known.
+    """
+
+    __slots__ = ("start", "notes", "n_playing")
+
+    def __init__(self, start):
+        self.start = start
+        self.notes = []  # [(note, duration bin index), ...] of the notes that have ended
+        self.n_playing = 0
+
+
+
+class OnlineTrack:
+    """
+    Encodes the notes of one channel into MidiTrackNHot steps as they arrive.  A note_on opens a note, the next
+    note_on/note_off of the same note ends it (like MidiTrack.pair_notes()).  A chord becomes a step once no more notes
+    can join it and all its notes have ended.  Notes held longer than MAXIMUM_NOTE_LENGTH are ended there, since they
+    all get the longest duration bin anyway, so no chord waits longer than that.
+
+    The last NUM_STEPS steps are kept in a ring buffer.  Every NUM_STEPS / 2 steps, once there are NUM_STEPS of them,
+    the buffer is handed out as a window, the same 50% overlap as MidiFileBase.to_X().
+    """
+
+    def __init__(self, channel):
+        """
+        :param channel: The MIDI channel.
+        """
+
+        self.channel = channel
+        self.is_drums = channel == DRUM_CHANNEL
+
+        self.playing = {}  # {note: Chord it started in}
+        self.onsets = {}  # {note: start time}
+        self.chords = deque()  # Chords in the order they started
+        self.note_counts = np.zeros(128, dtype=np.int64)  # for the octave transpose
+
+        self.steps = np.zeros((NUM_STEPS, N_FEATURES), dtype=np.byte)
+        self.n_steps = 0
+        self.steps_since_window = 0
+
+
+
+    def note_on(self, note, time):
+        """
+        :param note: The MIDI note.
+        :param time: When it started, in ticks.
+        :return: None
+        """
+
+        # a note_on of a note that is already playing restarts it
+        self.note_off(note, time)
+
+        if not self.chords or time - self.chords[-1].start > LIVE_CHORD_TICKS:
+            self.chords.append(Chord(time))
+
+        chord = self.chords[-1]
+        chord.n_playing += 1
+        self.playing[note] = chord
+        self.onsets[note] = time
+        self.note_counts[note] += 1
+
+
+
+    def note_off(self, note, time):
+        """
+        :param note: The MIDI note.
+        :param time: When it ended, in ticks.
+        :return: None
+        """
+
+        # note_offs with nothing playing are ignored
+        chord = self.playing.pop(note, None)
+        if chord is None:
+            return
+
+        chord.notes.append((note, bin_note_duration(time - self.onsets.pop(note))))
+        chord.n_playing -= 1
+
+
+
+    def ready_chords(self, time):
+        """
+        Takes the chords that are finished off the front of the queue.
+
+        :param time: The current time, in ticks.
+        :return: A list of Chords
+        """
+
+        ready = []
+
+        while self.chords:
+            chord = self.chords[0]
+
+            # end notes held too long to change their duration bin
+            if chord.n_playing and time - chord.start >= MAXIMUM_NOTE_LENGTH:
+                for note in [note for note, playing in self.playing.items() if playing is chord]:
+                    self.note_off(note, self.onsets[note] + MAXIMUM_NOTE_LENGTH)
+
+            # the newest chord can still get notes until LIVE_CHORD_TICKS have passed
+            if chord.n_playing or (len(self.chords) == 1 and time - chord.start <= LIVE_CHORD_TICKS):
+                break
+
+            ready.append(self.chords.popleft())
+
+        return ready
+
+
+
+    def add_step(self, step):
+        """
+        Appends a step to the ring buffer.
+
+        :param step: A numpy array of N_FEATURES.
+        :return: A window of shape (NUM_STEPS, N_FEATURES) if one is due, otherwise None
+        """
+
+        self.steps[self.n_steps % NUM_STEPS] = step
+        self.n_steps += 1
+        self.steps_since_window += 1
+
+        if self.n_steps >= NUM_STEPS and (self.n_steps == NUM_STEPS or self.steps_since_window >= NUM_STEPS // 2):
+            self.steps_since_window = 0
+            return self.window()
+
+        return None
+
+
+
+    def window(self):
+        """
+        :return: The last NUM_STEPS steps in order, zero padded at the end if there aren't that many yet.
+        """
+
+        if self.n_steps < NUM_STEPS:
+            return self.steps.copy()
+
+        oldest = self.n_steps % NUM_STEPS
+        return np.concatenate((self.steps[oldest:], self.steps[:oldest]))
+
+
+
+    def encode_chord(self, chord, key_interval):
+        """
+        Converts a finished chord to a step, transposed the way MidiTrack.transpose() would with what we know so far.
+
+        :param chord: The Chord.
+        :param key_interval: The current key signature transpose.
+        :return: A numpy array of N_FEATURES
+        """
+
+        step = np.zeros(N_FEATURES, dtype=np.byte)
+
+        interval = 0
+        if not self.is_drums:
+            octave_counts = np.bincount(np.clip((_PITCHES + key_interval) // 12, 0, None), weights=self.note_counts)
+            interval = key_interval + octave_transpose_interval(octave_counts)
+
+        for note, duration_i in chord.notes:
+            note += interval
+            if 0 <= note < 128:
+                step[note] = 1
+            step[128 + duration_i] = 1
+
+        return step
+
+
+
+
+class MidiStream:
+    """
+    Routes live MIDI messages to an OnlineTrack per channel and collects the windows they produce.  Time comes in as
+    seconds and is converted to ticks at the current tempo.  The key signature is found from a running MUSIC_NOTES
+    histogram of everything played so far, so it gets better as the piece goes on.
+
+    Everything it keeps is bounded: 16 channels, at most 128 notes playing per channel, chords no older than
+    MAXIMUM_NOTE_LENGTH and NUM_STEPS steps per channel.
+    """
+
+    def __init__(self, beats_per_minute=LIVE_BEATS_PER_MINUTE):
+        """
+        :param beats_per_minute: The tempo to convert seconds to ticks with.
+        """
+
+        self.tracks = {}  # {channel: OnlineTrack}
+        self.note_dist = np.zeros(12)
+        self.key_interval = 0
+
+        self.ticks_per_second = 0.
+        self.set_tempo(beats_per_minute)
+        self.last_seconds = None
+        self.time = 0.  # ticks since the first message
+
+
+
+    def set_tempo(self, beats_per_minute):
+        """
+        :param beats_per_minute: The new tempo, used from now on.
+        :return: None
+        """
+        self.ticks_per_second = TICKS_PER_BEAT * beats_per_minute / 60
+
+
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward and encodes any chords that finished.
+
+        :param seconds: The current time in seconds (any monotonic clock).
+        :return: A list of (channel, window) for the windows that are due
+        """
+
+        if self.last_seconds is not None:
+            self.time += (seconds - self.last_seconds) * self.ticks_per_second
+        self.last_seconds = seconds
+
+        windows = []
+        for track in self.tracks.values():
+            for chord in track.ready_chords(self.time):
+                window = track.add_step(track.encode_chord(chord, self.key_interval))
+                if window is not None:
+                    windows.append((track.channel, window))
+
+        return windows
+
+
+
+    def feed(self, message, seconds):
+        """
+        Handles one message.
+
+        :param message: A mido message.  Anything but note_on/note_off only moves the clock.
+        :param seconds: When it arrived in seconds (any monotonic clock).
+        :return: A list of (channel, window) for the windows that are due
+        """
+
+        windows = self.advance(seconds)
+
+        if message.type == "note_on" and message.velocity > 0:
+
+            track = self.tracks.get(message.channel)
+            if track is None:
+                # the track_on step, like the first row of MidiTrackNHot.to_sequence()
+                track = self.tracks[message.channel] = OnlineTrack(message.channel)
+                step = np.zeros(N_FEATURES, dtype=np.byte)
+                step[DRUM_TRACK_ON_I if track.is_drums else TRACK_ON_I] = 1
+                track.add_step(step)
+
+            track.note_on(message.note, self.time)
+
+            # same as MidiArchive.smf_meta(), which skips channel 10 (not the drums on 9) when counting
+            if message.channel != 10:
+                self.note_dist[message.note % 12] += 1
+                self.key_interval = keysig_transpose_interval(self.note_dist)
+
+        elif message.type == "note_off" or message.type == "note_on":
+            track = self.tracks.get(message.channel)
+            if track is not None:
+                track.note_off(message.note, self.time)
+
+        return windows
+
+
+
+    def close(self):
+        """
+        Ends every note, encodes what's left and adds the track_off steps.
+
+        :return: A list of (channel, window) with the last window of every track that has new steps (zero padded if it's
+                 short)
+        """
+
+        windows = []
+        for track in self.tracks.values():
+
+            for note in list(track.playing):
+                track.note_off(note, self.time)
+            for chord in track.ready_chords(self.time + LIVE_CHORD_TICKS + 1):
+                track.add_step(track.encode_chord(chord, self.key_interval))
+
+            step = np.zeros(N_FEATURES, dtype=np.byte)
+            step[DRUM_TRACK_OFF_I if track.is_drums else TRACK_OFF_I] = 1
+            window = track.add_step(step)
+            if window is None and track.steps_since_window:
+                window = track.window()
+            if window is not None:
+                windows.append((track.channel, window))
+
+        return windows
@@ -4,29 +4,53 @@
 # Functions for processing MIDI files
 
 import numpy as np
-from collections import Counter
 
-from src.midi_handlers.midi_message import MidiMessage
+from src.midi_handlers.midi_message import NOTE_DTYPE
+from src.midi_handlers.transposition import transpose_track_array
 from src.globals import *
 
 
 
+def nhot_to_indexes(nhot, max_polyphony=MAXIMUM_POLYPHONY):
+    """
+    Converts n-hot steps to the indexes of their active features.  Indexes are the feature + 1 so 0 can be padding.
+    Steps with more than max_polyphony features keep the highest ones (track markers, then durations, then the
+    highest notes).
+
+    :param nhot: A numpy array of shape (n_steps, n_features), n_features < 256.
+    :param max_polyphony: How many features each step keeps.
+    :return: A numpy array of uint8 with shape (n_steps, max_polyphony)
+    """
+
+    n_features = nhot.shape[1]
+
+    # reversed, so the features of each step come out highest first
+    step_i, reversed_i = np.nonzero(nhot[:, ::-1])
+    rank = np.arange(step_i.size) - np.searchsorted(step_i, step_i)
+    keep = rank < max_polyphony
+
+    result = np.zeros((nhot.shape[0], max_polyphony), dtype=np.uint8)
+    result[step_i[keep], rank[keep]] = n_features - reversed_i[keep]
+
+    return result
+
+
+
+
 class MidiTrack:
 
     def __init__(self, track, ticks_transformer, key_sig_transpose):
         """
         Initializes the object.
 
-        :param track: A mido.MidiTrack object.
+        :param track: An smf_reader.SmfTrack object, or None for a track made with from_array().
         :param ticks_transformer: The conversion rate for ticks per beat.
         :param key_sig_transpose: The interval to transpose into C/Am
         """
 
-        self.time_now = None  # absolute time
-        self.open_notes = {}  # {msg.note: MidiMessage}
-        self.track_dict = None  # {start_time: [MidiMessage, ...]}
-        self.track_C_octaves = Counter()
-        self.program = 0
+        self.track_array = None  # numpy array of NOTE_DTYPE sorted by (start_time, note)
+        self.track_C_octaves = None  # octave histogram, see transposition.octave_histogram()
+        self.program = track.program if track is not None else 0
 
         self.track = track
         self.ticks_transformer = ticks_transformer
@@ -35,129 +59,141 @@ class MidiTrack:
 
 
 
-    def close_note(self, note):
+    @classmethod
+    def from_array(cls, track_array, channel, program):
         """
-        Moves an open note from open_notes to track_result.
+        Makes a track out of notes that have already been through to_array(), e.g. from the note cache.
 
-        :param note: The note to close
-        :return: None
+        :param track_array: A numpy array of NOTE_DTYPE, already sorted and transposed.
+        :param channel: The channel of the track's first note.
+        :param program: The track's program.
+        :return: The track
         """
 
-        # if it's already playing, take it out of open_notes and add it to our list
-        if note in self.open_notes:
-            this_msg = self.open_notes[note]
+        track = cls(None, None, None)
+        track.track_array = track_array
+        track.channel = channel
+        track.program = program
 
-            # IMPORTANT: transpose to correct key signature occurs here
-            this_msg.transpose(self.key_sig_transpose)
-            # bin it to the correct duration
-            this_msg.duration = bin_note_duration(self.time_now - this_msg.start_time)
+        return track
 
-            if this_msg.start_time not in self.track_dict:
-                self.track_dict[this_msg.start_time] = []
-            self.track_dict[this_msg.start_time].append(this_msg)
 
-            del self.open_notes[note]
 
-            # save the octave distribution to use to transpose later
-            music_note, octave = midi_to_music(this_msg.note)
-            # if music_note == "C":
-            self.track_C_octaves.update([octave])
+    def transpose(self):
+        """
+        Transposes the track into C/Am and to the middle C octave range.
 
-        # else:
-        #     print("Note off with no start:", note)
+        :return: None
+        """
 
+        # IMPORTANT: transpose to correct key signature occurs here
+        self.track_C_octaves = transpose_track_array(self.track_array, self.key_sig_transpose)
 
 
-    def close_all_notes(self):
+
+    def pair_notes(self):
         """
-        Loops through open notes and closes them all with self.time_now.
+        Matches every note_on with the message that ends it.  A note ends at the next note_on/note_off of the same note
+        (a note_on of a note that is already playing restarts it), notes that never end are closed at the end of the
+        track.  note_off messages with nothing playing are ignored.
 
-        :return: None
+        :return: A numpy array of NOTE_DTYPE in the order the notes started, None if the track has no notes.
         """
 
-        # look for still playing notes and close them if all the messages are done
-        for key, value in self.open_notes.copy().items():
-            # print("Note has no end:", key)
-            # print("       duration:", self.time_now - value.start_time)
-            # print("       velocity:", value.velocity)
-            # print("Removing from <open_notes>...")
+        events = self.track.events
 
-            self.close_note(key)
+        # the first note_on is time 0, anything before it is just meta messages at the beginning
+        on_i = np.flatnonzero(events["on"])
+        if not on_i.size:
+            return None
+        events = events[on_i[0]:]
+        first_time = events["time"][0]
 
+        times = ((events["time"] - first_time) * self.ticks_transformer).astype(np.int64)
+        end_time = int((self.track.end_time - first_time) * self.ticks_transformer)
 
+        # a note_on with velocity 0 is really a note_off
+        starts = events["on"] & (events["velocity"] > 0)
+        if not starts.any():
+            return None
 
-    def transpose_octavewise(self):
-        """
-        Transposes the track to the middle C octave range.
+        # group the messages by note, keeping track order within a note.  each message ends the one before it
+        by_note = np.argsort(events["note"], kind="stable")
+        sorted_notes = events["note"][by_note]
+        end_times = np.full(events.size, end_time, dtype=np.int64)
+        same_note = sorted_notes[1:] == sorted_notes[:-1]
+        end_times[by_note[:-1][same_note]] = times[by_note[1:][same_note]]
 
-        :return: None
-        """
+        start_i = np.flatnonzero(starts)
+        self.channel = int(events["channel"][start_i[0]])
 
-        # transpose it to the correct octave (C4)
-        most_common_octave = self.track_C_octaves.most_common(1)[0][0]
-        if most_common_octave != 4:
+        track_array = np.empty(start_i.size, dtype=NOTE_DTYPE)
+        track_array["start_time"] = times[start_i]
+        track_array["duration"] = end_times[start_i] - times[start_i]
+        track_array["note"] = events["note"][start_i]
+        track_array["velocity"] = events["velocity"][start_i]
+        track_array["channel"] = events["channel"][start_i]
 
-            octave_transpose = (4 - most_common_octave) * 12
-            for start_time, note_list in self.track_dict.copy().items():
-                for msg in note_list:
-                    msg.transpose(octave_transpose)
+        return track_array
 
 
 
-    def to_dict(self):
+    def to_array(self):
         """
-        Converts it to a list.
+        Converts the track's note events to a numpy array of NOTE_DTYPE.
 
-        :return: The messages as a time series in a list.
+        :return: The notes as a numpy array sorted by (start_time, note), None if the track has no notes.
         """
 
-        self.track_dict = {}
+        # made with from_array(), nothing to parse
+        if self.track is None:
+            return self.track_array
 
-        for msg in self.track:
+        self.track_array = self.pair_notes()
+        # if the track didn't contain any actual notes, only meta
+        if self.track_array is None:
+            return None
 
-            # msg.time is the time since the last message.  So add this to time to get the current time since the track start
-            # we haven't seen a note_on yet, it's just some meta message at the beginning.  we want to make the first note at time = 0
-            if not self.time_now is None:
-                self.time_now += int(msg.time * self.ticks_transformer)
+        self.track_array["duration"] = bin_note_durations(self.track_array["duration"])
 
-            # get the instrument
-            if msg.type == "program_change":
-                self.program = msg.program
+        # sort once, by start time then by note
+        self.track_array = self.track_array[np.lexsort((self.track_array["note"], self.track_array["start_time"]))]
 
-            if msg.type == "note_off":
-                self.close_note(msg.note)
-                continue
+        # transpose it to C/Am and the most common octave to C4
+        self.transpose()
 
-            if msg.type == 'note_on':
+        return self.track_array
 
-                if self.time_now is None:
-                    self.time_now = 0
 
-                # if the velocity is 0, that means it is a "note_off" message, close the note and move on
-                if msg.velocity == 0:
-                    self.close_note(msg.note)
-                    continue
 
-                # it shouldn't be open already, but check any way.
-                if msg.note in self.open_notes:
-                    self.close_note(msg.note)
+    def step_indexes(self):
+        """
+        Gets the index of the chord (group of notes with the same start time) each note in track_array belongs to.
 
-                # add it to open notes
-                self.open_notes[msg.note] = MidiMessage(msg, self.time_now)
+        :return: A numpy array the same length as track_array
+        """
 
-                if self.channel == -1:
-                    self.channel = msg.channel
+        step_i = np.zeros(self.track_array.size, dtype=np.int64)
+        np.cumsum(np.diff(self.track_array["start_time"]) != 0, out=step_i[1:])
 
+        return step_i
 
-        self.close_all_notes()
-        # if the track didn't contain any actual notes, only meta
-        if not len(self.track_dict.keys()):
-            return None
 
-        # transpose it to the most common octave
-        self.transpose_octavewise()
 
-        return self.track_dict
+    def n_steps(self):
+        """
+        The length of the track's sequence without encoding it: one step per chord plus the track_on and track_off
+        steps.
+
+        :return: int
+        """
+
+        self.to_array()
+
+        if self.track_array is None:
+            return 0
+
+        return int(self.step_indexes()[-1]) + 3
 
 
 
@@ -177,9 +213,9 @@ class MidiTrackText(MidiTrack):
         :return: The notes contained within as a list
         """
 
-        self.to_dict()
+        self.to_array()
 
-        if not self.track_dict:
+        if self.track_array is None:
             return None
 
         if self.channel != 9:
@@ -187,9 +223,11 @@ class MidiTrackText(MidiTrack):
         else:
             result = ["DRUM_TRACK_START"]
 
-        for time, notes in sorted(self.track_dict.items()):
-            step = [midi_to_string(msg.note) + ":" + str(msg.duration) for msg in sorted(notes, key=lambda x: x.note)]
-            result.append(";".join(step))
+        # track_array is already sorted by (start_time, note), so each chord is a contiguous slice
+        words = [midi_to_string(note) + ":" + str(duration) for note, duration in zip(self.track_array["note"].tolist(), self.track_array["duration"].tolist())]
+        chord_starts = np.flatnonzero(np.diff(self.track_array["start_time"])) + 1
+        chord_bounds = zip([0] + chord_starts.tolist(), chord_starts.tolist() + [len(words)])
+        result.extend(";".join(words[i:j]) for i, j in chord_bounds)
 
         if self.channel != 9:
             result.append("TRACK_END")
@@ -227,9 +265,9 @@ class MidiTrackNHot(MidiTrack):
 
     def to_sequence(self):
 
-        self.to_dict()
+        self.to_array()
 
-        if not self.track_dict:
+        if self.track_array is None:
             return None
 
         track_on_i = 128 + len(DURATION_BINS)
@@ -237,38 +275,39 @@ class MidiTrackNHot(MidiTrack):
         drum_track_on_i = track_off_i + 1
         drum_track_off_i = drum_track_on_i + 1
 
-        empty = np.zeros(drum_track_off_i + 1, dtype=np.byte)
+        # one step per chord plus the track_on and track_off steps
+        step_i = self.step_indexes() + 1
+        result = np.zeros(shape=(step_i[-1] + 2, drum_track_off_i + 1), dtype=np.byte)
 
         if self.channel != 9:
-            first = empty.copy()
-            first[track_on_i] = 1
-            result = [first]
+            result[0, track_on_i] = 1
+            result[-1, track_off_i] = 1
         else:
-            first = empty.copy()
-            first[drum_track_on_i] = 1
-            result = [first]
+            result[0, drum_track_on_i] = 1
+            result[-1, drum_track_off_i] = 1
+
+        result[step_i, self.track_array["note"]] = 1
+        result[step_i, 128 + duration_bin_index(self.track_array["duration"])] = 1
 
-        for time, notes in sorted(self.track_dict.items()):
+        return result
 
-            n_hot = empty.copy()
 
-            for msg in notes:
-                n_hot[msg.note] = 1
-                duration = DURATION_BINS.index(msg.duration)
-                n_hot[128 + duration] = 1
 
-            result.append(n_hot)
+class MidiTrackNHotIndex(MidiTrackNHot):
+
+    def __init__(self, track, ticks_transformer, key_sig_transpose):
+        super().__init__(track, ticks_transformer, key_sig_transpose)
 
-        if self.channel != 9:
-            last = empty.copy()
-            last[track_off_i] = 1
-            result.append(last)
-        else:
-            last = empty.copy()
-            last[drum_track_off_i] = 1
-            result.append(last)
 
-        return result
+
+    def to_sequence(self):
+
+        result = super().to_sequence()
+
+        if result is None:
+            return None
+
+        return nhot_to_indexes(result)
 
 
 
@@ -282,21 +321,37 @@ class MidiTrackNHotTimeSeries(MidiTrack):
 
     @staticmethod
     def bin_timestamp(time):
+        """
+        Converts absolute times to the index of their time step.  Works on a single time or a numpy array of times.
 
-        bin = int(time / MINIMUM_TIMESERIES_STEP)
-        remainder = time % MINIMUM_TIMESERIES_STEP
+        :param time: The time in ticks
+        :return: The index of the time step
+        """
 
-        if remainder > MINIMUM_TIMESERIES_STEP / 2:
-            bin += 1
+        bin = np.floor_divide(time, MINIMUM_TIMESERIES_STEP).astype(np.int64)
+        remainder = np.remainder(time, MINIMUM_TIMESERIES_STEP)
+
+        bin += remainder > MINIMUM_TIMESERIES_STEP / 2
 
         return bin + 1  # add 1 because the first is the special track_on note
 
 
+
+    def n_steps(self):
+
+        self.to_array()
+
+        if self.track_array is None:
+            return 0
+
+        return int(self.bin_timestamp(self.track_array["start_time"][-1])) + 1 + 2
+
+
     def to_sequence(self):
 
-        self.to_dict()
+        self.to_array()
 
-        if not self.track_dict:
+        if self.track_array is None:
             return None
 
 
@@ -304,7 +359,9 @@ class MidiTrackNHotTimeSeries(MidiTrack):
         track_off_i = track_on_i + 1
         drum_track_on_i = track_off_i + 1
         drum_track_off_i = drum_track_on_i + 1
-        time_len = self.bin_timestamp(max(self.track_dict.keys())) + 1 + 2  # add 1 because we want the length, not the index.  add 2 because of track_on and track_off notes
+
+        time_i = self.bin_timestamp(self.track_array["start_time"])
+        time_len = time_i[-1] + 1 + 2  # add 1 because we want the length, not the index.  add 2 because of track_on and track_off notes
 
         result = np.zeros(shape=(time_len, drum_track_off_i + 1), dtype=np.byte)
 
@@ -317,14 +374,26 @@ class MidiTrackNHotTimeSeries(MidiTrack):
             result[-1, drum_track_off_i] = 1
 
 
-        for time, notes in sorted(self.track_dict.items()):
+        result[time_i, self.track_array["note"]] = 1
+        result[time_i, 128 + duration_bin_index(self.track_array["duration"])] = 1
 
-            time_i = self.bin_timestamp(time)
 
-            for msg in notes:
-                result[time_i, msg.note] = 1
-                duration = DURATION_BINS.index(msg.duration)
-                result[time_i, 128 + duration] = 1
+        return result
 
 
-        return result
+
+class MidiTrackNHotTimeSeriesIndex(MidiTrackNHotTimeSeries):
+
+    def __init__(self, track, ticks_transformer, key_sig_transpose):
+        super().__init__(track, ticks_transformer, key_sig_transpose)
+
+
+
+    def to_sequence(self):
+
+        result = super().to_sequence()
+
+        if result is None:
+            return None
+
+        return nhot_to_indexes(result)
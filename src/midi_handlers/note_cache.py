@@ -0,0 +1,141 @@
+# Mark Evers
+# Created: 10/19/2026
+# note_cache.py
+# On disk cache of each file's transposed, quantized note arrays so the encoders don't have to parse MIDI again
+
+import hashlib
+import os
+import numpy as np
+
+from src.globals import *
+from src.midi_handlers.midi_message import NOTE_DTYPE
+
+
+
+# bump this whenever MidiTrack.to_array() changes what it produces
+CACHE_FORMAT_VERSION = 1
+
+
+
+def cache_version():
+    """
+    Identifies everything the cached arrays depend on.  Changing any of the parse globals gives a new version, which
+    lives in its own sub directory of NOTE_CACHE_DIR.
+
+    :return: A short hex string
+    """
+
+    settings = (CACHE_FORMAT_VERSION, NOTE_DTYPE.descr, TICKS_PER_BEAT, MINIMUM_NOTE_LENGTH, MAXIMUM_NOTE_LENGTH,
+                tuple(DURATION_BINS))
+    return hashlib.sha1(repr(settings).encode()).hexdigest()[:12]
+
+
+
+def cache_path(filename, cache_dir=None):
+    """
+    Gets where a MIDI file's note arrays are cached.
+
+    :param filename: Path to the MIDI file.
+    :param cache_dir: The cache directory, NOTE_CACHE_DIR by default.
+    :return: Path to the .npz file
+    """
+
+    cache_dir = cache_dir or NOTE_CACHE_DIR
+    name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    return os.path.join(cache_dir, cache_version(), name[:2], name + ".npz")
+
+
+
+def _source_stamp(filename):
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+
+def save(filename, key_sig_transpose, tracks, cache_dir=None):
+    """
+    Caches the note arrays of a MIDI file.
+
+    :param filename: Path to the MIDI file.
+    :param key_sig_transpose: The interval the notes were transposed by.
+    :param tracks: A list of (track_array, channel, program), one per track with notes.
+    :param cache_dir: The cache directory, NOTE_CACHE_DIR by default.
+    :return: None
+    """
+
+    path = cache_path(filename, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # all the tracks in one array, track i is notes[track_offsets[i]:track_offsets[i + 1]]
+    notes = np.concatenate([track_array for track_array, channel, program in tracks]) if tracks else np.empty(0, dtype=NOTE_DTYPE)
+    track_offsets = np.cumsum([0] + [track_array.size for track_array, channel, program in tracks])
+
+    # write then rename so a reader never sees half a file
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, "wb") as f:
+        np.savez(f, notes=notes, track_offsets=track_offsets,
+                 channels=np.array([channel for track_array, channel, program in tracks], dtype=np.int64),
+                 programs=np.array([program for track_array, channel, program in tracks], dtype=np.int64),
+                 key_sig_transpose=np.array(key_sig_transpose), source=_source_stamp(filename))
+    os.replace(temp_path, path)
+
+
+
+def load(filename, key_sig_transpose, cache_dir=None):
+    """
+    Gets the cached note arrays of a MIDI file.
+
+    :param filename: Path to the MIDI file.
+    :param key_sig_transpose: The interval the notes need to be transposed by.
+    :param cache_dir: The cache directory, NOTE_CACHE_DIR by default.
+    :return: A list of (track_array, channel, program), or None if it isn't cached (or the MIDI file changed since).
+    """
+
+    path = cache_path(filename, cache_dir)
+
+    try:
+        with np.load(path) as cached:
+            if int(cached["key_sig_transpose"]) != key_sig_transpose or \
+                    not np.array_equal(cached["source"], _source_stamp(filename)):
+                return None
+
+            notes = cached["notes"]
+            track_offsets = cached["track_offsets"]
+            channels = cached["channels"].tolist()
+            programs = cached["programs"].tolist()
+
+    except (OSError, KeyError, ValueError):
+        return None
+
+    return [(notes[track_offsets[i]:track_offsets[i + 1]], channels[i], programs[i]) for i in range(len(channels))]
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+    import pandas as pd
+    from multiprocessing import Pool
+    from src.midi_handlers.midi_file import MidiFileNHot
+    from src.progress import ProgressReporter
+
+    def cache_one(args):
+        filename, note_dist = args
+        mid = MidiFileNHot(filename, note_dist, use_cache=True)
+        try:
+            mid.get_note_arrays()
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except:
+            print("\nERROR -> Skipping invalid file:", filename)
+        return mid.n_notes
+
+    base_dir = argv[1] if len(argv) > 1 else "midi/classical"
+    meta_df = pd.read_csv(os.path.join(base_dir, "meta.csv"), index_col="filename")
+    jobs = list(zip(meta_df.index.values, meta_df[MUSIC_NOTES].values))
+
+    print("Caching the notes of", len(jobs), "files in", os.path.join(NOTE_CACHE_DIR, cache_version()), "...")
+    with Pool() as pool, ProgressReporter("note cache", len(jobs)) as progress:
+        for n_notes in pool.imap_unordered(cache_one, jobs, chunksize=8):
+            progress.update(notes=n_notes)
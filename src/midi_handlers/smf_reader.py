@@ -0,0 +1,344 @@
+# Mark Evers
+# Created: 10/19/2026
+# smf_reader.py
+# Fast Standard MIDI File reader that goes straight from the raw bytes to note arrays
+
+import io
+import struct
+import numpy as np
+import mido
+
+
+
+# one row per note_on/note_off message in a track, in the order they appear in the track
+EVENT_DTYPE = np.dtype([("time", np.int64),     # absolute time in ticks
+                        ("seq", np.int32),      # index of the message in the track
+                        ("note", np.int16),
+                        ("velocity", np.int16),
+                        ("channel", np.int8),
+                        ("on", np.bool_)])      # note_on message (even with velocity 0) vs note_off message
+
+# same names mido uses for the key_signature meta message
+KEY_SIGNATURES_SF = {(-7, 0): 'Cb', (-6, 0): 'Gb', (-5, 0): 'Db', (-4, 0): 'Ab', (-3, 0): 'Eb', (-2, 0): 'Bb',
+                     (-1, 0): 'F', (0, 0): 'C', (1, 0): 'G', (2, 0): 'D', (3, 0): 'A', (4, 0): 'E', (5, 0): 'B',
+                     (6, 0): 'F#', (7, 0): 'C#',
+                     (-7, 1): 'Abm', (-6, 1): 'Ebm', (-5, 1): 'Bbm', (-4, 1): 'Fm', (-3, 1): 'Cm', (-2, 1): 'Gm',
+                     (-1, 1): 'Dm', (0, 1): 'Am', (1, 1): 'Em', (2, 1): 'Bm', (3, 1): 'F#m', (4, 1): 'C#m',
+                     (5, 1): 'G#m', (6, 1): 'D#m', (7, 1): 'A#m'}
+
+
+
+class SmfReadError(Exception):
+    """
+    Raised by the fast reader when a file is malformed or uses something it doesn't handle.  read_midi() falls back to
+    mido when it sees one.
+    """
+    pass
+
+
+
+class SmfTrack:
+    """
+    The notes of one MIDI track.
+    """
+
+    __slots__ = ("index", "events", "end_time", "program")
+
+    def __init__(self, index, events, end_time, program):
+        """
+        :param index: The index of the track in the file.
+        :param events: A numpy array of EVENT_DTYPE.
+        :param end_time: Absolute time of the last message in the track (in ticks).
+        :param program: The last program_change in the track.
+        """
+        self.index = index
+        self.events = events
+        self.end_time = end_time
+        self.program = program
+
+
+
+class SmfFile:
+    """
+    The parts of a MIDI file this project uses.  Only tracks that contain notes are kept in <tracks>, <n_tracks> is the
+    number of tracks in the file.
+    """
+
+    __slots__ = ("filename", "type", "ticks_per_beat", "n_tracks", "tracks", "key_signatures", "time_signatures")
+
+    def __init__(self, filename, type, ticks_per_beat, n_tracks):
+        self.filename = filename
+        self.type = type
+        self.ticks_per_beat = ticks_per_beat
+        self.n_tracks = n_tracks
+        self.tracks = []           # [SmfTrack, ...]
+        self.key_signatures = []   # [(time, track index, seq, key), ...]
+        self.time_signatures = []  # [(time, track index, seq, numerator, denominator, 32nds per beat, clocks per click), ...]
+
+
+
+    def count_notes(self):
+        """
+        :return: How many notes are played in the file (note_on messages with a velocity).
+        """
+        return sum(int((track.events["on"] & (track.events["velocity"] > 0)).sum()) for track in self.tracks)
+
+
+
+def is_buffer(filename):
+    """
+    Whether the "filename" given to a reader is really the contents of a file.
+
+    :param filename: A path or bytes-like object
+    :return: True for bytes-like objects
+    """
+    return isinstance(filename, (bytes, bytearray, memoryview))
+
+
+
+def read_variable_int(data, pos):
+    """
+    Decodes a variable length quantity.
+
+    :param data: The file contents.
+    :param pos: Where the quantity starts.
+    :return: (value, position after the quantity)
+    """
+
+    value = 0
+    for _ in range(4):
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos
+
+    raise SmfReadError("Variable length quantity longer than 4 bytes")
+
+
+
+def read_track(data, pos, end, track_i, smf):
+    """
+    Reads one MTrk chunk.  Note events are returned as an SmfTrack, meta messages we use are added to smf.
+
+    :param data: The file contents.
+    :param pos: Start of the track data (just after the chunk header).
+    :param end: End of the track data.
+    :param track_i: The index of this track.
+    :param smf: The SmfFile being built.
+    :return: An SmfTrack, or None if the track has no note events.
+    """
+
+    times = []
+    seqs = []
+    notes = []
+    velocities = []
+    channels = []
+    ons = []
+    program = 0
+
+    time_now = 0
+    last_status = None
+    seq = 0
+
+    while pos < end:
+
+        delta, pos = read_variable_int(data, pos)
+        time_now += delta
+
+        status = data[pos]
+        if status < 0x80:
+            # running status, the byte we just looked at is the first data byte
+            if last_status is None:
+                raise SmfReadError("Running status without a previous status byte")
+            status = last_status
+        else:
+            pos += 1
+
+        if status == 0xff:
+            meta_type = data[pos]
+            length, pos = read_variable_int(data, pos + 1)
+
+            if meta_type == 0x59:
+                if length != 2:
+                    raise SmfReadError("Bad key_signature length")
+                sf, mi = struct.unpack_from(">bB", data, pos)
+                if (sf, mi) not in KEY_SIGNATURES_SF:
+                    raise SmfReadError("Unknown key signature")
+                smf.key_signatures.append((time_now, track_i, seq, KEY_SIGNATURES_SF[(sf, mi)]))
+
+            elif meta_type == 0x58:
+                if length != 4:
+                    raise SmfReadError("Bad time_signature length")
+                numerator, denominator, clocks, notated_32nds = struct.unpack_from(">BBBB", data, pos)
+                smf.time_signatures.append((time_now, track_i, seq, numerator, 2 ** denominator, notated_32nds, clocks))
+
+            pos += length
+
+        elif status == 0xf0 or status == 0xf7:
+            # sysex, skip it
+            length, pos = read_variable_int(data, pos)
+            pos += length
+
+        elif status >= 0xf0:
+            raise SmfReadError("System common message in a track")
+
+        else:
+            last_status = status
+            kind = status & 0xf0
+
+            if kind == 0x90 or kind == 0x80:
+                note = data[pos]
+                velocity = data[pos + 1]
+                if note > 127 or velocity > 127:
+                    raise SmfReadError("Data byte out of range")
+                pos += 2
+
+                times.append(time_now)
+                seqs.append(seq)
+                notes.append(note)
+                velocities.append(velocity)
+                channels.append(status & 0x0f)
+                ons.append(kind == 0x90)
+
+            elif kind == 0xc0:
+                program = data[pos]
+                if program > 127:
+                    raise SmfReadError("Data byte out of range")
+                pos += 1
+
+            elif kind == 0xd0:
+                if data[pos] > 127:
+                    raise SmfReadError("Data byte out of range")
+                pos += 1
+
+            else:
+                if data[pos] > 127 or data[pos + 1] > 127:
+                    raise SmfReadError("Data byte out of range")
+                pos += 2
+
+        seq += 1
+
+    if pos != end:
+        raise SmfReadError("Track ran past the end of its chunk")
+
+    # meta only tracks stop here without building any arrays
+    if not notes:
+        return None
+
+    events = np.empty(len(notes), dtype=EVENT_DTYPE)
+    events["time"] = times
+    events["seq"] = seqs
+    events["note"] = notes
+    events["velocity"] = velocities
+    events["channel"] = channels
+    events["on"] = ons
+
+    return SmfTrack(track_i, events, time_now, program)
+
+
+
+def read_midi_fast(filename):
+    """
+    Reads a MIDI file directly from its bytes.
+
+    :param filename: Path to the MIDI file, or the contents of one as bytes.
+    :return: An SmfFile
+    """
+
+    if is_buffer(filename):
+        data = memoryview(filename)
+        filename = None
+    else:
+        with open(filename, "rb") as f:
+            data = memoryview(f.read())
+
+    try:
+        chunk, header_size, type, n_tracks, division = struct.unpack_from(">4sLHHH", data, 0)
+        if chunk != b"MThd" or header_size < 6:
+            raise SmfReadError("No MThd header")
+        if division & 0x8000:
+            raise SmfReadError("SMPTE time division")
+
+        smf = SmfFile(filename, type, division, n_tracks)
+
+        pos = 8 + header_size
+        for track_i in range(n_tracks):
+
+            chunk, size = struct.unpack_from(">4sL", data, pos)
+            if chunk != b"MTrk":
+                raise SmfReadError("No MTrk header")
+            pos += 8
+            if pos + size > len(data):
+                raise SmfReadError("Truncated track")
+
+            track = read_track(data, pos, pos + size, track_i, smf)
+            if track is not None:
+                smf.tracks.append(track)
+
+            pos += size
+
+    except (IndexError, struct.error):
+        raise SmfReadError("Unexpected end of file")
+
+    return smf
+
+
+
+def read_midi_mido(filename):
+    """
+    Reads a MIDI file with mido into the same structure as read_midi_fast().
+
+    :param filename: Path to the MIDI file, or the contents of one as bytes.
+    :return: An SmfFile
+    """
+
+    if is_buffer(filename):
+        mid = mido.MidiFile(file=io.BytesIO(filename))
+        filename = None
+    else:
+        mid = mido.MidiFile(filename)
+    smf = SmfFile(filename, mid.type, mid.ticks_per_beat, len(mid.tracks))
+
+    for track_i, track in enumerate(mid.tracks):
+
+        rows = []
+        program = 0
+        time_now = 0
+
+        for seq, msg in enumerate(track):
+            time_now += msg.time
+
+            if msg.type == "note_on" or msg.type == "note_off":
+                rows.append((time_now, seq, msg.note, msg.velocity, msg.channel, msg.type == "note_on"))
+            elif msg.type == "program_change":
+                program = msg.program
+            elif msg.type == "key_signature":
+                smf.key_signatures.append((time_now, track_i, seq, msg.key))
+            elif msg.type == "time_signature":
+                smf.time_signatures.append((time_now, track_i, seq, msg.numerator, msg.denominator,
+                                            msg.notated_32nd_notes_per_beat, msg.clocks_per_click))
+
+        if rows:
+            smf.tracks.append(SmfTrack(track_i, np.array(rows, dtype=EVENT_DTYPE), time_now, program))
+
+    return smf
+
+
+
+def read_midi(filename, fast=True):
+    """
+    Reads a MIDI file into an SmfFile.  The fast reader is tried first, anything it doesn't handle is read by mido.
+
+    :param filename: Path to the MIDI file, or the contents of one as bytes.
+    :param fast: Whether to try the fast reader at all.
+    :return: An SmfFile
+    """
+
+    if fast:
+        try:
+            return read_midi_fast(filename)
+        except SmfReadError:
+            pass
+
+    return read_midi_mido(filename)
@@ -0,0 +1,103 @@
+# Mark Evers
+# Created: 10/19/2026
+# transposition.py
+# Vectorized key signature and octave transposition of note arrays
+
+import numpy as np
+
+from src.globals import get_key_sig
+
+
+
+DRUM_CHANNEL = 9
+# the octave every track gets moved to (C4 is middle C)
+TARGET_OCTAVE = 4
+
+
+
+def drum_mask(channels):
+    """
+    Gets which notes are on the drum channel.  Drum notes are instruments, not pitches, so they are never transposed.
+
+    :param channels: A numpy array of MIDI channels
+    :return: A boolean numpy array, True where the note is a drum
+    """
+    return np.asarray(channels) == DRUM_CHANNEL
+
+
+
+def transpose_notes(notes, channels, interval):
+    """
+    Transposes an array of notes by interval, leaving drum notes alone.
+
+    :param notes: A numpy array of MIDI notes
+    :param channels: A numpy array of MIDI channels the same shape as notes
+    :param interval: The interval to transpose by.  Either a single int or an array that broadcasts against notes
+    :return: A new numpy array of transposed notes
+    """
+    return np.where(drum_mask(channels), notes, notes + interval)
+
+
+
+def keysig_transpose_interval(note_dist):
+    """
+    Gets the interval that transposes a piece into C/Am.
+
+    :param note_dist: The piece's distribution of MUSIC_NOTES.
+    :return: The interval in semitones, between -5 and 6
+    """
+
+    key_sig = get_key_sig(note_dist)
+
+    if key_sig < 6:
+        return -key_sig
+    else:
+        return 12 - key_sig
+
+
+
+def octave_histogram(notes):
+    """
+    Counts how many notes fall in each octave.  Index 0 is octave -1 (MIDI notes 0-11), so octave = index - 1, the same
+    as midi_to_music().
+
+    :param notes: A numpy array of MIDI notes
+    :return: A numpy array of counts, one per octave
+    """
+
+    # anything below note 0 gets counted with the lowest octave
+    return np.bincount(np.clip(np.floor_divide(notes, 12), 0, None).astype(np.int64))
+
+
+
+def octave_transpose_interval(octave_counts):
+    """
+    Gets the interval that moves the most common octave to TARGET_OCTAVE.
+
+    :param octave_counts: An octave histogram from octave_histogram()
+    :return: The interval in semitones
+    """
+
+    most_common_octave = int(np.argmax(octave_counts)) - 1
+    return (TARGET_OCTAVE - most_common_octave) * 12
+
+
+
+def transpose_track_array(track_array, key_sig_transpose):
+    """
+    Transposes a note array into C/Am and to the middle C octave in place.  The octave histogram is taken after the key
+    signature transpose, then both shifts are applied to the pitch column as one add.
+
+    :param track_array: A numpy array of NOTE_DTYPE
+    :param key_sig_transpose: The interval to transpose into C/Am
+    :return: The octave histogram of the key transposed notes
+    """
+
+    not_drums = ~drum_mask(track_array["channel"])
+    octave_counts = octave_histogram(np.where(not_drums, track_array["note"] + key_sig_transpose, track_array["note"]))
+    interval = key_sig_transpose + octave_transpose_interval(octave_counts)
+
+    if interval:
+        track_array["note"][not_drums] += interval
+
+    return octave_counts
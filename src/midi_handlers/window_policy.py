@@ -0,0 +1,143 @@
+# Mark Evers
+# Created: 10/19/2026
+# window_policy.py
+# Caps how many windows MidiFileBase.to_X() makes of a file, so a few huge scores can't dominate encoding and training
+
+import hashlib
+import numpy as np
+
+from src.globals import *
+
+
+
+class WindowPolicy:
+    """
+    Which of a file's windows to keep:
+
+    - tracks with fewer than min_track_notes notes are skipped, unless none has that many, then only the track with the
+      most notes is kept
+    - each track keeps at most max_per_track windows, then the file keeps at most max_per_file
+    - "uniform" sampling picks the windows at random, "stratified" splits them into equal runs in the order they come in
+      the piece and picks one from each run, so the sample covers the whole piece
+
+    The sampling is seeded by the filename, so a file gets the same windows every time it's encoded (count_windows()
+    and write_X() have to agree).  The windows that are kept stay in to_X()'s order.
+    """
+
+    SAMPLING = ("uniform", "stratified")
+
+    def __init__(self, max_per_file=WINDOW_MAX_PER_FILE, max_per_track=WINDOW_MAX_PER_TRACK,
+                 sampling=WINDOW_SAMPLING, min_track_notes=WINDOW_MIN_TRACK_NOTES, seed=WINDOW_SEED):
+        """
+        :param max_per_file: The most windows a file keeps, None for no limit.
+        :param max_per_track: The most windows a track keeps, None for no limit.
+        :param sampling: "uniform" or "stratified".
+        :param min_track_notes: Tracks with fewer notes are skipped, 0 keeps them all.
+        :param seed: Mixed with each filename to seed the sampling.
+        """
+
+        if sampling not in self.SAMPLING:
+            raise ValueError("sampling must be one of " + ", ".join(self.SAMPLING))
+        for name, limit in (("max_per_file", max_per_file), ("max_per_track", max_per_track)):
+            if limit is not None and limit < 1:
+                raise ValueError("{} must be at least 1, or None for no limit".format(name))
+
+        self.max_per_file = max_per_file
+        self.max_per_track = max_per_track
+        self.sampling = sampling
+        self.min_track_notes = min_track_notes
+        self.seed = seed
+
+
+
+    def __repr__(self):
+        return "WindowPolicy(max_per_file={}, max_per_track={}, sampling={!r}, min_track_notes={}, seed={})".format(
+            self.max_per_file, self.max_per_track, self.sampling, self.min_track_notes, self.seed)
+
+
+
+    def keeps_everything(self):
+        """
+        :return: Whether select() always returns every window
+        """
+        return self.max_per_file is None and self.max_per_track is None and not self.min_track_notes
+
+
+
+    def random_state(self, key):
+        """
+        :param key: The filename, or the contents of the file if it was passed in as bytes.
+        :return: A numpy RandomState that only depends on the key and the seed
+        """
+
+        key = key.encode("utf-8", "surrogateescape") if isinstance(key, str) else bytes(key)
+        digest = int.from_bytes(hashlib.md5(key).digest()[:4], "big")
+
+        return np.random.RandomState([self.seed, digest])
+
+
+
+    def sample(self, n, k, random_state):
+        """
+        Picks k of n things that are in order.
+
+        :param n: How many there are.
+        :param k: How many to pick, at most n.
+        :param random_state: A numpy RandomState.
+        :return: A sorted numpy array of k indexes
+        """
+
+        if self.sampling == "uniform":
+            return np.sort(random_state.choice(n, k, replace=False))
+
+        # k runs of n / k, every run has at least one
+        edges = np.linspace(0, n, k + 1).astype(np.int64)
+        return np.array([random_state.randint(edges[i], edges[i + 1]) for i in range(k)], dtype=np.int64)
+
+
+
+    def select(self, track_bounds, track_notes, key):
+        """
+        Picks the windows to keep.
+
+        :param track_bounds: Each track's windows, from window_bounds().
+        :param track_notes: How many notes each track has.
+        :param key: The filename, see random_state().
+        :return: Each track's windows to keep, a list of (start step, length) like window_bounds()
+        """
+
+        if self.keeps_everything():
+            return track_bounds
+
+        selected = [list(bounds) for bounds in track_bounds]
+
+        if self.min_track_notes:
+            with_windows = [i for i, bounds in enumerate(selected) if bounds]
+            kept = [i for i in with_windows if track_notes[i] >= self.min_track_notes]
+            if not kept and with_windows:
+                kept = [max(with_windows, key=lambda i: track_notes[i])]
+            selected = [bounds if i in kept else [] for i, bounds in enumerate(selected)]
+
+        random_state = self.random_state(key)
+
+        if self.max_per_track is not None:
+            for i, bounds in enumerate(selected):
+                if len(bounds) > self.max_per_track:
+                    selected[i] = [bounds[j] for j in self.sample(len(bounds), self.max_per_track, random_state)]
+
+        n_windows = sum(len(bounds) for bounds in selected)
+        if self.max_per_file is not None and n_windows > self.max_per_file:
+
+            # every window by how far into its track it is, so the runs of "stratified" go through the piece once
+            # instead of through each track in turn
+            windows = []
+            for i, bounds in enumerate(selected):
+                n_steps = max(start + length for start, length in track_bounds[i]) if bounds else 1
+                windows.extend(((start + length / 2) / n_steps, i, j) for j, (start, length) in enumerate(bounds))
+            windows.sort()
+
+            keep = set((i, j) for position, i, j in
+                       (windows[w] for w in self.sample(len(windows), self.max_per_file, random_state)))
+            selected = [[window for j, window in enumerate(bounds) if (i, j) in keep] for i, bounds in enumerate(selected)]
+
+        return selected
@@ -5,9 +5,10 @@
 
 import numpy as np
 from keras.models import Sequential, model_from_json
-from keras.layers import LSTM, Dense, Dropout
+from keras.layers import LSTM, RNN, Dense, Dropout, Masking
 from keras.wrappers.scikit_learn import KerasClassifier
-from keras.callbacks import Callback
+from keras.optimizers import Adam
+from keras import backend as K
 from keras.utils import plot_model
 from sklearn.model_selection import cross_val_score
 from sklearn.metrics import precision_recall_fscore_support
@@ -19,6 +20,15 @@ from src.globals import *
 from src.file_handlers.dataset import VectorGetterNHot
 from src.midi_handlers.midi_file import MidiFileNHot
 from src.file_handlers.midi_archive import MidiArchive
+from src.file_handlers.shared_corpus import attach_from_file
+from src.file_handlers.bucketing import bucketed_generator
+from src.file_handlers.augmentation import augmented_generator, augment_batch
+from src.file_handlers.stateful import split_windows, stateful_batches
+from src.embedding_bag import EmbeddingBag, BagLSTMCell
+from src.checkpoint import TrainingCheckpoint
+from src.training_controller import TrainingController
+from src.progress import ProgressReporter
+from src.batch_predict import save_encoding
 
 # fix random seed for reproducibility
 # np.random.seed(777)
@@ -27,18 +37,54 @@ from src.file_handlers.midi_archive import MidiArchive
 
 
 
-def create_model(_dataset):
+def create_model(_dataset, ragged=False, stateful_batch_size=None, units=(665, 444, 222), dropout=(.555, .333, .111),
+                 learning_rate=None):
+    """
+    Creates the LSTM classifier.
+
+    :param _dataset: The VectorGetter it will be trained on.
+    :param ragged: Accept batches with any number of timesteps and mask out all-zero (padding) steps, for length
+                   bucketed training.  Only use it with the n-hot encoders, in a time series rests are all zeros too.
+    :param stateful_batch_size: Make the LSTMs stateful with this fixed batch size, so each lane of the batch carries
+                                its state over to the next batch (see predict_stateful()).
+    :param units: The units of each LSTM, the model gets one LSTM per entry.
+    :param dropout: The dropout after each LSTM.
+    :param learning_rate: Adam's learning rate, None for keras' default.
+    :return: A compiled keras model
+    """
+
+    stateful = bool(stateful_batch_size)
+
+    # the index encoders have max_polyphony feature indexes per step instead of n_features
+    step_shape = (_dataset.max_polyphony or _dataset.n_features,)
+    if ragged:
+        input_shape = {"input_shape": (None,) + step_shape}
+    elif stateful:
+        input_shape = {"batch_input_shape": (stateful_batch_size, NUM_STEPS) + step_shape}
+    else:
+        input_shape = {"input_shape": (NUM_STEPS,) + step_shape}
 
     # CREATE THE _model
     _model = Sequential()
-    _model.add(LSTM(units=665, input_shape=(NUM_STEPS, _dataset.n_features), return_sequences=True))
-    _model.add(Dropout(.555))
-    _model.add(LSTM(units=444, return_sequences=True))
-    _model.add(Dropout(.333))
-    _model.add(LSTM(222))
-    _model.add(Dropout(.111))
+    if _dataset.max_polyphony:
+        # the bag is the first LSTM's input kernel, summing its rows for the active features is the n-hot matmul
+        _model.add(EmbeddingBag(_dataset.n_features + 1, 4 * units[0], **input_shape))
+        input_shape = {}
+    if ragged:
+        _model.add(Masking(mask_value=0, **input_shape))
+        input_shape = {}
+    for i, (n_units, rate) in enumerate(zip(units, dropout)):
+        # every LSTM but the last passes on the whole sequence
+        return_sequences = i < len(units) - 1
+        if i == 0 and _dataset.max_polyphony:
+            _model.add(RNN(BagLSTMCell(n_units), return_sequences=return_sequences, stateful=stateful))
+        else:
+            _model.add(LSTM(units=n_units, return_sequences=return_sequences, stateful=stateful, **input_shape))
+        _model.add(Dropout(rate))
+        input_shape = {}
     _model.add(Dense(units=_dataset.n_composers, activation='softmax'))
-    _model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['categorical_accuracy'])
+    optimizer = Adam(lr=learning_rate) if learning_rate else 'adam'
+    _model.compile(loss='categorical_crossentropy', optimizer=optimizer, metrics=['categorical_accuracy'])
     print(_model.summary())
 
     return _model
@@ -50,7 +96,7 @@ def load_from_disk(filename):
     # load json and create _model
     with open(filename + '.json', 'r') as f:
         json_str = f.read()
-    _model = model_from_json(json_str)
+    _model = model_from_json(json_str, custom_objects={"EmbeddingBag": EmbeddingBag, "BagLSTMCell": BagLSTMCell})
     # load weights into new _model
     _model.load_weights(filename + ".h5")
     print("Loaded model from disk")
@@ -59,7 +105,7 @@ def load_from_disk(filename):
 
 
 
-def save_to_disk(_model, filename):
+def save_to_disk(_model, filename, _dataset=None):
 
     print("Saving model to disk")
     # serialize _model to JSON
@@ -68,13 +114,27 @@ def save_to_disk(_model, filename):
         json_file.write(_model_json)
     # serialize weights to HDF5
     _model.save_weights(filename + ".h5")
+    # how to encode its inputs, for batch_predict and the webapp
+    if _dataset is not None:
+        save_encoding(filename, _dataset)
+
 
 
+def fit_model(_dataset, _model, bucketed=False, augment=AUGMENT_TRANSPOSE):
+    """
+    Trains a model on the whole dataset.
 
-def fit_model(_dataset, _model):
+    :param _dataset: The VectorGetter.
+    :param _model: The model.  Needs create_model(ragged=True) when bucketed.
+    :param bucketed: Train on batches of windows with similar lengths, only padded to the longest window in the batch.
+    :param augment: Randomly transpose the training windows every epoch, see augmentation.py.
+    :return: The model
+    """
 
     logfile = "models/final.txt"
-    X_train, X_test, y_train, y_test = _dataset.get_all_split()
+    X_train, X_test, y_train, y_test, lengths_train, lengths_test, drums_train, drums_test = \
+        _dataset.get_all_split(return_lengths=True, return_drums=True, hold_out_validation=True)
+    controller = TrainingController(lambda m: eval_file_accuracy(_dataset, m, split="validation"))
 
     # FIT THE _model
     print("Training model...")
@@ -82,9 +142,30 @@ def fit_model(_dataset, _model):
         f.write("***Model***\n")
         f.write("Neurons: 666 -> 444 -> 222\n")
         f.write("Dropout: .555 -> .333 -> .111\n")
-
-
-    history = _model.fit(X_train, y_train, validation_data=(X_test, y_test), epochs=N_EPOCHS, batch_size=BATCH_SIZE)
+        f.write("Windows: {}\n".format(_dataset.get_window_policy()))
+
+    train_generator = None
+    if augment:
+        # logged, so the same intervals and batches can be drawn again
+        seed = int(np.random.randint(2 ** 31))
+        train_generator = augmented_generator(X_train, y_train, drums_train, lengths_train if bucketed else None,
+                                              seed=seed, max_polyphony=_dataset.max_polyphony)
+        with open(logfile, "a") as f:
+            f.write("Transposition augmentation: up to {} semitones, seed {}\n".format(AUGMENT_MAX_SHIFT, seed))
+
+
+    if bucketed:
+        history = _model.fit_generator(train_generator or bucketed_generator(X_train, y_train, lengths_train),
+                                       steps_per_epoch=int(np.ceil(len(lengths_train) / BATCH_SIZE)),
+                                       validation_data=bucketed_generator(X_test, y_test, lengths_test),
+                                       validation_steps=int(np.ceil(len(lengths_test) / BATCH_SIZE)), epochs=N_EPOCHS,
+                                       callbacks=[controller])
+    elif augment:
+        history = _model.fit_generator(train_generator, steps_per_epoch=int(np.ceil(len(y_train) / BATCH_SIZE)),
+                                       validation_data=(X_test, y_test), epochs=N_EPOCHS, callbacks=[controller])
+    else:
+        history = _model.fit(X_train, y_train, validation_data=(X_test, y_test), epochs=N_EPOCHS, batch_size=BATCH_SIZE,
+                             callbacks=[controller])
 
     with open(logfile, "a") as f:
         f.write(str(history))
@@ -96,6 +177,125 @@ def fit_model(_dataset, _model):
 
 
 
+def checkpointed_fit_model(_dataset, _model, checkpoint, state=None):
+    """
+    Trains a model BATCH_FILES training files at a time, saving a checkpoint every CHECKPOINT_EVERY batches and at the
+    end of every chunk of files.  The file order of each epoch and the window order of each chunk come from seeds
+    derived from state["seed"], so a resumed run sees exactly the batches the interrupted one would have.  A
+    TrainingController runs at the end of every epoch and its state goes in the checkpoint too.  With
+    AUGMENT_TRANSPOSE each batch is transposed with a seed derived the same way.
+
+    :param _dataset: The VectorGetter.
+    :param _model: The model.
+    :param checkpoint: A TrainingCheckpoint.
+    :param state: The cursor from TrainingCheckpoint.load() to resume from, None to start from the beginning.
+    :return: The model
+    """
+
+    logfile = "models/final.txt"
+    if state is None:
+        state = {"epoch": 0, "chunk_i": 0, "batch_i": 0, "seed": int(np.random.randint(2 ** 31))}
+    seed = state["seed"]
+
+    controller = TrainingController(lambda m: eval_file_accuracy(_dataset, m, split="validation"))
+    controller.set_model(_model)
+    controller.restore(state.get("controller"))
+    _model.stop_training = controller.stopped_epoch is not None
+
+    print("Training model...")
+
+    for epoch in range(state["epoch"], N_EPOCHS):
+
+        if _model.stop_training:
+            break
+
+        print("EPOCH", epoch + 1, "/", N_EPOCHS)
+        controller.on_epoch_begin(epoch)
+
+        _dataset.shuffle_train_files(np.random.RandomState([seed, epoch]))
+        _dataset.reset_chunks()
+        first_batch_i = 0
+        if epoch == state["epoch"]:
+            _dataset.last_train_chunk_i = state["chunk_i"]
+            first_batch_i = state["batch_i"]
+
+        losses = []
+        while _dataset.last_train_chunk_i < _dataset.get_n_fit_files():
+
+            chunk_i = _dataset.last_train_chunk_i
+            X, y, drums = _dataset.get_chunk(BATCH_FILES, "train", return_drums=True)
+            shuffled_i = np.random.RandomState([seed, epoch, chunk_i]).permutation(X.shape[0])
+            X = X[shuffled_i]
+            y = y[shuffled_i]
+            drums = drums[shuffled_i]
+
+            n_batches = int(np.ceil(X.shape[0] / BATCH_SIZE))
+            progress = ProgressReporter("train", n_batches - first_batch_i, unit="batches")
+            for batch_i in range(first_batch_i, n_batches):
+                X_batch = X[batch_i * BATCH_SIZE:(batch_i + 1) * BATCH_SIZE]
+                if AUGMENT_TRANSPOSE:
+                    X_batch = augment_batch(X_batch, drums[batch_i * BATCH_SIZE:(batch_i + 1) * BATCH_SIZE],
+                                            np.random.RandomState([seed, epoch, chunk_i, batch_i]),
+                                            max_polyphony=_dataset.max_polyphony)
+                loss = _model.train_on_batch(X_batch, y[batch_i * BATCH_SIZE:(batch_i + 1) * BATCH_SIZE])
+                losses.append(loss)
+                progress.update(text=str(loss), windows=BATCH_SIZE)
+
+                if not (batch_i + 1) % CHECKPOINT_EVERY and batch_i + 1 < n_batches:
+                    checkpoint.save(_model, {"epoch": epoch, "chunk_i": chunk_i, "batch_i": batch_i + 1, "seed": seed,
+                                             "controller": controller.state()})
+            progress.close()
+
+            first_batch_i = 0
+            if _dataset.last_train_chunk_i < _dataset.get_n_fit_files():
+                checkpoint.save(_model, {"epoch": epoch, "chunk_i": _dataset.last_train_chunk_i, "batch_i": 0, "seed": seed,
+                                         "controller": controller.state()})
+
+        controller.on_epoch_end(epoch, {"loss": np.mean(losses, axis=0)} if losses else None)
+        checkpoint.save(_model, {"epoch": epoch + 1, "chunk_i": 0, "batch_i": 0, "seed": seed,
+                                 "controller": controller.state()})
+        with open(logfile, "a") as f:
+            f.write("EPOCH {}: {}\n".format(epoch + 1, np.mean(losses, axis=0) if losses else None))
+
+        print()  # newline
+
+
+    return _model
+
+
+
+def checkpointed_training(checkpoint_dir=CHECKPOINT_DIR, resume=False):
+    """
+    Trains the final model with checkpoints, or picks up an interrupted run where it left off.
+
+    :param checkpoint_dir: Where the checkpoint is kept.
+    :param resume: Continue from the checkpoint in checkpoint_dir instead of starting over.
+    :return: The model
+    """
+
+    checkpoint = TrainingCheckpoint(checkpoint_dir)
+
+    if resume:
+        if not checkpoint.exists():
+            print("No checkpoint in", checkpoint_dir)
+            return None
+        dataset = checkpoint.load_dataset()
+        model = create_model(dataset)
+        state = checkpoint.load(model)
+
+    else:
+        dataset = VectorGetterNHot("midi/classical")
+        model = create_model(dataset)
+        checkpoint.save_dataset(dataset)
+        state = None
+
+    model = checkpointed_fit_model(dataset, model, checkpoint, state)
+    save_to_disk(model, "models/final", dataset)
+
+    return model
+
+
+
 def kfold_eval(_dataset):
 
     X, y = _dataset.get_all()
@@ -109,15 +309,30 @@ def kfold_eval(_dataset):
 
 
 
-def predict_one_file(_model, filename, _dataset=None):
+def predict_one_file(_model, filename, _dataset=None, window_policy=None):
+    """
+    Classifies a file by summing the predictions of its windows.
+
+    :param _model: The model.
+    :param filename: The file.
+    :param _dataset: The VectorGetter, for the file's encoder, note distribution and window policy.  Without one the
+                     file is n-hot encoded.
+    :param window_policy: The WindowPolicy to pick the windows with, None for the dataset's (or the globals' without a
+                          dataset).
+    :return: The predicted composer's index and the normed probabilities
+    """
 
     if _dataset:
-        note_dist = _dataset.meta_df.loc[filename][MUSIC_NOTES].values
+        note_dist = _dataset.get_note_dist(filename)
+        window_policy = window_policy or _dataset.get_window_policy()
+        file_converter, X_dtype = _dataset.file_converter, _dataset.X_dtype
     else:
         note_dist = MidiArchive.parse_midi_meta(filename)[14:]
+        file_converter, X_dtype = MidiFileNHot, np.byte
 
-    mid = MidiFileNHot(filename, note_dist)
-    X = np.array(mid.to_X(), dtype=np.byte)
+    # only the dataset's files are cached, not uploads
+    mid = file_converter(filename, note_dist, window_policy=window_policy, use_cache=_dataset is not None)
+    X = np.array(mid.to_X(), dtype=X_dtype)
 
     y_pred = _model.predict(X)
     sum_probs = y_pred.sum(axis=0)
@@ -129,16 +344,215 @@ def predict_one_file(_model, filename, _dataset=None):
 
 
 
-def eval_file_accuracy(_dataset, _model):
+def to_stateful(_model, _dataset, batch_size=BATCH_SIZE):
+    """
+    Copies a trained model's weights into a stateful model with the same layers.
+
+    :param _model: The trained model.
+    :param _dataset: The VectorGetter it was trained on.
+    :param batch_size: How many tracks the stateful model runs side by side.
+    :return: The stateful model
+    """
+
+    stateful_model = create_model(_dataset, stateful_batch_size=batch_size)
+    stateful_model.set_weights(_model.get_weights())
+
+    return stateful_model
+
+
+
+def reset_lanes(_model, lanes):
+    """
+    Zeros the LSTM states of some lanes of a stateful model's batch, leaving the other lanes alone.  model.reset_states()
+    can only reset all of them.
+
+    :param _model: A stateful model.
+    :param lanes: The lanes to reset.
+    :return: None
+    """
+
+    if not len(lanes):
+        return
+
+    for layer in _model.layers:
+        if getattr(layer, "stateful", False):
+            for state in layer.states:
+                value = K.get_value(state)
+                value[lanes] = 0
+                K.set_value(state, value)
+
 
-    y = _dataset.y_test_filenames
-    y_pred = [predict_one_file(_model, filename, _dataset)[0] for filename in _dataset.X_test_filenames]
+
+def predict_stateful(_model, track_windows):
+    """
+    Runs a stateful model over whole tracks.  Each track goes through its back to back windows in one lane of the batch,
+    so every step is seen once and the LSTMs remember everything before the current window.  A lane's state is reset
+    when it starts a new track.
+
+    :param _model: A model from to_stateful().
+    :param track_windows: A list of windows per track, from stateful.split_windows().
+    :return: A numpy array of the summed window probabilities of each track, shape (n_tracks, n_composers)
+    """
+
+    batch_size = _model.input_shape[0]
+    sum_probs = np.zeros((len(track_windows), _model.output_shape[-1]))
+
+    _model.reset_states()
+    for X, lane_tracks, new_lanes in stateful_batches(track_windows, batch_size):
+        reset_lanes(_model, new_lanes)
+        y_pred = _model.predict_on_batch(X)
+        playing = lane_tracks >= 0
+        sum_probs[lane_tracks[playing]] += y_pred[playing]
+
+    return sum_probs
+
+
+
+def predict_files_stateful(_model, filenames, _dataset=None):
+    """
+    Classifies files with a stateful model.  The tracks of all the files share the batch lanes.
+
+    :param _model: A model from to_stateful().
+    :param filenames: The files.
+    :param _dataset: The VectorGetter the model was trained on, for the encoder and the note distributions.  Without
+                     one the files are n-hot encoded and their note distributions are read from them.
+    :return: A list of (predicted label index, normed probabilities), one per file
+    """
+
+    track_windows = []
+    track_files = []
+    if _dataset:
+        file_converter, X_dtype = _dataset.file_converter, _dataset.X_dtype
+    else:
+        file_converter, X_dtype = MidiFileNHot, np.byte
+
+    with ProgressReporter("encode", len(filenames)) as progress:
+        for file_i, filename in enumerate(filenames):
+            if _dataset:
+                note_dist = _dataset.get_note_dist(filename)
+            else:
+                note_dist = MidiArchive.parse_midi_meta(filename)[14:]
+
+            # the same encoding fit_stateful() trains on
+            mid = file_converter(filename, note_dist, use_cache=_dataset is not None)
+            sequences = mid.to_sequences()
+            track_windows.extend(split_windows(sequence.astype(X_dtype, copy=False)) for sequence in sequences)
+            track_files.extend([file_i] * len(sequences))
+            progress.update(notes=mid.n_notes)
+
+    sum_probs = np.zeros((len(filenames), _model.output_shape[-1]))
+    if track_windows:
+        np.add.at(sum_probs, np.array(track_files), predict_stateful(_model, track_windows))
+
+    totals = sum_probs.sum(axis=1, keepdims=True)
+    normed_probs = sum_probs / np.where(totals, totals, 1)
+
+    return [(np.argmax(probs), probs) for probs in normed_probs]
+
+
+
+def fit_stateful(_dataset, _model, epochs=N_EPOCHS, prefix="models/stateful"):
+    """
+    Trains a stateful model on whole tracks, BATCH_FILES training files at a time.  Every window of a track is trained on
+    the file's composer with the state carried over from the track's previous windows (truncated backpropagation
+    through time, NUM_STEPS steps at a time).  Empty lanes get a sample weight of 0.  The validation files aren't
+    trained on, a TrainingController scores them statefully at the end of every epoch.
+
+    :param _dataset: The VectorGetter.
+    :param _model: A model from create_model(stateful_batch_size=...).
+    :param epochs: The most epochs to train for.
+    :param prefix: Where the TrainingController keeps the best weights and the history.
+    :return: The model
+    """
+
+    batch_size = _model.input_shape[0]
+    labels = np.eye(_dataset.n_composers, dtype=np.byte)
+
+    controller = TrainingController(lambda m: eval_file_accuracy(_dataset, m, stateful=True, split="validation"),
+                                    prefix=prefix)
+    controller.set_model(_model)
+    _model.stop_training = False
+
+    for epoch in range(epochs):
+
+        if _model.stop_training:
+            break
+
+        print("EPOCH", epoch + 1, "/", epochs)
+        controller.on_epoch_begin(epoch)
+        order = np.random.permutation(_dataset.get_n_fit_files())
+        progress = ProgressReporter("train", order.size)
+        losses = []
+
+        for chunk_start in range(0, order.size, BATCH_FILES):
+
+            track_windows = []
+            track_labels = []
+            for file_i in order[chunk_start:chunk_start + BATCH_FILES]:
+                filename = _dataset.X_train_filenames[file_i]
+                sequences = _dataset.file_converter(filename, _dataset.get_note_dist(filename),
+                                                    use_cache=True).to_sequences()
+                track_windows.extend(split_windows(sequence.astype(_dataset.X_dtype, copy=False))
+                                     for sequence in sequences)
+                track_labels.extend([_dataset.y_train_filenames[file_i]] * len(sequences))
+
+            if not track_windows:
+                progress.update(len(order[chunk_start:chunk_start + BATCH_FILES]))
+                continue
+            y = labels[_dataset.y_label_encoder.transform(track_labels)]
+
+            loss = None
+            _model.reset_states()
+            for X, lane_tracks, new_lanes in stateful_batches(track_windows, batch_size):
+                reset_lanes(_model, new_lanes)
+                playing = lane_tracks >= 0
+                y_batch = np.zeros((batch_size, _dataset.n_composers), dtype=np.byte)
+                y_batch[playing] = y[lane_tracks[playing]]
+                loss = _model.train_on_batch(X, y_batch, sample_weight=playing.astype(np.float32))
+                losses.append(loss)
+
+            progress.update(len(order[chunk_start:chunk_start + BATCH_FILES]), text=str(loss), windows=sum(len(windows) for windows in track_windows))
+
+        progress.close()
+        controller.on_epoch_end(epoch, {"loss": np.mean(losses, axis=0)} if losses else None)
+
+
+    return _model
+
+
+
+def eval_file_accuracy(_dataset, _model, stateful=False, split="test"):
+    """
+    Classifies the test files (or the validation files) and prints the file level metrics.
+
+    :param _dataset: The VectorGetter.
+    :param _model: The model.
+    :param stateful: _model is a stateful model from to_stateful().
+    :param split: "test" to report on, "validation" to pick epochs and tune on while training.
+    :return: accuracy, precision, recall, fscore
+    """
+
+    if split == "test":
+        X, y = _dataset.X_test_filenames, _dataset.y_test_filenames
+    elif split == "validation":
+        X, y = _dataset.get_validation_files()
+    else:
+        raise ValueError("split must be either 'test' or 'validation'.")
+
+    if stateful:
+        y_pred = [result for result, probs in predict_files_stateful(_model, X, _dataset)]
+    else:
+        y_pred = []
+        with ProgressReporter("evaluate", len(X)) as progress:
+            for filename in X:
+                y_pred.append(predict_one_file(_model, filename, _dataset)[0])
+                progress.update()
     y_pred_labels = np.array([_dataset.composers[row] for row in y_pred])
 
     accuracy = (y == y_pred_labels).sum() / len(y)
     precision, recall, fscore, support = precision_recall_fscore_support(y, y_pred_labels, labels=_dataset.composers)
 
-    print("\nModel Metrics:")
+    print("\nModel Metrics ({} files):".format(split))
     print("Accuracy: ", accuracy)
     print("Precision:", precision)
     print("Recall:   ", recall)
@@ -149,26 +563,6 @@ def eval_file_accuracy(_dataset, _model):
 
 
 
-class FileAccuracyCallback(Callback):
-
-    def __init__(self, _dataset):
-        super().__init__()
-        self.dataset = _dataset
-        self.history = []
-        self.best_accuracy = 0
-
-    def on_epoch_end(self, epoch, logs=None):
-
-        accuracy, precision, recall, fscore = eval_file_accuracy(self.dataset, self.model)
-        self.history.append((accuracy, precision, recall, fscore))
-
-        # if accuracy > self.best_accuracy:
-        #     print("Saving new best accuracy (", accuracy, ")")
-        self.model.save_weights("models/final_{0:02d}-{1:.2f}.h5".format(epoch + 1, accuracy))
-        self.best_accuracy = accuracy
-
-
-
 def epoch_gridsearch():
 
     if os.path.exists("midi/classical/dataset.pkl"):
@@ -181,29 +575,73 @@ def epoch_gridsearch():
             pickle.dump(dataset, f)
 
 
-    X_train, X_test, y_train, y_test = dataset.get_all_split()
-    file_accuracy = FileAccuracyCallback(dataset)
+    # attach to the corpus if shared_corpus.py is already serving it, otherwise encode it ourselves.  Either way the
+    # validation files aren't trained on.
+    if os.path.exists("midi/classical/shared_corpus.json"):
+        corpus = attach_from_file("midi/classical/shared_corpus.json")
+        n_fit_windows = int(corpus.file_offsets[dataset.get_n_fit_files()])
+        X_train, X_test, y_train, y_test = corpus.split()
+        X_train, y_train = X_train[:n_fit_windows], y_train[:n_fit_windows]
+    else:
+        X_train, X_test, y_train, y_test = dataset.get_all_split(hold_out_validation=True)
+    controller = TrainingController(lambda m: eval_file_accuracy(dataset, m, split="validation"))
 
     model = create_model(dataset)
     with open("models/final.json", "w") as f:
         f.write(model.to_json())
 
-    model.fit(X_train, y_train, epochs=N_EPOCHS, batch_size=BATCH_SIZE, callbacks=[file_accuracy])
+    model.fit(X_train, y_train, epochs=N_EPOCHS, batch_size=BATCH_SIZE, callbacks=[controller])
+
 
+    metrics = []
+    for epoch in controller.history:
+        print("\nModel Metrics (epoch {}):".format(epoch["epoch"]))
+        print("Accuracy: ", epoch["accuracy"])
+        print("Precision:", epoch["precision"])
+        print("Recall:   ", epoch["recall"])
+        print("F-Score:  ", epoch["fscore"])
+        metrics.append((epoch["accuracy"], np.array(epoch["precision"]), np.array(epoch["recall"]), np.array(epoch["fscore"])))
+
+    # for eda/results.py
+    with open("models/final_metrics.pkl", "wb") as f:
+        pickle.dump(metrics, f)
+
+
+
+def stateful_evaluation():
+    """
+    Compares the file accuracy of the final model on overlapping windows with the same weights run statefully over
+    whole tracks.
+
+    :return: None
+    """
+
+    with open("midi/classical/dataset.pkl", "rb") as f:
+        dataset = pickle.load(f)
+    model = load_from_disk("models/final")
+
+    print("\nOverlapping windows:")
+    eval_file_accuracy(dataset, model)
+    print("\nStateful:")
+    eval_file_accuracy(dataset, to_stateful(model, dataset), stateful=True)
 
-    i = 1
-    for accuracy, precision, recall, fscore in file_accuracy.history:
-        print("\nModel Metrics (epoch {}):".format(i))
-        print("Accuracy: ", accuracy)
-        print("Precision:", precision)
-        print("Recall:   ", recall)
-        print("F-Score:  ", fscore)
-        i += 1
 
-    with open("models/final.json" "wb") as f:
-        pickle.dump(file_accuracy.history, f)
 
 
 if __name__ == "__main__":
 
-    epoch_gridsearch()
+    from sys import argv
+
+    checkpoint_dir = CHECKPOINT_DIR
+    for arg in argv[1:]:
+        if arg.startswith("--checkpoint="):
+            checkpoint_dir = arg.split("=", 1)[1]
+
+    if "--resume" in argv:
+        checkpointed_training(checkpoint_dir, resume=True)
+    elif "--checkpointed" in argv:
+        checkpointed_training(checkpoint_dir)
+    elif "--stateful-eval" in argv:
+        stateful_evaluation()
+    else:
+        epoch_gridsearch()
@@ -0,0 +1,222 @@
+# Mark Evers
+# Created: 10/19/2026
+# progress.py
+# Progress and throughput reporting for the long running stages
+
+import json
+import os
+import sys
+import threading
+import time
+
+from src.globals import *
+
+
+
+def format_seconds(seconds):
+    """
+    Formats a duration as h:mm:ss.
+
+    :param seconds: The duration.
+    :return: A string, "?" if seconds is None
+    """
+
+    if seconds is None:
+        return "?"
+
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+
+def as_number(value):
+    """
+    Unwraps numpy scalars, the counts often come out of numpy arrays and json can't write them.
+
+    :param value: A number.
+    :return: The same number as a python int or float
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+
+class StdoutSink:
+    """
+    Draws a progress bar with rates and an ETA on one line of the terminal.
+    """
+
+    def __init__(self, stream=None):
+        """
+        :param stream: Where to draw, sys.stdout by default.
+        """
+        self.stream = stream or sys.stdout
+
+    def write(self, report):
+
+        i = int(report["done"] / report["total"] * 100) if report["total"] else 100
+        rates = "".join(" {:,.1f} {}/s".format(rate, unit) for unit, rate in report["rates"].items())
+
+        line = "\r{} [{}]{}%{}{} ETA {}".format(report["stage"], ("-" * int(i / 2) + (">" if i < 100 else "")).ljust(50),
+                                               str(i).rjust(4), "({}/{})".format(report["done"], report["total"]).rjust(15),
+                                               rates, format_seconds(report["eta"]))
+        if report.get("text"):
+            line += " " + report["text"]
+
+        self.stream.write(line)
+        if report["final"]:
+            self.stream.write("\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+
+class JsonLinesSink:
+    """
+    Appends every report to a file as one line of json.  Each line goes out in a single write to a file opened for
+    appending, so several processes can share the same log.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: The log file.
+        """
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def write(self, report):
+        os.write(self.fd, (json.dumps(report) + "\n").encode())
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class ProgressReporter:
+    """
+    Counts work done in one stage and hands reports to its sinks at most every <interval> seconds (and once at the end).
+    Any thread can call update().  Each process keeps its own counts, the reports carry the pid to tell them apart.
+
+    Usage:
+        with ProgressReporter("encode", len(files)) as progress:
+            for file in files:
+                ...
+                progress.update(notes=n_notes, windows=n_windows)
+    """
+
+    def __init__(self, stage, total, unit="files", interval=PROGRESS_INTERVAL, sinks=None):
+        """
+        :param stage: Name of the stage, shown on the bar and in the log.
+        :param total: How many items the stage will do.
+        :param unit: What an item is called in the rates.
+        :param interval: The minimum number of seconds between reports.
+        :param sinks: Where the reports go, default is the terminal plus PROGRESS_LOG if it's set.
+        """
+
+        self.stage = stage
+        self.total = as_number(total)
+        self.unit = unit
+        self.interval = interval
+
+        if sinks is None:
+            sinks = [StdoutSink()]
+            if PROGRESS_LOG:
+                sinks.append(JsonLinesSink(PROGRESS_LOG))
+        self.sinks = sinks
+
+        self.done = 0
+        self.counts = {}  # other things counted along the way, {"notes": 0, "windows": 0, ...}
+        self.text = ""
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_report_time = 0
+        self.closed = False
+
+
+
+    def update(self, done=1, text=None, **counts):
+        """
+        Records finished work.
+
+        :param done: How many more items are done.
+        :param text: Replaces the text shown after the bar.
+        :param counts: How much more of anything else was done, e.g. notes=1234, windows=56.
+        :return: None
+        """
+
+        with self.lock:
+            self.done += as_number(done)
+            for key, value in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + as_number(value)
+            if text is not None:
+                self.text = text
+
+            now = time.time()
+            if now - self.last_report_time >= self.interval or self.done >= self.total:
+                self.last_report_time = now
+                self._report(now, final=False)
+
+
+
+    def report(self):
+        """
+        Builds a report of the stage so far.
+
+        :return: A json-able dict
+        """
+
+        with self.lock:
+            return self._snapshot(time.time(), final=False)
+
+
+
+    def _snapshot(self, now, final):
+
+        elapsed = now - self.start_time
+        rates = {self.unit: self.done / elapsed if elapsed else 0.}
+        rates.update((key, value / elapsed if elapsed else 0.) for key, value in self.counts.items())
+
+        eta = None
+        if self.done and self.total:
+            eta = max(self.total - self.done, 0) * elapsed / self.done
+
+        return {"stage": self.stage, "pid": os.getpid(), "time": now, "elapsed": elapsed, "done": self.done,
+                "total": self.total, "counts": dict(self.counts), "rates": rates, "eta": eta, "text": self.text,
+                "final": final}
+
+
+
+    def _report(self, now, final):
+
+        report = self._snapshot(now, final)
+        for sink in self.sinks:
+            sink.write(report)
+
+
+
+    def close(self):
+        """
+        Sends the final report and closes the sinks.
+
+        :return: The final report
+        """
+
+        with self.lock:
+            if self.closed:
+                return None
+            self.closed = True
+
+            report = self._snapshot(time.time(), final=True)
+            for sink in self.sinks:
+                sink.write(report)
+                sink.close()
+
+        return report
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
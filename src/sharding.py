@@ -0,0 +1,559 @@
+# Mark Evers
+# Created: 10/19/2026
+# sharding.py
+# Splits archive-wide jobs (meta building, encoding, batch scoring) into shards that run on different machines sharing
+# a filesystem, and merges their outputs
+
+import csv
+import hashlib
+import json
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+
+from src.globals import *
+from src.batch_predict import find_midi_files, score_files, load_encoding
+from src.file_handlers.midi_archive import MidiArchive, write_meta
+from src.progress import ProgressReporter
+
+
+
+STAGES = ("meta", "encode", "score")
+# the arrays each encode shard saves, all in the order of its files' windows except counts
+ENCODE_ARRAYS = ("X", "y", "counts", "lengths", "drums")
+
+
+
+def shard_of(filename, n_shards, base_dir=None):
+    """
+    Which shard a file belongs to.  It only depends on the file's path relative to base_dir, so every node agrees
+    without talking to the others, wherever the shared filesystem is mounted.
+
+    :param filename: The file.
+    :param n_shards: How many shards there are.
+    :param base_dir: The directory the paths are relative to.
+    :return: A shard between 0 and n_shards - 1
+    """
+
+    key = os.path.relpath(filename, base_dir) if base_dir else filename
+    digest = hashlib.md5(key.replace(os.sep, "/").encode("utf-8", "surrogateescape")).digest()
+
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+
+
+def shard_dir(out_dir, stage, shard_i, n_shards):
+    """
+    :return: The directory a shard's partial outputs and manifest go in
+    """
+    return os.path.join(out_dir, stage, "shard-{:05d}-of-{:05d}".format(shard_i, n_shards))
+
+
+
+def load_dataset(archive_dir):
+    """
+    Loads the archive's dataset.pkl.  The nodes don't make it if it's missing, they would each split the files into
+    train and test differently.
+
+    :param archive_dir: The archive.
+    :return: The VectorGetter
+    """
+
+    with open(os.path.join(archive_dir, "dataset.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+
+def dataset_files(dataset):
+    """
+    :param dataset: A VectorGetter.
+    :return: Its train files then its test files, and their composers.  This is the order of the merged features, like
+             SharedCorpus.from_dataset().
+    """
+
+    filenames = list(dataset.X_train_filenames) + list(dataset.X_test_filenames)
+    composers = list(dataset.y_train_filenames) + list(dataset.y_test_filenames)
+
+    return filenames, composers
+
+
+
+def run_meta(archive_dir, directory, shard_i, n_shards):
+    """
+    Builds the meta rows and duplicate fingerprints of one shard's files.  Duplicates are only found when the shards
+    are merged, since the copies of a file can be in any shard.
+
+    :param archive_dir: The archive.
+    :param directory: Where the shard's outputs go.
+    :param shard_i: The shard.
+    :param n_shards: How many shards there are.
+    :return: What goes in the manifest
+    """
+
+    archive = MidiArchive(archive_dir)
+    archive.get_all_filenames()
+    archive.keep_filenames(lambda file: shard_of(file, n_shards, archive_dir) == shard_i)
+    print("Shard", shard_i, "has", archive.midi_filenames_total, "files")
+    archive.build_meta_df()
+
+    partial = {"meta_df": archive.meta_df, "duplicate_index": archive.duplicate_index,
+               "invalid": archive.midi_filenames_invalid, "quarantined": archive.midi_filenames_quarantined}
+    with open(os.path.join(directory, "meta.pkl"), "wb") as f:
+        pickle.dump(partial, f)
+
+    return {"files": archive.midi_filenames, "rows": len(archive.meta_df),
+            "invalid": len(archive.midi_filenames_invalid), "quarantined": len(archive.midi_filenames_quarantined)}
+
+
+
+def run_encode(archive_dir, directory, shard_i, n_shards):
+    """
+    Encodes one shard's files of the archive's dataset.pkl with VectorGetter.assemble().
+
+    :param archive_dir: The archive.
+    :param directory: Where the shard's outputs go.
+    :param shard_i: The shard.
+    :param n_shards: How many shards there are.
+    :return: What goes in the manifest
+    """
+
+    dataset = load_dataset(archive_dir)
+    filenames, composers = dataset_files(dataset)
+    keep = [i for i, file in enumerate(filenames) if shard_of(file, n_shards, archive_dir) == shard_i]
+    files = [filenames[i] for i in keep]
+    print("Shard", shard_i, "has", len(files), "files")
+
+    arrays = dataset.assemble(files, [composers[i] for i in keep], stage="encode")
+    for name, array in zip(ENCODE_ARRAYS, arrays):
+        np.save(os.path.join(directory, name + ".npy"), array)
+
+    return {"files": files, "windows": int(arrays[2].sum())}
+
+
+
+def run_score(archive_dir, directory, shard_i, n_shards, score_dir, model_file="models/final", n_processes=None):
+    """
+    Scores one shard's files of a directory with batch_predict.score_files().  Like batch_predict.py, running it again
+    picks up where an interrupted run left off.
+
+    :param archive_dir: The archive the model was trained on, for its composers.
+    :param directory: Where the shard's outputs go.
+    :param shard_i: The shard.
+    :param n_shards: How many shards there are.
+    :param score_dir: The directory to score.
+    :param model_file: The model, from save_to_disk().
+    :param n_processes: How many worker processes to encode with (default: one per core).
+    :return: What goes in the manifest
+    """
+
+    from src.model_final import load_from_disk
+    from src.file_handlers.dataset import VectorGetterNHot
+
+    files = [file for file in find_midi_files(score_dir) if shard_of(file, n_shards, score_dir) == shard_i]
+    print("Shard", shard_i, "has", len(files), "files")
+
+    composers = VectorGetterNHot(archive_dir).composers
+    score_files(load_from_disk(model_file), composers, files, os.path.join(directory, "predictions.csv"),
+                n_processes=n_processes, encoding=load_encoding(model_file))
+
+    return {"files": files}
+
+
+
+def run_shard(stage, shard_i, n_shards, archive_dir="midi/classical", out_dir=None, **kwargs):
+    """
+    Runs a stage for one shard.  Its manifest is written last, so a shard only counts as done once it has one.
+
+    :param stage: "meta", "encode" or "score".
+    :param shard_i: The shard.
+    :param n_shards: How many shards there are.
+    :param archive_dir: The archive.
+    :param out_dir: Where the shards go, SHARD_DIR in the archive by default.
+    :param kwargs: The rest of run_score()'s arguments.
+    :return: The manifest
+    """
+
+    if stage not in STAGES:
+        raise ValueError("Unknown stage " + str(stage))
+    if not 0 <= shard_i < n_shards:
+        raise ValueError("Shard {} is not between 0 and {}".format(shard_i, n_shards - 1))
+
+    directory = shard_dir(out_dir or os.path.join(archive_dir, SHARD_DIR), stage, shard_i, n_shards)
+    manifest_file = os.path.join(directory, "manifest.json")
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
+    started = time.time()
+    if stage == "meta":
+        manifest = run_meta(archive_dir, directory, shard_i, n_shards)
+    elif stage == "encode":
+        manifest = run_encode(archive_dir, directory, shard_i, n_shards)
+    else:
+        manifest = run_score(archive_dir, directory, shard_i, n_shards, **kwargs)
+
+    manifest.update({"stage": stage, "shard": shard_i, "n_shards": n_shards, "host": socket.gethostname(),
+                     "pid": os.getpid(), "seconds": round(time.time() - started, 3), "finished": time.time()})
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+    print("Shard", shard_i, "of", n_shards, "finished", stage, "in {:.1f}s".format(manifest["seconds"]))
+
+    return manifest
+
+
+
+def read_manifests(out_dir, stage, n_shards, expected_files, base_dir):
+    """
+    Checks that every shard of a stage finished and that together they cover expected_files exactly once.
+
+    :param out_dir: Where the shards are.
+    :param stage: The stage.
+    :param n_shards: How many shards there should be.
+    :param expected_files: Every file the stage should have covered.
+    :param base_dir: The directory the shards were hashed relative to.
+    :return: The manifests in shard order
+    """
+
+    manifests = []
+    problems = []
+
+    for shard_i in range(n_shards):
+        manifest_file = os.path.join(shard_dir(out_dir, stage, shard_i, n_shards), "manifest.json")
+        if not os.path.exists(manifest_file):
+            problems.append("shard {} has not finished (no {})".format(shard_i, manifest_file))
+            continue
+
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if manifest["stage"] != stage or manifest["shard"] != shard_i or manifest["n_shards"] != n_shards:
+            problems.append("{} is for {} shard {} of {}".format(manifest_file, manifest["stage"], manifest["shard"],
+                                                                  manifest["n_shards"]))
+            continue
+        manifests.append(manifest)
+
+    seen = {}
+    for manifest in manifests:
+        for file in manifest["files"]:
+            if file in seen:
+                problems.append("{} is in shards {} and {}".format(file, seen[file], manifest["shard"]))
+            elif shard_of(file, n_shards, base_dir) != manifest["shard"]:
+                problems.append("{} is in shard {}, it hashes to shard {}".format(
+                    file, manifest["shard"], shard_of(file, n_shards, base_dir)))
+            seen[file] = manifest["shard"]
+
+    if len(manifests) == n_shards:
+        expected_files = set(expected_files)
+        missing = expected_files.difference(seen)
+        extra = set(seen).difference(expected_files)
+        if missing:
+            problems.append("{} files are in no shard, e.g. {} (did the files change after the shards ran?)".format(
+                len(missing), min(missing)))
+        if extra:
+            problems.append("{} files in the shards are gone, e.g. {}".format(len(extra), min(extra)))
+
+    if problems:
+        raise ValueError("Can't merge {} shards:\n  ".format(stage) + "\n  ".join(problems))
+
+    print("All", n_shards, stage, "shards finished, {} files from {} hosts".format(
+        len(seen), len({manifest["host"] for manifest in manifests})))
+
+    return manifests
+
+
+
+def merge_meta(archive_dir="midi/classical", out_dir=None, n_shards=SHARD_COUNT):
+    """
+    Combines the meta shards and finds the duplicates across all of them.  meta.csv and duplicates.txt are saved in
+    the archive, like build_all_meta().
+
+    :param archive_dir: The archive.
+    :param out_dir: Where the shards are, SHARD_DIR in the archive by default.
+    :param n_shards: How many shards there are.
+    :return: The MidiArchive with the merged meta_df
+    """
+
+    import pandas as pd
+
+    out_dir = out_dir or os.path.join(archive_dir, SHARD_DIR)
+    archive = MidiArchive(archive_dir)
+    archive.get_all_filenames()
+    manifests = read_manifests(out_dir, "meta", n_shards, archive.midi_filenames, archive_dir)
+
+    frames = []
+    for manifest in manifests:
+        with open(os.path.join(shard_dir(out_dir, "meta", manifest["shard"], n_shards), "meta.pkl"), "rb") as f:
+            partial = pickle.load(f)
+
+        meta_df = partial["meta_df"]
+        if len(meta_df) != manifest["rows"] or not set(meta_df.index).issubset(manifest["files"]):
+            raise ValueError("The meta rows of shard {} don't match its manifest".format(manifest["shard"]))
+
+        if len(meta_df):
+            frames.append(meta_df)
+        archive.duplicate_index.update(partial["duplicate_index"])
+        archive.midi_filenames_invalid.extend(partial["invalid"])
+        archive.midi_filenames_quarantined.extend(partial["quarantined"])
+
+    if frames:
+        # in the order get_all_filenames() finds them, so the merge comes out the same every time
+        meta_df = pd.concat(frames)
+        archive.meta_df = meta_df.loc[[file for file in archive.midi_filenames if file in meta_df.index]]
+
+    print(len(archive.meta_df), "files in the meta,", len(archive.midi_filenames_invalid), "invalid,",
+          len(archive.midi_filenames_quarantined), "quarantined")
+    write_meta(archive, archive_dir)
+
+    return archive
+
+
+
+def merge_encode(archive_dir="midi/classical", out_dir=None, n_shards=SHARD_COUNT):
+    """
+    Gathers the encode shards into one set of .npy files in <out_dir>/encode/features, in the dataset's order: the
+    train files then the test files.  The arrays are written through memory maps, so the merge doesn't need the
+    memory to hold them.
+
+    :param archive_dir: The archive.
+    :param out_dir: Where the shards are, SHARD_DIR in the archive by default.
+    :param n_shards: How many shards there are.
+    :return: The directory of the merged features, see load_features()
+    """
+
+    out_dir = out_dir or os.path.join(archive_dir, SHARD_DIR)
+    dataset = load_dataset(archive_dir)
+    filenames, composers = dataset_files(dataset)
+    manifests = read_manifests(out_dir, "encode", n_shards, filenames, archive_dir)
+
+    # filename -> (the shard's arrays, first window, end)
+    windows = {}
+    shards = []
+    for manifest in manifests:
+        directory = shard_dir(out_dir, "encode", manifest["shard"], n_shards)
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in ENCODE_ARRAYS}
+        if len(arrays["counts"]) != len(manifest["files"]) or int(arrays["counts"].sum()) != len(arrays["X"]):
+            raise ValueError("The arrays of encode shard {} don't match its manifest".format(manifest["shard"]))
+
+        offsets = np.concatenate(([0], np.cumsum(arrays["counts"])))
+        for i, file in enumerate(manifest["files"]):
+            windows[file] = (arrays, int(offsets[i]), int(offsets[i + 1]))
+        shards.append(arrays)
+
+    for arrays in shards[1:]:
+        for name in ("X", "y"):
+            if arrays[name].shape[1:] != shards[0][name].shape[1:] or arrays[name].dtype != shards[0][name].dtype:
+                raise ValueError("The shards were encoded differently, {} is {} {} in one and {} {} in another".format(
+                    name, shards[0][name].dtype, shards[0][name].shape[1:], arrays[name].dtype, arrays[name].shape[1:]))
+
+    counts = np.array([windows[file][2] - windows[file][1] for file in filenames], dtype=np.int64)
+    file_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    file_labels = dataset.y_label_encoder.transform(composers)
+    n_windows = int(file_offsets[-1])
+
+    features_dir = os.path.join(out_dir, "encode", "features")
+    os.makedirs(features_dir, exist_ok=True)
+    merged = {name: np.lib.format.open_memmap(os.path.join(features_dir, name + ".npy"), mode="w+",
+                                              dtype=shards[0][name].dtype, shape=(n_windows,) + shards[0][name].shape[1:])
+              for name in ("X", "y", "lengths", "drums")}
+
+    with ProgressReporter("merge", len(filenames)) as progress:
+        for i, file in enumerate(filenames):
+            arrays, start, end = windows[file]
+            rows = slice(file_offsets[i], file_offsets[i + 1])
+            for name, array in merged.items():
+                array[rows] = arrays[name][start:end]
+
+            if not merged["y"][rows, file_labels[i]].all():
+                raise ValueError("{} is labelled differently in its shard than in dataset.pkl".format(file))
+            progress.update(windows=end - start)
+
+    for array in merged.values():
+        array.flush()
+    del merged
+    np.save(os.path.join(features_dir, "file_offsets.npy"), file_offsets)
+    np.save(os.path.join(features_dir, "file_labels.npy"), file_labels)
+    with open(os.path.join(features_dir, "features.json"), "w") as f:
+        json.dump({"filenames": filenames, "n_train_files": len(dataset.X_train_filenames), "windows": n_windows,
+                   "n_shards": n_shards}, f)
+
+    print("Merged", n_windows, "windows of", len(filenames), "files into", features_dir)
+
+    return features_dir
+
+
+
+def load_features(features_dir, mmap_mode="r"):
+    """
+    Loads the features merge_encode() saved.  The first six keys are SharedCorpus.publish()'s arguments.
+
+    :param features_dir: The directory.
+    :param mmap_mode: How np.load() maps the arrays, None reads them into memory.
+    :return: A dict of X, y, file_offsets, file_labels, filenames, n_train_files, lengths and drums
+    """
+
+    with open(os.path.join(features_dir, "features.json"), "r") as f:
+        info = json.load(f)
+
+    features = {name: np.load(os.path.join(features_dir, name + ".npy"), mmap_mode=mmap_mode)
+                for name in ("X", "y", "file_offsets", "file_labels")}
+    features["filenames"] = info["filenames"]
+    features["n_train_files"] = info["n_train_files"]
+    for name in ("lengths", "drums"):
+        features[name] = np.load(os.path.join(features_dir, name + ".npy"), mmap_mode=mmap_mode)
+
+    return features
+
+
+
+def merge_score(score_dir, output_file, archive_dir="midi/classical", out_dir=None, n_shards=SHARD_COUNT):
+    """
+    Combines the score shards into one csv file, like batch_predict.py's, sorted by filename.
+
+    :param score_dir: The directory that was scored.
+    :param output_file: Where the results go.
+    :param archive_dir: The archive.
+    :param out_dir: Where the shards are, SHARD_DIR in the archive by default.
+    :param n_shards: How many shards there are.
+    :return: How many files were scored
+    """
+
+    out_dir = out_dir or os.path.join(archive_dir, SHARD_DIR)
+    manifests = read_manifests(out_dir, "score", n_shards, find_midi_files(score_dir), score_dir)
+
+    header = None
+    rows = {}
+    for manifest in manifests:
+        predictions_file = os.path.join(shard_dir(out_dir, "score", manifest["shard"], n_shards), "predictions.csv")
+        if not manifest["files"]:
+            continue
+
+        with open(predictions_file, "r", newline="") as f:
+            reader = csv.reader(f)
+            shard_header = next(reader)
+            if header is None:
+                header = shard_header
+            elif shard_header != header:
+                raise ValueError("Score shard {} has different columns: {}".format(manifest["shard"], shard_header))
+
+            shard_files = set(manifest["files"])
+            for row in reader:
+                if row[0] not in shard_files or row[0] in rows:
+                    raise ValueError("Score shard {} has an unexpected row for {}".format(manifest["shard"], row[0]))
+                rows[row[0]] = row
+
+        unscored = shard_files.difference(rows)
+        if unscored:
+            raise ValueError("Score shard {} is missing {} files, e.g. {}".format(manifest["shard"], len(unscored),
+                                                                                min(unscored)))
+
+    with open(output_file + ".tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        if header is not None:
+            writer.writerow(header)
+        for file in sorted(rows):
+            writer.writerow(rows[file])
+    os.replace(output_file + ".tmp", output_file)
+
+    print("Saved the scores of", len(rows), "files to", output_file)
+
+    return len(rows)
+
+
+
+def run_local(stage, n_shards=SHARD_COUNT, archive_dir="midi/classical", out_dir=None, score_dir=None,
+              output_file=None, model_file="models/final"):
+    """
+    Runs every shard of a stage in its own process on this machine, as if each were a node, then merges them.  This
+    is the way to try the sharding before spreading it over machines.
+
+    :param stage: "meta", "encode" or "score".
+    :param n_shards: How many shards, and processes.
+    :param archive_dir: The archive.
+    :param out_dir: Where the shards go, SHARD_DIR in the archive by default.
+    :param score_dir: The directory to score, for "score".
+    :param output_file: Where the scores go, for "score".
+    :param model_file: The model, for "score".
+    :return: What the merge returned
+    """
+
+    common = ["--shards=" + str(n_shards), "--archive=" + archive_dir]
+    if out_dir:
+        common.append("--out=" + out_dir)
+    if stage == "score":
+        # the nodes share the cores
+        common += ["--dir=" + score_dir, "--model=" + model_file,
+                   "--processes=" + str(max(1, (os.cpu_count() or 1) // n_shards))]
+
+    if stage == "encode" and not os.path.exists(os.path.join(archive_dir, "dataset.pkl")):
+        from src.file_handlers.dataset import VectorGetterNHot
+        dataset = VectorGetterNHot(archive_dir)
+        with open(os.path.join(archive_dir, "dataset.pkl"), "wb") as f:
+            pickle.dump(dataset, f)
+
+    started = time.time()
+    nodes = [subprocess.Popen([sys.executable, "-m", "src.sharding", "run", stage, "--shard=" + str(shard_i)] + common)
+             for shard_i in range(n_shards)]
+    failed = [shard_i for shard_i, node in enumerate(nodes) if node.wait()]
+    if failed:
+        raise RuntimeError("Shards {} of {} failed".format(", ".join(str(shard_i) for shard_i in failed), stage))
+    print("\nAll", n_shards, "nodes finished in {:.1f}s, merging...".format(time.time() - started))
+
+    if stage == "meta":
+        return merge_meta(archive_dir, out_dir, n_shards)
+    elif stage == "encode":
+        return merge_encode(archive_dir, out_dir, n_shards)
+    else:
+        return merge_score(score_dir, output_file, archive_dir, out_dir, n_shards)
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in argv[1:] if arg.startswith("--") and "=" in arg)
+
+    if len(args) < 2 or args[0] not in ("run", "merge", "local") or args[1] not in STAGES or \
+            (args[0] == "run" and "shard" not in options) or \
+            (args[1] == "score" and ("dir" not in options or (args[0] != "run" and len(args) != 3))):
+        print("Usage:\n"
+              "  python sharding.py run <meta|encode|score> --shard=K [--shards=N] [--archive=DIR] [--out=DIR]\n"
+              "  python sharding.py merge <meta|encode> [--shards=N] [--archive=DIR] [--out=DIR]\n"
+              "  python sharding.py local <meta|encode> [--shards=N] [--archive=DIR] [--out=DIR]\n"
+              "Scoring also takes --dir=<midi_dir> [--model=models/final] [--processes=P], and merge and local take "
+              "the <output_file>.\n"
+              "Every node runs 'run' with its own --shard and the same --shards, then one of them runs 'merge'.  'local' "
+              "runs all the shards as processes on this machine and merges them.  'encode' needs the archive's "
+              "dataset.pkl.")
+        exit(1)
+
+    command, stage = args[0], args[1]
+    n_shards = int(options.get("shards", SHARD_COUNT))
+    archive_dir = options.get("archive", "midi/classical")
+    out_dir = options.get("out")
+
+    if command == "run":
+        kwargs = {}
+        if stage == "score":
+            kwargs = {"score_dir": options["dir"], "model_file": options.get("model", "models/final"),
+                      "n_processes": int(options["processes"]) if "processes" in options else None}
+        run_shard(stage, int(options["shard"]), n_shards, archive_dir, out_dir, **kwargs)
+
+    elif command == "merge":
+        if stage == "meta":
+            merge_meta(archive_dir, out_dir, n_shards)
+        elif stage == "encode":
+            merge_encode(archive_dir, out_dir, n_shards)
+        else:
+            merge_score(options["dir"], args[2], archive_dir, out_dir, n_shards)
+
+    else:
+        run_local(stage, n_shards, archive_dir, out_dir, options.get("dir"), args[2] if len(args) > 2 else None,
+                  options.get("model", "models/final"))
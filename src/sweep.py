@@ -0,0 +1,345 @@
+# Mark Evers
+# Created: 10/19/2026
+# sweep.py
+# Runs hyperparameter trials side by side in worker processes that share one encoded dataset
+
+import itertools
+import json
+import os
+import pickle
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from src.globals import *
+from src.file_handlers.dataset import VectorGetterNHot
+from src.file_handlers.shared_corpus import SharedCorpus, attach_from_file
+from src.progress import ProgressReporter
+
+
+
+# every combination is a trial with --grid, --random=N samples N of them
+SEARCH_SPACE = {
+    "units": [(665, 444, 222), (444, 296, 148), (256, 128, 64)],
+    "dropout": [(.555, .333, .111), (.3, .2, .1)],
+    "learning_rate": [.001, .0003],
+    "batch_size": [BATCH_SIZE, BATCH_SIZE * 2],
+    "epochs": [N_EPOCHS],
+}
+
+# set in every worker by _init_worker()
+_corpus = None
+_dataset = None
+_board = None
+_n_fit_files = 0
+
+
+
+def grid_trials(space):
+    """
+    :param space: {hyperparameter: [values]}
+    :return: A list of {hyperparameter: value}, one per combination
+    """
+
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+
+def random_trials(space, n_trials, seed=None):
+    """
+    Samples combinations without repeats.
+
+    :param space: {hyperparameter: [values]}
+    :param n_trials: How many to sample.  Capped at the number of combinations.
+    :param seed: For the same trials again.
+    :return: A list of {hyperparameter: value}
+    """
+
+    grid = grid_trials(space)
+    chosen = np.random.RandomState(seed).permutation(len(grid))[:n_trials]
+
+    return [grid[i] for i in chosen]
+
+
+
+def file_predictions(_model, corpus, first_file, last_file):
+    """
+    Classifies a range of a corpus' files: the window probabilities of each file are summed and the composer with the
+    most wins, like predict_one_file().
+
+    :param _model: The model.
+    :param corpus: A SharedCorpus.
+    :param first_file: The first file to classify.
+    :param last_file: One past the last file.
+    :return: A numpy array of label indexes, one per file
+    """
+
+    n_files = last_file - first_file
+    if not n_files:
+        return np.zeros(0, dtype=np.int64)
+
+    offsets = corpus.file_offsets[first_file:last_file + 1]
+    y_pred = _model.predict(corpus.X[offsets[0]:offsets[-1]], batch_size=PREDICT_BATCH_SIZE)
+
+    sum_probs = np.zeros((n_files, y_pred.shape[1]))
+    np.add.at(sum_probs, np.repeat(np.arange(n_files), np.diff(offsets)), y_pred)
+
+    return sum_probs.argmax(axis=1)
+
+
+
+def file_accuracy(_model, corpus, first_file, last_file):
+    """
+    File level accuracy over a range of a corpus' files, see file_predictions().
+
+    :param _model: The model.
+    :param corpus: A SharedCorpus.
+    :param first_file: The first file to score.
+    :param last_file: One past the last file.
+    :return: The fraction of the files classified correctly
+    """
+
+    if last_file == first_file:
+        return 0.
+
+    return float((file_predictions(_model, corpus, first_file, last_file) ==
+                  corpus.file_labels[first_file:last_file]).mean())
+
+
+
+def is_losing(trial_i, epoch, accuracy, board):
+    """
+    The median stopping rule: a trial is losing if it's below the median of the trials that reached the same epoch.
+
+    :param trial_i: The trial.
+    :param epoch: The epoch it just finished (from 0).
+    :param accuracy: Its accuracy after it.
+    :param board: {trial_i: [accuracy after each epoch]} of every trial so far.
+    :return: bool
+    """
+
+    if epoch + 1 < SWEEP_GRACE_EPOCHS:
+        return False
+
+    peers = [history[epoch] for other_i, history in board.items() if other_i != trial_i and len(history) > epoch]
+
+    return len(peers) >= SWEEP_MINIMUM_PEERS and accuracy < np.median(peers)
+
+
+
+def limit_threads(n_threads, cores):
+    """
+    Holds a worker to its share of the machine.  Has to happen before the first keras session is made.
+
+    :param n_threads: Threads for the math libraries and tensorflow.
+    :param cores: CPUs to pin the process to, None to leave it alone.
+    :return: None
+    """
+
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        os.environ[variable] = str(n_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    from keras import backend as K
+    if K.backend() == "tensorflow":
+        import tensorflow as tf
+        config = tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=1)
+        K.set_session(tf.Session(config=config))
+
+
+
+def _init_worker(manifest, dataset, board, core_sets, n_threads, n_fit_files):
+    """
+    Runs once in each worker process.
+
+    :param manifest: The SharedCorpus manifest.
+    :param dataset: The VectorGetter the corpus was encoded from, for create_model().
+    :param board: A managed dict of every trial's accuracies, for is_losing().
+    :param core_sets: A managed queue of CPU lists, each worker takes one.
+    :param n_threads: The worker's thread budget.
+    :param n_fit_files: The training files before this are trained on, the rest are for scoring.
+    :return: None
+    """
+
+    global _corpus, _dataset, _board, _n_fit_files
+
+    limit_threads(n_threads, core_sets.get())
+
+    _corpus = SharedCorpus.attach(manifest)
+    _dataset = dataset
+    _board = board
+    _n_fit_files = n_fit_files
+
+
+
+def run_trial(trial_i, params):
+    """
+    Trains one configuration an epoch at a time, scoring it on the held out training files after each epoch and giving
+    up once it's losing.  Runs in a worker.
+
+    :param trial_i: The trial's number.
+    :param params: {hyperparameter: value}, see SEARCH_SPACE.
+    :return: A json-able dict of the trial and how it went
+    """
+
+    # keras is only imported once limit_threads() has run
+    from src.model_final import create_model
+
+    started = time.time()
+    result = {"trial": trial_i, "params": params, "history": [], "status": "finished"}
+
+    try:
+        model = create_model(_dataset, units=params["units"], dropout=params["dropout"],
+                             learning_rate=params["learning_rate"])
+        n_fit_windows = int(_corpus.file_offsets[_n_fit_files])
+
+        for epoch in range(params["epochs"]):
+            model.fit(_corpus.X[:n_fit_windows], _corpus.y[:n_fit_windows], epochs=1,
+                      batch_size=params["batch_size"], verbose=0)
+
+            accuracy = file_accuracy(model, _corpus, _n_fit_files, _corpus.n_train_files)
+            result["history"].append(accuracy)
+            _board[trial_i] = list(result["history"])
+
+            if is_losing(trial_i, epoch, accuracy, _board):
+                result["status"] = "stopped"
+                break
+
+    except KeyboardInterrupt:
+        raise
+    except:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+
+    history = result["history"]
+    result["best_accuracy"] = max(history) if history else None
+    result["best_epoch"] = int(np.argmax(history)) + 1 if history else None
+    result["seconds"] = time.time() - started
+
+    return result
+
+
+
+def sweep(trials, archive_dir="midi/classical", workers=SWEEP_WORKERS, n_threads=SWEEP_THREADS,
+          results_file="models/sweep.jsonl"):
+    """
+    Runs every trial, SWEEP_WORKERS at a time.  The dataset is encoded once into a SharedCorpus (or attached to, if
+    shared_corpus.py is already serving it) and every worker trains on the same memory.  Each trial is appended to
+    results_file as it finishes.
+
+    :param trials: A list of {hyperparameter: value}, from grid_trials() or random_trials().
+    :param archive_dir: The archive, its dataset.pkl is made if it isn't there.
+    :param workers: How many trials at once.
+    :param n_threads: Threads per trial, None for an even share of the cores.
+    :param results_file: A json lines file to append the results to.
+    :return: The results, best first
+    """
+
+    dataset_pickle = os.path.join(archive_dir, "dataset.pkl")
+    manifest_file = os.path.join(archive_dir, "shared_corpus.json")
+
+    # use the same train/test split as everything else that loads dataset.pkl
+    if os.path.exists(dataset_pickle):
+        with open(dataset_pickle, "rb") as f:
+            dataset = pickle.load(f)
+    else:
+        dataset = VectorGetterNHot(archive_dir)
+        with open(dataset_pickle, "wb") as f:
+            pickle.dump(dataset, f)
+
+    if os.path.exists(manifest_file):
+        corpus = attach_from_file(manifest_file)
+    else:
+        corpus = SharedCorpus.from_dataset(dataset)
+
+    workers = max(min(workers, len(trials)), 1)
+    n_cores = os.cpu_count() or 1
+    if n_threads is None:
+        n_threads = max(n_cores // workers, 1)
+    n_fit_files = corpus.n_train_files - int(round(corpus.n_train_files * SWEEP_VALIDATION_FRACTION))
+    print("Running", len(trials), "trials,", workers, "at a time with", n_threads, "threads each")
+
+    # spawned so each worker's keras starts fresh with its own thread limits
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    try:
+        with context.Manager() as manager, ProgressReporter("sweep", len(trials), unit="trials") as progress:
+
+            board = manager.dict()
+            core_sets = manager.Queue()
+            for worker_i in range(workers):
+                cores = [core % n_cores for core in range(worker_i * n_threads, (worker_i + 1) * n_threads)]
+                core_sets.put(cores if workers * n_threads <= n_cores else None)
+
+            with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                     initargs=(corpus.manifest, dataset, board, core_sets, n_threads, n_fit_files)) as pool:
+
+                futures = [pool.submit(run_trial, trial_i, params) for trial_i, params in enumerate(trials)]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    with open(results_file, "a") as f:
+                        f.write(json.dumps(result) + "\n")
+
+                    progress.update(text="best {:.3f}".format(max(r["best_accuracy"] or 0 for r in results)),
+                                    **{result["status"]: 1})
+
+    finally:
+        corpus.close()
+
+    results.sort(key=lambda r: -1 if r["best_accuracy"] is None else r["best_accuracy"], reverse=True)
+    print_ranking(results)
+
+    return results
+
+
+
+def print_ranking(results):
+    """
+    :param results: Results from sweep(), best first.
+    :return: None
+    """
+
+    print("\n{:>5}  {:>8}  {:>5}  {:>8}  {:>6}  params".format("trial", "accuracy", "epoch", "status", "min"))
+    for result in results:
+        accuracy = "-" if result["best_accuracy"] is None else "{:.3f}".format(result["best_accuracy"])
+        print("{:>5}  {:>8}  {:>5}  {:>8}  {:>6.1f}  {}".format(result["trial"], accuracy, result["best_epoch"] or "-",
+                                                            result["status"], result["seconds"] / 60,
+                                                            json.dumps(result["params"])))
+
+
+
+
+if __name__ == "__main__":
+
+    from sys import argv
+
+    space = SEARCH_SPACE
+    n_random = None
+    workers = SWEEP_WORKERS
+    n_threads = SWEEP_THREADS
+    for arg in argv[1:]:
+        if arg.startswith("--space="):
+            with open(arg.split("=", 1)[1], "r") as f:
+                space = json.load(f)
+        elif arg.startswith("--random="):
+            n_random = int(arg.split("=", 1)[1])
+        elif arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        elif arg.startswith("--threads="):
+            n_threads = int(arg.split("=", 1)[1])
+
+    if "--grid" not in argv and n_random is None:
+        print("Usage:\n  python sweep.py (--grid | --random=N) [--space=<json>] [--workers=N] [--threads=N]")
+        print("The space is {hyperparameter: [values]} with units, dropout, learning_rate, batch_size and epochs.")
+        exit(1)
+
+    trials = grid_trials(space) if n_random is None else random_trials(space, n_random)
+    sweep(trials, workers=workers, n_threads=n_threads)
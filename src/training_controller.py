@@ -0,0 +1,181 @@
+# Mark Evers
+# Created: 10/19/2026
+# training_controller.py
+# Early stopping, learning rate plateaus and checkpoint retention driven by file level accuracy
+
+import json
+import os
+import time
+import numpy as np
+from keras.callbacks import Callback
+from keras import backend as K
+
+from src.globals import *
+
+
+
+class TrainingController(Callback):
+    """
+    Scores the model at the end of every epoch and decides what to do about it:
+
+    - the weights are saved to <prefix>_best.h5 whenever file accuracy improves by more than EARLY_STOPPING_MIN_DELTA
+    - the last KEEP_LAST_CHECKPOINTS epochs are kept as <prefix>_<epoch>-<accuracy>.h5, older ones are deleted
+    - after LR_PLATEAU_PATIENCE epochs without improvement the learning rate is multiplied by LR_REDUCE_FACTOR
+    - after EARLY_STOPPING_PATIENCE epochs without improvement training stops
+
+    Every epoch is added to a json history file.  Works as a keras callback, or by calling on_epoch_end() from a
+    custom training loop (see checkpointed_fit_model(), which saves state() in its checkpoints).
+    """
+
+    def __init__(self, evaluate, prefix="models/final", patience=EARLY_STOPPING_PATIENCE,
+                 min_delta=EARLY_STOPPING_MIN_DELTA, lr_patience=LR_PLATEAU_PATIENCE, lr_factor=LR_REDUCE_FACTOR,
+                 min_lr=LR_MINIMUM, keep_last=KEEP_LAST_CHECKPOINTS):
+        """
+        :param evaluate: Called with the model, returns (accuracy, precision, recall, fscore) like eval_file_accuracy().
+        :param prefix: Where the weights and <prefix>_history.json go.
+        :param patience: Epochs without improvement before stopping, None to never stop early.
+        :param min_delta: How much accuracy has to go up to count as an improvement.
+        :param lr_patience: Epochs without improvement before the learning rate is reduced, None to leave it alone.
+        :param lr_factor: What the learning rate is multiplied by.
+        :param min_lr: The learning rate isn't reduced below this.
+        :param keep_last: How many of the latest epochs' weights to keep, 0 for only the best.
+        """
+
+        super().__init__()
+
+        self.evaluate = evaluate
+        self.prefix = prefix
+        self.history_file = prefix + "_history.json"
+        self.patience = patience
+        self.min_delta = min_delta
+        self.lr_patience = lr_patience
+        self.lr_factor = lr_factor
+        self.min_lr = min_lr
+        self.keep_last = keep_last
+
+        self.best_accuracy = None
+        self.best_epoch = None
+        self.wait = 0  # epochs since the last improvement
+        self.lr_wait = 0  # epochs since the last improvement or learning rate reduction
+        self.stopped_epoch = None
+        self.kept = []  # the last keep_last weight files, oldest first
+        self.history = []  # one dict per epoch
+        self.epoch_started = None
+
+
+
+    def state(self):
+        """
+        :return: Everything needed to pick up where this left off, a json-able dict
+        """
+
+        return {"best_accuracy": self.best_accuracy, "best_epoch": self.best_epoch, "wait": self.wait,
+                "lr_wait": self.lr_wait, "stopped_epoch": self.stopped_epoch, "kept": self.kept,
+                "history": self.history, "lr": self.get_lr()}
+
+
+
+    def restore(self, state):
+        """
+        Continues from a state().  Needs the model set (set_model() or model.fit()).
+
+        :param state: From state(), None to start fresh.
+        :return: None
+        """
+
+        if not state:
+            return
+
+        for key in ("best_accuracy", "best_epoch", "wait", "lr_wait", "stopped_epoch", "kept", "history"):
+            setattr(self, key, state[key])
+        # the learning rate isn't one of the optimizer's weights, so the checkpoint doesn't have it
+        if state["lr"] is not None:
+            K.set_value(self.model.optimizer.lr, state["lr"])
+
+
+
+    def get_lr(self):
+        """
+        :return: The optimizer's learning rate, None without a model
+        """
+
+        if getattr(self, "model", None) is None:
+            return None
+        return float(K.get_value(self.model.optimizer.lr))
+
+
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_started = time.time()
+
+
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        accuracy, precision, recall, fscore = self.evaluate(self.model)
+        lr = self.get_lr()
+
+        improved = self.best_accuracy is None or accuracy > self.best_accuracy + self.min_delta
+        if improved:
+            self.best_accuracy = accuracy
+            self.best_epoch = epoch + 1
+            self.wait = 0
+            self.lr_wait = 0
+            self.save_weights(self.prefix + "_best.h5")
+        else:
+            self.wait += 1
+            self.lr_wait += 1
+
+        if self.keep_last:
+            weights_file = "{}_{:02d}-{:.2f}.h5".format(self.prefix, epoch + 1, accuracy)
+            self.save_weights(weights_file)
+            self.kept.append(weights_file)
+            while len(self.kept) > self.keep_last:
+                old_file = self.kept.pop(0)
+                if os.path.exists(old_file):
+                    os.remove(old_file)
+
+        new_lr = None
+        if self.lr_patience is not None and self.lr_wait >= self.lr_patience and lr > self.min_lr:
+            new_lr = max(lr * self.lr_factor, self.min_lr)
+            K.set_value(self.model.optimizer.lr, new_lr)
+            self.lr_wait = 0
+            print("\nNo improvement in", self.lr_patience, "epochs, learning rate", lr, "->", new_lr)
+
+        if self.patience is not None and self.wait >= self.patience:
+            self.stopped_epoch = epoch + 1
+            self.model.stop_training = True
+            print("\nNo improvement in", self.patience, "epochs, stopping.  Best accuracy", self.best_accuracy,
+                  "at epoch", self.best_epoch)
+
+        record = {"epoch": epoch + 1, "accuracy": float(accuracy), "precision": np.asarray(precision).tolist(),
+                  "recall": np.asarray(recall).tolist(), "fscore": np.asarray(fscore).tolist(), "lr": lr,
+                  "new_lr": new_lr, "improved": bool(improved),
+                  "seconds": time.time() - self.epoch_started if self.epoch_started else None}
+        record.update({key: float(np.mean(value)) for key, value in (logs or {}).items()})
+        self.history.append(record)
+        self.write_history()
+
+
+
+    def save_weights(self, filename):
+        """
+        Saves the weights to a temporary file first, so an interrupted save doesn't clobber the last good one.
+
+        :param filename: Where to save them.
+        :return: None
+        """
+
+        self.model.save_weights(filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+
+
+
+    def write_history(self):
+
+        history = {"best_accuracy": self.best_accuracy, "best_epoch": self.best_epoch,
+                   "stopped_epoch": self.stopped_epoch, "epochs": self.history}
+
+        with open(self.history_file + ".tmp", "w") as f:
+            json.dump(history, f, indent=1)
+        os.replace(self.history_file + ".tmp", self.history_file)
@@ -5,6 +5,7 @@
 
 
 import os
+import queue
 import sys
 sys.path.append(os.getcwd())
 sys.path.append("src")
@@ -15,8 +16,9 @@ from werkzeug.utils import secure_filename
 from src.file_handlers.dataset import VectorGetterNHot
 from src.model_final import load_from_disk
 import numpy as np
-from src.file_handlers.midi_archive import MidiArchive
-from src.midi_handlers.midi_file import MidiFileNHot
+from src.globals import SERVING_MODEL, WEBAPP_PARSE_WORKERS
+from src.file_handlers.quarantine import ParseWorker, ParseLimitError
+from src.batch_predict import encode_upload, load_encoding
 import tensorflow as tf
 
 
@@ -25,8 +27,14 @@ app.secret_key = os.urandom(24)
 composers = VectorGetterNHot("midi/classical").composers
 upload_folder = "temp_midi_uploads"
 
-model = load_from_disk("models/final")
+model = load_from_disk(SERVING_MODEL)
+# encode uploads the way the model was trained, a distilled student can use another encoder than the final model
+encoding = load_encoding(SERVING_MODEL)
 graph = tf.get_default_graph()
+# the idle ParseWorkers, a fixed pool.  Their processes start with the first upload each one parses
+parse_workers = queue.Queue()
+for _ in range(WEBAPP_PARSE_WORKERS):
+    parse_workers.put(ParseWorker())
 
 
 ALLOWED_EXTENSIONS = {"mid", "midi", "MID", "MIDI"}
@@ -40,10 +48,12 @@ def predict_one_file(filename):
 
     global graph
 
-    note_dist = MidiArchive.parse_midi_meta(filename)[14:]
-
-    mid = MidiFileNHot(filename, note_dist)
-    X = np.array(mid.to_X(), dtype=np.byte)
+    # uploads get the same time and memory limits as the archive, and wait for a worker when they're all busy
+    worker = parse_workers.get()
+    try:
+        X = worker.parse(encode_upload, filename, *encoding)
+    finally:
+        parse_workers.put(worker)
 
     with graph.as_default():
         y_pred = model.predict(X)
@@ -103,6 +113,9 @@ def midi():
 
             try:
                 prediction, probs = predict_one_file(temp_midifile_path)
+            except ParseLimitError as e:
+                print("Upload over the parse limits:", e)
+                return render_template("shell.html", content="corrupt.html")
             except:
                 return render_template("shell.html", content="corrupt.html")
             finally: